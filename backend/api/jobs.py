@@ -0,0 +1,184 @@
+from typing import List, Literal, Optional
+
+import anyio
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel, Field
+
+from ml_core.job_store import find_job_dir, finish_job_record, load_job_record
+from ml_core.render_recipes import discard_job, is_preview, load_recipes, load_rejected, reject_outputs
+from ml_core.scheduler import scheduler
+from ml_core import selection
+
+router = APIRouter()
+
+
+class SelectRequest(BaseModel):
+    # Text model (shorts) parameters
+    num_clips: Optional[int] = Field(None, ge=1, description="Number of clips to generate per platform")
+    max_duration_yt: Optional[int] = Field(None, ge=10, le=60, description="Max duration for YouTube shorts in seconds")
+    target_format: Optional[Literal["youtube", "instagram", "both"]] = None
+    # Motion model parameters
+    std_factor: Optional[float] = Field(None, ge=0, description="Motion threshold = mean + std_factor * std")
+    min_motion_frames: Optional[int] = Field(None, ge=1)
+    merge_gap: Optional[float] = Field(None, ge=0, description="Motion intervals closer than this (seconds) are merged")
+    min_clip_duration: Optional[float] = Field(None, ge=0)
+    max_clip_duration: Optional[float] = Field(None, gt=0)
+    min_total_fraction: Optional[float] = Field(None, gt=0, le=1, description="Share of the video the main reel covers")
+    short_target: Optional[float] = Field(None, gt=0)
+    story_target: Optional[float] = Field(None, gt=0)
+
+
+class RejectRequest(BaseModel):
+    outputs: List[str] = Field(..., min_items=1, description="Previews or outputs (relative to the job) to reject")
+
+
+# Pipeline -> (request model, starter) of jobs that can run again from their records. main.py registers
+# its starters here, since this router can not import main.py (which includes it).
+JOB_STARTERS = {}
+
+TEXT_PARAMETERS = ("num_clips", "max_duration_yt", "target_format")
+MOTION_PARAMETERS = ("std_factor", "min_motion_frames", "merge_gap", "min_clip_duration", "max_clip_duration",
+                     "min_total_fraction", "short_target", "story_target")
+
+
+@router.post("/jobs/{job_id}/select", tags=["Jobs"])
+async def reselect_highlights(job_id: str, request: SelectRequest):
+    """
+    Recomputes a finished job's highlight timestamps with new selection parameters, from the
+    features its pipeline stored (transcript segments, audio peaks, scenes or the motion curve).
+    Nothing is decoded or rendered, so this is cheap enough for interactive tuning.
+    """
+    pipeline, job_dir = find_job_dir(job_id)
+    if job_dir is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    try:
+        features = await anyio.to_thread.run_sync(selection.load_selection_features, job_dir)
+    except (OSError, ValueError):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} has no stored selection features (it may predate them or still be running).")
+
+    params = request.dict(exclude_none=True)
+    if pipeline == "text":
+        result = selection.select_text_job(features, **{k: v for k, v in params.items() if k in TEXT_PARAMETERS})
+    else:
+        try:
+            result = selection.select_motion_job(features, **{k: v for k, v in params.items() if k in MOTION_PARAMETERS})
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+    return {"job_id": job_id, "pipeline": pipeline, "parameters": params, "selection": result}
+
+
+def _job_or_404(job_id):
+    pipeline, job_dir = find_job_dir(job_id)
+    if job_dir is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return pipeline, job_dir
+
+
+@router.get("/jobs/{job_id}", tags=["Jobs"])
+async def get_job_status(job_id: str):
+    """
+    Lists a job's previews and outputs. Previews (fast 360p encodes with a VTT subtitle sidecar)
+    exist as soon as the job returns; full-quality outputs are "pending" until rendered, either by
+    the background renderer or on their first request under /static/outputs.
+    While a job is queued or running, "scheduling" has its predicted start and completion times.
+    """
+    scheduling = scheduler.status(job_id)
+    pipeline, job_dir = find_job_dir(job_id)
+    if job_dir is None:
+        if scheduling is None:
+            raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+        # Jobs without an output directory (transcriptions)
+        return {"job_id": job_id, "pipeline": scheduler.jobs[job_id]["pipeline"], "scheduling": scheduling}
+    # Reads the recipe files and stats every output: off the event loop
+    previews, outputs = await anyio.to_thread.run_sync(_list_job_outputs, job_id, job_dir)
+    return {"job_id": job_id, "pipeline": pipeline, "previews": previews, "outputs": outputs, "scheduling": scheduling}
+
+
+def _list_job_outputs(job_id, job_dir):
+    """(previews, outputs) of a job with their render state, as listed by GET /jobs/{job_id}. Blocking."""
+    recipes = load_recipes(job_dir)
+    rejected = load_rejected(job_dir)
+    url_prefix = f"{job_dir.parent.name}/{job_id}"
+
+    def state(relative_path):
+        if relative_path in rejected:
+            return "rejected"
+        return "rendered" if (job_dir / relative_path).exists() else "pending"
+
+    previews, outputs = [], []
+    for relative_path, recipe in sorted(recipes.items()):
+        if recipe["kind"] == "subtitles_vtt":
+            continue
+        entry = {"path": f"{url_prefix}/{relative_path}", "state": state(relative_path)}
+        if is_preview(recipe):
+            entry["subtitles"] = f"{url_prefix}/{recipe['subtitles']}" if recipe.get("subtitles") else None
+            entry["full_outputs"] = [f"{url_prefix}/{rel}" for rel in recipe.get("full_outputs", [])]
+            previews.append(entry)
+        else:
+            outputs.append(entry)
+    return previews, outputs
+
+
+@router.post("/jobs/{job_id}/reject", tags=["Jobs"])
+async def reject_job_outputs(job_id: str, request: RejectRequest):
+    """
+    Rejects highlights: a rejected preview cancels the full-quality renders it stands for (and those
+    of merged reels / shorts built from them); rejected outputs are never rendered.
+    """
+    _pipeline, job_dir = _job_or_404(job_id)
+    recipes = await anyio.to_thread.run_sync(load_recipes, job_dir)
+    url_prefix = f"{job_dir.parent.name}/{job_id}/"
+    # Accept paths as listed in the job status (with the job prefix) as well as relative to the job
+    requested = [path[len(url_prefix):] if path.startswith(url_prefix) else path for path in request.outputs]
+    unknown = [path for path in requested if path not in recipes]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown outputs for job {job_id}: {', '.join(unknown)}")
+    # Takes the recipe file lock and signals running renders
+    rejected, cancelled = await anyio.to_thread.run_sync(reject_outputs, job_dir, requested)
+    return {"job_id": job_id, "rejected": [f"{url_prefix}{rel}" for rel in rejected], "cancelled_renders": cancelled}
+
+
+@router.delete("/jobs/{job_id}", tags=["Jobs"])
+async def cancel_job(job_id: str):
+    """
+    Cancels a job and removes its outputs. A queued job leaves the queue; a running job's whole
+    process tree (the pipeline script, ffmpeg, yt-dlp, whisper workers) is terminated and its temp
+    files are removed. Background renders of a finished job are stopped and its outputs deleted.
+    """
+    scheduling = scheduler.status(job_id)
+    _pipeline, job_dir = find_job_dir(job_id)
+    record = await anyio.to_thread.run_sync(load_job_record, job_id)
+    if job_dir is None and scheduling is None and record is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    cancelled = await scheduler.cancel(job_id)
+    removed = await anyio.to_thread.run_sync(discard_job, job_dir) if job_dir is not None else 0
+    # A failed job can not be retried any more
+    await anyio.to_thread.run_sync(finish_job_record, job_id, "cancelled")
+    previous_state = scheduling["state"] if scheduling else (record or {}).get("state", "finished")
+    return {"job_id": job_id, "cancelled": cancelled, "previous_state": previous_state, "outputs_removed": removed}
+
+
+def register_job_starter(pipeline, request_model, start_job):
+    """start_job(request, job_id, user, respond_async, requeued) admits and runs a job of the pipeline."""
+    JOB_STARTERS[pipeline] = (request_model, start_job)
+
+
+async def resubmit_job(record, requeued=False):
+    """Queues a recorded job again under its job_id, in the background: matching stage checkpoints are skipped."""
+    request_model, start_job = JOB_STARTERS[record["pipeline"]]
+    return await start_job(request_model(**record["request"]), record["job_id"], record["user"], True, requeued)
+
+
+@router.post("/jobs/{job_id}/retry", tags=["Jobs"])
+async def retry_job(job_id: str):
+    """
+    Runs a failed job again with its original request (202, like Prefer: respond-async). It keeps its
+    job_id and output directory, so the stages whose checkpoints still match are not run again.
+    """
+    record = await anyio.to_thread.run_sync(load_job_record, job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} has no record to retry (unknown, succeeded or cancelled).")
+    if record["state"] != "failed":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} has not failed; it is still queued or running.")
+    return await resubmit_job(record)
@@ -0,0 +1,146 @@
+import asyncio
+import re
+from typing import Optional
+
+import anyio
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+
+from ml_core.upload_store import (
+    ALLOWED_VIDEO_EXTENSIONS, advance_running_hash, create_session, discard_session, load_session, running_hash,
+    save_session, server_file_path, session_dir, store_upload
+)
+
+router = APIRouter()
+
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+
+# One request at a time may append to a session
+_session_locks = {}
+
+
+class CreateUploadRequest(BaseModel):
+    filename: str = Field(..., description="Original file name; its extension must be a video type")
+    length: Optional[int] = Field(None, gt=0, description="Total size in bytes, if known")
+
+
+def _session_or_404(upload_id):
+    session = load_session(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found.")
+    return session
+
+
+def _status(session):
+    return {"upload_id": session["upload_id"], "offset": session["offset"], "length": session["length"],
+            "complete": session["length"] is not None and session["offset"] == session["length"]}
+
+
+@router.post("/upload/sessions", status_code=201, tags=["Video Upload"])
+async def create_upload_session(request: CreateUploadRequest):
+    """
+    Starts a resumable upload. Send the bytes with PUT /upload/sessions/{upload_id} (Content-Range,
+    in order; after a dropped connection continue from the offset GET reports), then finalize.
+    """
+    extension = request.filename[request.filename.rfind("."):].lower() if "." in request.filename else ""
+    if extension not in ALLOWED_VIDEO_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Invalid file type: {extension}. Please upload a video file.")
+    session = await anyio.to_thread.run_sync(create_session, request.filename, request.length)
+    return _status(session)
+
+
+@router.get("/upload/sessions/{upload_id}", tags=["Video Upload"])
+async def get_upload_session(upload_id: str):
+    """Current offset of an upload: the next PUT has to start there."""
+    return _status(_session_or_404(upload_id))
+
+
+@router.put("/upload/sessions/{upload_id}", tags=["Video Upload"])
+async def put_upload_chunk(upload_id: str, request: Request):
+    """
+    Appends the body as the byte range given in Content-Range ("bytes start-end/total" or ".../*").
+    The range has to start at the current offset. Bytes that arrive before a dropped connection are
+    kept, so the client resumes from the offset in the response (or GET) instead of from zero.
+    """
+    session = _session_or_404(upload_id)
+    match = CONTENT_RANGE_PATTERN.match(request.headers.get("content-range", ""))
+    if not match:
+        raise HTTPException(status_code=400, detail="A Content-Range header 'bytes start-end/total' is required.")
+    start, end, total = int(match.group(1)), int(match.group(2)), match.group(3)
+    if end < start:
+        raise HTTPException(status_code=400, detail="Invalid Content-Range.")
+    if total != "*":
+        if session["length"] is None:
+            session["length"] = int(total)
+        elif session["length"] != int(total):
+            raise HTTPException(status_code=400, detail=f"Upload length is {session['length']} bytes, not {total}.")
+    if session["length"] is not None and end >= session["length"]:
+        raise HTTPException(status_code=400, detail=f"Range ends after the upload length ({session['length']} bytes).")
+
+    lock = _session_locks.setdefault(upload_id, asyncio.Lock())
+    async with lock:
+        session = {**_session_or_404(upload_id), "length": session["length"]}
+        if start != session["offset"]:
+            return JSONResponse(status_code=409, headers={"Upload-Offset": str(session["offset"])},
+                                content={"detail": f"Range must start at the current offset {session['offset']}.",
+                                         **_status(session)})
+        expected = end - start + 1
+        digest = await anyio.to_thread.run_sync(running_hash, session)
+        received = 0
+        try:
+            async with await anyio.open_file(session_dir(upload_id) / "data", "r+b") as data_file:
+                await data_file.seek(start)
+                async for chunk in request.stream():
+                    chunk = chunk[:expected - received]
+                    if not chunk:
+                        continue
+                    await data_file.write(chunk)
+                    digest.update(chunk)
+                    received += len(chunk)
+                await data_file.truncate()
+        finally:
+            # Whatever arrived is kept, even if the client went away mid-chunk
+            session["offset"] = start + received
+            advance_running_hash(session, digest)
+            await anyio.to_thread.run_sync(save_session, session)
+    return _status(session)
+
+
+@router.post("/upload/sessions/{upload_id}/finalize", tags=["Video Upload"])
+async def finalize_upload_session(upload_id: str):
+    """
+    Completes an upload. The sha256 was kept up to date as bytes arrived, so this does not re-read
+    the file. If the same video was stored before, the existing file is returned instead.
+    """
+    async with _session_locks.setdefault(upload_id, asyncio.Lock()):
+        # Loaded under the lock: a PUT that was still appending has saved its offset by now, and a
+        # finalize that ran first has removed the session (404 instead of storing a missing file)
+        session = _session_or_404(upload_id)
+        if session["offset"] == 0:
+            raise HTTPException(status_code=409, detail="Nothing was uploaded yet.")
+        if session["length"] is not None and session["offset"] != session["length"]:
+            raise HTTPException(status_code=409, detail=f"Upload incomplete: {session['offset']} of {session['length']} bytes.")
+        content_hash = (await anyio.to_thread.run_sync(running_hash, session)).hexdigest()
+        try:
+            stored_path, duplicate = await anyio.to_thread.run_sync(
+                store_upload, session_dir(upload_id) / "data", content_hash, session["extension"])
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found.")
+        await anyio.to_thread.run_sync(discard_session, upload_id)
+    _session_locks.pop(upload_id, None)
+
+    return {
+        "message": "Duplicate of an already uploaded video" if duplicate else "File uploaded successfully",
+        "server_file_path": server_file_path(stored_path),
+        "content_sha256": content_hash,
+        "duplicate": duplicate,
+    }
+
+
+@router.delete("/upload/sessions/{upload_id}", tags=["Video Upload"])
+async def abort_upload_session(upload_id: str):
+    _session_or_404(upload_id)
+    await anyio.to_thread.run_sync(discard_session, upload_id)
+    _session_locks.pop(upload_id, None)
+    return {"upload_id": upload_id, "aborted": True}
@@ -4,6 +4,7 @@ import yt_dlp # Use yt-dlp
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from ..ml_core.highlight import extract_highlights
+from ..ml_core.download_cache import download_with_cache
 
 router = APIRouter()
 
@@ -27,10 +28,7 @@ async def download_and_highlight_ytdlp(data: YouTubeRequest):
     if not url:
         raise HTTPException(status_code=400, detail="YouTube URL cannot be empty.")
 
-    video_filename = f"{uuid.uuid4()}.mp4"
-    # Ensure output_template uses a path relative to where yt-dlp will be "run" from
-    # or an absolute path. Since DOWNLOAD_DIR is absolute or correctly relative, this should be fine.
-    output_template = os.path.join(DOWNLOAD_DIR, video_filename)
+    video_filename = str(uuid.uuid4())
     
     # yt-dlp options
     # Forcing mp4 can sometimes fail if a native mp4 isn't available in the chosen quality.
@@ -39,8 +37,6 @@ async def download_and_highlight_ytdlp(data: YouTubeRequest):
     # For simplicity, we'll try to get an mp4 directly.
     # Using a format string less likely to require merging if ffmpeg is not present.
     ydl_opts = {
-        'format': 'best[ext=mp4]/best', # Prefer best single MP4 file, fallback to overall best
-        'outtmpl': output_template,
         'noplaylist': True,       # Download only the single video
         'quiet': True,            # Suppress yt-dlp console output
         'no_warnings': True,
@@ -51,35 +47,13 @@ async def download_and_highlight_ytdlp(data: YouTubeRequest):
 
     try:
         print(f"Processing YouTube URL with yt-dlp: {url}")
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(url, download=False) # First get info
-            video_title = info_dict.get('title', 'Unknown Title')
-            
-            # Check if a direct mp4 format is available, otherwise yt-dlp might download something else
-            # and we'd need a postprocessor to convert.
-            # For this version, we rely on yt-dlp finding an mp4.
-            
-            print(f"Downloading video: {video_title}")
-            ydl.download([url]) # Perform download
-            
-            # yt-dlp might add format suffix to filename if not mp4, or if title is used in template.
-            # Since we use a UUID.mp4, it should be fairly predictable.
-            # The `prepare_filename` method is safer if `outtmpl` uses template strings like %(title)s.
-            # With a fixed output_template like ours, the path should be `output_template`.
-            downloaded_file_path = output_template 
-            if not os.path.exists(downloaded_file_path):
-                # Fallback if filename was altered by yt-dlp (e.g. if it wasn't mp4 and it saved as .mkv etc)
-                # This is a simple check; more robust would be to parse ydl.prepare_filename(info_dict)
-                # or check info_dict for actual downloaded filename if possible.
-                # For now, assume output_template is the correct path if download succeeded.
-                # A common issue: if format is not mp4, it saves as e.g. .mkv, then this path is wrong.
-                # Let's try to find the downloaded file if exact match fails.
-                possible_files = [os.path.join(DOWNLOAD_DIR, f) for f in os.listdir(DOWNLOAD_DIR) if f.startswith(str(uuid.UUID(video_filename.split('.')[0])))]
-                if possible_files:
-                    downloaded_file_path = possible_files[0] # take the first match
-                    print(f"Adjusted downloaded file path to: {downloaded_file_path}")
-                else: # if still not found
-                    raise HTTPException(status_code=500, detail=f"Downloaded file not found at expected path: {output_template} or similar.")
+        # The download cache resolves the video id and format first, so a video that was already
+        # downloaded (by any job) is copied from the cache instead of fetched again.
+        # 'best[ext=mp4]/best': prefer best single MP4 file, fallback to overall best
+        downloaded_file_path, info_dict = download_with_cache(url, DOWNLOAD_DIR, 'best[ext=mp4]/best', ydl_opts,
+                                                              filename=video_filename)
+        video_title = info_dict.get('title', 'Unknown Title')
+        print(f"Downloaded video: {video_title}")
 
     except yt_dlp.utils.DownloadError as e:
         print(f"yt-dlp DownloadError: {e}")
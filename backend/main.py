@@ -1,15 +1,36 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile
+from fastapi import FastAPI, HTTPException, File, Request, UploadFile
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import subprocess
 import uuid
 import os
 import sys # Import sys module
 from pathlib import Path
 import shutil # Add shutil
+import hashlib
+import math
+import json
+import secrets
+import anyio
 from pydantic import BaseModel, HttpUrl, Field, root_validator # Add root_validator
 from typing import Literal, Optional # Add Optional
 
+from fastapi.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+from ml_core.cache_utils import CACHE_ROOT
+from ml_core.ingest import INGEST_CHUNK_SIZE, StreamingIngest
+from ml_core.upload_store import store_upload
+from ml_core.job_store import claim_interrupted_jobs, find_job_dir, finish_job_record, save_job_record
+from ml_core.render_recipes import RENDER_TIMEOUT, load_recipes, pending_outputs, source_ranges
+from ml_core.cpu_budget import job_environment
+from ml_core.admission import describe_source, predict_job
+from ml_core.scheduler import (
+    AdmissionRejected, JobCancelled, run_subprocess, scheduler, scheduler_user, terminate_job_processes
+)
+
 PYTHON_EXECUTABLE = sys.executable
 
 app = FastAPI(
@@ -47,8 +68,133 @@ UPLOADED_VIDEOS_DIR = project_root_for_uploads / "uploaded_videos"
 # Create the directory if it doesn't exist
 UPLOADED_VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
 
+# On-demand renders are scheduler jobs: they wait for a slot, get a CPU share and go through admission
+# control like pipeline jobs (503 + Retry-After when the queue is too long). The request that starts
+# one waits LAZY_RENDER_WAIT seconds at most, so short renders are still served by the first request;
+# otherwise it gets 202 + Retry-After and the render goes on in the background, shared by every
+# request for the same file.
+LAZY_RENDER_WAIT = float(os.environ.get("LAZY_RENDER_WAIT", "10"))
+on_demand_renders = {}  # static path -> task rendering it
+
+class LazyStaticFiles(StaticFiles):
+    """
+    Serves job outputs; an output that was recorded as a render recipe but not rendered yet is
+    rendered (as a scheduler job, single-flight per file) on its first request, then served.
+    """
+
+    async def get_response(self, path, scope):
+        try:
+            return await super().get_response(path, scope)
+        except StarletteHTTPException as e:
+            if e.status_code != 404 or scope["method"] not in ("GET", "HEAD"):
+                raise
+        render = on_demand_renders.get(path)
+        if render is None:
+            recorded = await run_in_threadpool(recorded_output, path)
+            if recorded is None:
+                raise StarletteHTTPException(status_code=404)
+            render = on_demand_renders.get(path) or start_render(path, *recorded)
+        done, _ = await asyncio.wait({render}, timeout=LAZY_RENDER_WAIT)
+        if not done:
+            job = render.job
+            status = scheduler.status(job["job_id"]) or {}
+            retry_after = max(1, math.ceil(status.get("estimated_seconds_remaining") or 1))
+            return JSONResponse(status_code=202, headers={"Retry-After": str(retry_after)},
+                                content={"job_id": job["job_id"], "status_url": f"/jobs/{job['job_id']}", **status})
+        if not render.result():
+            raise StarletteHTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+
+def recorded_output(path):
+    """(job_dir, relative output, recipe) of outputs/<pipeline>_outputs/<job_id>/<file> if it has a render recipe, else None."""
+    parts = Path(path).parts
+    if len(parts) < 3 or ".." in parts:
+        return None
+    _pipeline, job_dir = find_job_dir(parts[1])
+    if job_dir is None or job_dir.parent.name != parts[0]:
+        return None
+    relative_output = "/".join(parts[2:])
+    recipe = load_recipes(job_dir).get(relative_output)
+    if recipe is None:
+        return None
+    return job_dir, relative_output, recipe
+
+
+def start_render(path, job_dir, relative_output, recipe):
+    """
+    Admits the render of a recorded output to the scheduler and starts it in the background. Returns
+    its task (with the scheduler job as task.job); raises 503 + Retry-After if admission rejects it.
+    """
+    ranges = source_ranges(recipe)
+    duration = sum(end - start for start, end in ranges) if ranges else None
+    prediction = predict_job("render", {"duration": duration or None})
+    render_id = f"render-{hashlib.sha256(path.encode()).hexdigest()[:16]}"
+    try:
+        # All on-demand renders share one fair-share user, so a burst of them can not crowd out pipeline jobs
+        job = scheduler.admit(render_id, "on-demand-render", "render", prediction)
+    except AdmissionRejected as e:
+        raise StarletteHTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    render = asyncio.create_task(render_on_demand(path, job_dir, relative_output, job))
+    render.job = job
+    on_demand_renders[path] = render
+    render.add_done_callback(lambda _: on_demand_renders.pop(path, None))
+    return render
+
+
+async def render_on_demand(path, job_dir, relative_output, job):
+    """
+    Renders outputs/<pipeline>_outputs/<job_id>/<file> from its recipe once the scheduler starts the
+    job. Returns True if the file exists afterwards. The render runs in its own session like job
+    scripts (run_subprocess), so a timeout or DELETE /jobs/{render job} terminates its whole process
+    tree (ffmpeg, moviepy workers) too.
+    """
+    render_script = Path(__file__).resolve().parent / "ml_core" / "render_recipes.py"
+    try:
+        async with scheduler.slot(job):
+            await run_subprocess([PYTHON_EXECUTABLE, str(render_script), str(job_dir), relative_output],
+                                 timeout=RENDER_TIMEOUT, env=job_environment(job["job_id"]), job=job)
+    except subprocess.TimeoutExpired:
+        print(f"On-demand render of {path} timed out after {RENDER_TIMEOUT}s")
+    except subprocess.CalledProcessError as e:
+        print(f"On-demand render of {path} failed: {e.stderr[-1000:]}")
+    except JobCancelled:
+        print(f"On-demand render of {path} was cancelled")
+    return await run_in_threadpool((job_dir / relative_output).is_file)
+
+
 # Now mount it
-app.mount("/static/outputs", StaticFiles(directory=outputs_dir), name="static_outputs")
+app.mount("/static/outputs", LazyStaticFiles(directory=outputs_dir), name="static_outputs")
+
+# Optional batched transcription service: one process holds the Whisper models and decodes the
+# 30 s windows of all concurrent jobs together. The scripts find it through ASR_SERVICE_ADDRESS and
+# authenticate with ASR_SERVICE_AUTHKEY, a secret generated here (unless configured) and inherited by
+# the service and every job script through the environment.
+ASR_SERVICE_ENABLED = os.environ.get("ASR_SERVICE_ENABLED", "off") == "on"
+asr_service_process = None
+
+@app.on_event("startup")
+def start_asr_service():
+    global asr_service_process
+    if not ASR_SERVICE_ENABLED:
+        return
+    service_script_path = Path(__file__).resolve().parent / "ml_core" / "asr_service.py"
+    asr_service_address = os.environ.setdefault("ASR_SERVICE_ADDRESS", str(CACHE_ROOT / "asr_service.sock"))
+    os.environ.setdefault("ASR_SERVICE_AUTHKEY", secrets.token_hex(32))
+    preload = os.environ.get("ASR_SERVICE_PRELOAD", "base").split()
+    asr_service_process = subprocess.Popen(
+        [PYTHON_EXECUTABLE, str(service_script_path), "--address", asr_service_address, "--preload", *preload]
+    )
+    print(f"Started ASR service (pid {asr_service_process.pid}) on {asr_service_address}")
+
+@app.on_event("shutdown")
+def stop_asr_service():
+    if asr_service_process and asr_service_process.poll() is None:
+        asr_service_process.terminate()
+        try:
+            asr_service_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            asr_service_process.kill()
 
 @app.get("/")
 async def read_root():
@@ -72,9 +218,18 @@ async def upload_video_file(file: UploadFile = File(...)):
     unique_filename = f"{uuid.uuid4()}{extension}"
     save_path = UPLOADED_VIDEOS_DIR / unique_filename
 
+    digest = hashlib.sha256()
     try:
-        with save_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Copied in chunks with async file I/O (hashing on the way) so the event loop is not blocked;
+        # large files should use the resumable /upload/sessions protocol instead
+        async with await anyio.open_file(save_path, "wb") as buffer:
+            while True:
+                chunk = await file.read(INGEST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await buffer.write(chunk)
+                digest.update(chunk)
+        save_path, duplicate = await run_in_threadpool(store_upload, save_path, digest.hexdigest(), extension)
     except Exception as e:
         # Log the exception e if you have a logger configured
         # print(f"Error saving file: {e}") # For debugging
@@ -84,8 +239,53 @@ async def upload_video_file(file: UploadFile = File(...)):
 
     return {
         "message": "File uploaded successfully",
-        "server_file_path": str(save_path.relative_to(project_root_for_uploads))
+        "server_file_path": str(save_path.relative_to(project_root_for_uploads)),
         # This path is relative to the project root, e.g., "uploaded_videos/xyz.mp4"
+        "content_sha256": digest.hexdigest(),
+        "duplicate": duplicate,
+    }
+
+@app.post("/upload/video/stream")
+async def upload_video_stream(request: Request, filename: str):
+    """
+    Streaming ingest: the raw request body (not multipart) is the video. It is written to disk in
+    chunks, hashed for the content cache and piped into the analysis decoders while it arrives, so
+    /process/motion/ and /process/text/ find the analysis features ready right after the upload.
+    """
+    extension = Path(filename).suffix
+    if extension.lower() not in ['.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv', '.wmv']:
+        raise HTTPException(status_code=400, detail=f"Invalid file type: {extension}. Please upload a video file.")
+
+    save_path = UPLOADED_VIDEOS_DIR / f"{uuid.uuid4()}{extension}"
+    ingest = await run_in_threadpool(StreamingIngest, save_path)
+    try:
+        # Disk writes, hashing and pipe feeding block, so they run in the threadpool, a chunk at a time
+        pending = bytearray()
+        async for chunk in request.stream():
+            pending.extend(chunk)
+            if len(pending) >= INGEST_CHUNK_SIZE:
+                await run_in_threadpool(ingest.write, bytes(pending))
+                pending.clear()
+        if pending:
+            await run_in_threadpool(ingest.write, bytes(pending))
+        if ingest.size == 0:
+            raise HTTPException(status_code=400, detail="Empty upload.")
+        content_hash, analysis_state = await run_in_threadpool(ingest.finish)
+        save_path, duplicate = await run_in_threadpool(store_upload, save_path, content_hash, extension)
+    except HTTPException:
+        await run_in_threadpool(ingest.abort)
+        raise
+    except Exception as e:
+        # Includes the client disconnecting mid-upload; the partial file is removed
+        await run_in_threadpool(ingest.abort)
+        raise HTTPException(status_code=500, detail=f"Could not save file: {filename}. Error: {str(e)}")
+
+    return {
+        "message": "File uploaded successfully",
+        "server_file_path": str(save_path.relative_to(project_root_for_uploads)),
+        "content_sha256": content_hash,
+        "duplicate": duplicate,
+        "analysis": analysis_state,
     }
 
 class MotionRequest(BaseModel):
@@ -106,6 +306,10 @@ class TextProcessRequest(BaseModel):
     num_clips: int = Field(default=3, ge=1, description="Number of clips to generate per platform")
     max_duration_yt: int = Field(default=59, ge=10, le=60, description="Max duration for YouTube shorts in seconds")
     target_format: Literal["youtube", "instagram", "both"] = "both"
+    asr_model: Optional[str] = None # Whisper model for transcription, e.g., tiny, base, small (script default: base)
+    asr_engine: Optional[Literal["fp32", "int8"]] = None # int8 = dynamically quantized Whisper for CPU-only hosts
+    sparse_transcription: Optional[bool] = None # Only transcribe windows around audio peaks / scene cuts; None = SPARSE_TRANSCRIPTION env
+    streaming_render: Optional[bool] = None # Render highlight clips while transcription still runs; None = STREAMING_RENDER env
 
     @root_validator(pre=False, skip_on_failure=True)
     def check_one_source_provided(cls, values):
@@ -118,23 +322,66 @@ class TranscriptionRequest(BaseModel):
     server_video_file_path: str # Path relative to project root (e.g., "outputs/motion_model_outputs/job_id/video.mp4")
     output_format: Literal["txt", "srt", "vtt", "tsv", "json"] = "txt"
     model_name: Optional[str] = "base" # e.g., tiny, base, small, medium, large
+    engine: Optional[Literal["fp32", "int8"]] = None # int8 = dynamically quantized Linear layers, faster on CPU; None = ASR_ENGINE env / fp32
 
 # Base directory for text model outputs (relative to this file: backend/main.py)
 # This constant isn't strictly used at module level in the provided snippet,
 # but defined as per instructions. It's effectively used to construct paths inside the endpoint.
 TEXT_OUTPUTS_BASE_DIR = Path("../outputs/text_model_outputs")
 
+# Set when this worker shuts down: the jobs it is still running stay active in their records, so the
+# next worker re-queues them (see requeue_interrupted_jobs)
+worker_shutting_down = False
+requeue_tasks = set()
+
+def prefers_async(http_request):
+    return "respond-async" in http_request.headers.get("prefer", "").lower()
+
+async def admit_job(job_id, pipeline, request, source, model, user, requeued=False):
+    """
+    Predicts the job's runtime and peak memory (ml_core/admission.py) and queues it with the scheduler.
+    Answers 429 + Retry-After instead when the predicted queue wait is over the limit. Admitted jobs
+    get a durable record (ml_core/job_store.py), so they can be retried or re-queued after a restart.
+    """
+    source_info = await run_in_threadpool(describe_source, source)
+    prediction = await run_in_threadpool(predict_job, pipeline, source_info, model)
+    try:
+        job = scheduler.admit(job_id, user, pipeline, prediction)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    await run_in_threadpool(save_job_record, job_id, pipeline, json.loads(request.json()), user, requeued)
+    return job
+
+async def run_job(job, execute, respond_async):
+    """
+    Runs an admitted job and returns its response. With "Prefer: respond-async" the job continues in
+    the background and 202 is returned right away; GET /jobs/{job_id} reports its state, estimated
+    completion time and, once finished, the response it would have returned.
+    """
+    async def execute_and_record():
+        try:
+            return await execute()
+        finally:
+            if not worker_shutting_down:
+                await run_in_threadpool(finish_job_record, job["job_id"], job["state"], job.get("error"))
+
+    if not respond_async:
+        return await execute_and_record()
+    scheduler.track(job, asyncio.create_task(execute_and_record()))
+    return JSONResponse(status_code=202, content={"job_id": job["job_id"], "status_url": f"/jobs/{job['job_id']}",
+                                                  **scheduler.status(job["job_id"])})
+
 @app.post("/process/motion/")
-async def process_motion_video(request: MotionRequest):
-    job_id = str(uuid.uuid4())
-    
+async def process_motion_video(request: MotionRequest, http_request: Request):
+    return await start_motion_job(request, str(uuid.uuid4()), scheduler_user(http_request), prefers_async(http_request))
+
+async def start_motion_job(request, job_id, user, respond_async, requeued=False):
     project_root = Path(__file__).resolve().parent.parent
     # Base directory for all motion model outputs, relative to project root
     motion_outputs_root = project_root / "outputs" / "motion_model_outputs"
     
-    # Unique output directory for this specific job
+    # Unique output directory for this specific job (created once the job is admitted)
     absolute_output_dir_for_job = motion_outputs_root / job_id
-    absolute_output_dir_for_job.mkdir(parents=True, exist_ok=True)
 
     # Path to the motion processor script
     # Assuming motion_model is at the project root, and this main.py is in backend/
@@ -156,74 +403,88 @@ async def process_motion_video(request: MotionRequest):
         str(absolute_output_dir_for_job) # The script will create its content inside this dir
     ]
 
-    try:
-        # Using subprocess.run for simplicity, consider asyncio.create_subprocess_exec for non-blocking
-        result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=600) # 10 min timeout
-    except subprocess.CalledProcessError as e:
-        print(f"Error during motion processing script execution for job {job_id}:")
-        print(f"Command: {' '.join(map(str, command))}")
-        print(f"Return code: {e.returncode}")
-        print(f"Stdout: {e.stdout}")
-        print(f"Stderr: {e.stderr}")
-        raise HTTPException(status_code=500, detail=f"Motion processing script failed. Stderr: {e.stderr}")
-    except subprocess.TimeoutExpired as e:
-        print(f"Motion processing script timed out for job {job_id}:")
-        print(f"Command: {' '.join(map(str, command))}")
-        # stdout/stderr might be bytes, decode them
-        stdout_decoded = e.stdout.decode(errors='ignore') if isinstance(e.stdout, bytes) else e.stdout
-        stderr_decoded = e.stderr.decode(errors='ignore') if isinstance(e.stderr, bytes) else e.stderr
-        print(f"Stdout: {stdout_decoded}")
-        print(f"Stderr: {stderr_decoded}")
-        raise HTTPException(status_code=504, detail="Motion processing timed out.")
-    except FileNotFoundError:
-        # This error means either 'python' command is not found or the script_path is incorrect.
-        print(f"Motion processing script or Python interpreter not found for job {job_id}. Script path: {absolute_script_path}")
-        raise HTTPException(status_code=500, detail=f"Motion processing script not found at {str(absolute_script_path)} or Python interpreter not in PATH.")
-    except Exception as e: # Catch any other unexpected errors
-        print(f"An unexpected error occurred during motion processing for job {job_id}: {str(e)}")
-        print(f"Command: {' '.join(map(str, command))}")
-        raise HTTPException(status_code=500, detail=f"An unexpected error occurred during motion processing: {str(e)}")
-
-    generated_files = []
-    # The motion_processor.py script might create a subdirectory within absolute_output_dir_for_job.
-    # We need to list all files recursively in absolute_output_dir_for_job.
-    for root_dir, _, files_in_dir in os.walk(absolute_output_dir_for_job):
-        for file_name in files_in_dir:
-            full_path = Path(root_dir) / file_name
-            try:
-                # Make path relative to project_root/outputs for the response
-                # e.g., "motion_model_outputs/{job_id}/file.mp4"
-                relative_path = full_path.relative_to(motion_outputs_root.parent) # parent is 'outputs'
-                generated_files.append(str(relative_path))
-            except ValueError:
-                # Fallback if the path structure is not as expected (e.g., not under motion_outputs_root.parent)
-                # This might happen if absolute_output_dir_for_job was outside the expected 'outputs' structure
-                # For robustness, make it relative to the job directory and then prepend a known base.
-                relative_to_job_dir = full_path.relative_to(absolute_output_dir_for_job)
-                generated_files.append(str(Path("motion_model_outputs") / job_id / relative_to_job_dir))
+    job = await admit_job(job_id, "motion", request, input_source_for_script, None, user, requeued)
+    absolute_output_dir_for_job.mkdir(parents=True, exist_ok=True)
+
+    async def execute():
+        # Waits for a scheduler slot (shortest job first, fair share per user); the timeout starts with the script
+        try:
+            async with scheduler.slot(job):
+                result = await run_subprocess(command, timeout=600, env=job_environment(job_id), job=job) # 10 min timeout
+        except subprocess.CalledProcessError as e:
+            print(f"Error during motion processing script execution for job {job_id}:")
+            print(f"Command: {' '.join(map(str, command))}")
+            print(f"Return code: {e.returncode}")
+            print(f"Stdout: {e.stdout}")
+            print(f"Stderr: {e.stderr}")
+            raise HTTPException(status_code=500, detail=f"Motion processing script failed. Stderr: {e.stderr}")
+        except subprocess.TimeoutExpired as e:
+            print(f"Motion processing script timed out for job {job_id}:")
+            print(f"Command: {' '.join(map(str, command))}")
+            # stdout/stderr might be bytes, decode them
+            stdout_decoded = e.stdout.decode(errors='ignore') if isinstance(e.stdout, bytes) else e.stdout
+            stderr_decoded = e.stderr.decode(errors='ignore') if isinstance(e.stderr, bytes) else e.stderr
+            print(f"Stdout: {stdout_decoded}")
+            print(f"Stderr: {stderr_decoded}")
+            raise HTTPException(status_code=504, detail="Motion processing timed out.")
+        except FileNotFoundError:
+            # This error means either 'python' command is not found or the script_path is incorrect.
+            print(f"Motion processing script or Python interpreter not found for job {job_id}. Script path: {absolute_script_path}")
+            raise HTTPException(status_code=500, detail=f"Motion processing script not found at {str(absolute_script_path)} or Python interpreter not in PATH.")
+        except JobCancelled:
+            # DELETE /jobs/{job_id} stopped the script's process tree
+            raise HTTPException(status_code=409, detail=f"Job {job_id} was cancelled.")
+        except Exception as e: # Catch any other unexpected errors
+            print(f"An unexpected error occurred during motion processing for job {job_id}: {str(e)}")
+            print(f"Command: {' '.join(map(str, command))}")
+            raise HTTPException(status_code=500, detail=f"An unexpected error occurred during motion processing: {str(e)}")
+
+        generated_files = []
+        # The motion_processor.py script might create a subdirectory within absolute_output_dir_for_job.
+        # We need to list all files recursively in absolute_output_dir_for_job.
+        for root_dir, _, files_in_dir in os.walk(absolute_output_dir_for_job):
+            for file_name in files_in_dir:
+                full_path = Path(root_dir) / file_name
+                try:
+                    # Make path relative to project_root/outputs for the response
+                    # e.g., "motion_model_outputs/{job_id}/file.mp4"
+                    relative_path = full_path.relative_to(motion_outputs_root.parent) # parent is 'outputs'
+                    generated_files.append(str(relative_path))
+                except ValueError:
+                    # Fallback if the path structure is not as expected (e.g., not under motion_outputs_root.parent)
+                    # This might happen if absolute_output_dir_for_job was outside the expected 'outputs' structure
+                    # For robustness, make it relative to the job directory and then prepend a known base.
+                    relative_to_job_dir = full_path.relative_to(absolute_output_dir_for_job)
+                    generated_files.append(str(Path("motion_model_outputs") / job_id / relative_to_job_dir))
             
-    if not generated_files and result.stdout: # Check stdout if no files found, for debugging
-        print(f"Job {job_id} completed but no files found in {absolute_output_dir_for_job}. Script stdout: {result.stdout}")
+        # Outputs recorded as render recipes are listed too; they are rendered on their first request
+        generated_files.extend(str(Path("motion_model_outputs") / job_id / relative_output)
+                               for relative_output in pending_outputs(absolute_output_dir_for_job))
 
-    return {
-        "job_id": job_id,
-        "output_base_directory": str(Path("outputs") / "motion_model_outputs" / job_id), # Relative to project root
-        "generated_files": generated_files,
-        "stdout": result.stdout, # For debugging, can be removed or logged differently later
-        "stderr": result.stderr  # For debugging
-    }
+        if not generated_files and result.stdout: # Check stdout if no files found, for debugging
+            print(f"Job {job_id} completed but no files found in {absolute_output_dir_for_job}. Script stdout: {result.stdout}")
+
+        return {
+            "job_id": job_id,
+            "output_base_directory": str(Path("outputs") / "motion_model_outputs" / job_id), # Relative to project root
+            "generated_files": generated_files,
+            "stdout": result.stdout, # For debugging, can be removed or logged differently later
+            "stderr": result.stderr  # For debugging
+        }
+
+    return await run_job(job, execute, respond_async)
 
 @app.post("/process/text/")
-async def process_text_video(request: TextProcessRequest):
-    job_id = str(uuid.uuid4())
-    
+async def process_text_video(request: TextProcessRequest, http_request: Request):
+    return await start_text_job(request, str(uuid.uuid4()), scheduler_user(http_request), prefers_async(http_request))
+
+async def start_text_job(request, job_id, user, respond_async, requeued=False):
     project_root = Path(__file__).resolve().parent.parent
     absolute_script_path = project_root / "backend" / "text_model" / "process_shorts.py"
     
     # absolute_output_dir is derived from project_root, consistent with motion model
     # TEXT_OUTPUTS_BASE_DIR is effectively project_root / "outputs" / "text_model_outputs"
     absolute_output_dir = project_root / "outputs" / "text_model_outputs" / job_id
-    absolute_output_dir.mkdir(parents=True, exist_ok=True)
 
     input_source_for_script = None
     if request.video_url:
@@ -249,77 +510,102 @@ async def process_text_video(request: TextProcessRequest):
     elif request.server_file_path:
         # process_shorts.py expects --input_file_path with the path
         command.extend(["--input_file_path", input_source_for_script]) # input_source_for_script is the absolute file path
+    if request.asr_model:
+        command.extend(["--asr-model", request.asr_model])
+    if request.asr_engine:
+        command.extend(["--asr-engine", request.asr_engine])
+    if request.sparse_transcription is not None:
+        command.extend(["--sparse-transcription", "on" if request.sparse_transcription else "off"])
+    if request.streaming_render is not None:
+        command.extend(["--streaming-render", "on" if request.streaming_render else "off"])
+
+    job = await admit_job(job_id, "text", request, input_source_for_script, request.asr_model, user, requeued)
+    absolute_output_dir.mkdir(parents=True, exist_ok=True)
 
-    try:
-        # Consider a longer timeout for text processing + transcription
-        result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=900) # 15 min timeout
-    except subprocess.CalledProcessError as e:
-        # Ensure stdout/stderr are strings, even if None or bytes
-        stdout_str = e.stdout.decode(errors='ignore') if isinstance(e.stdout, bytes) else str(e.stdout) if e.stdout is not None else ""
-        stderr_str = e.stderr.decode(errors='ignore') if isinstance(e.stderr, bytes) else str(e.stderr) if e.stderr is not None else ""
+    async def execute():
+        try:
+            # Consider a longer timeout for text processing + transcription
+            async with scheduler.slot(job):
+                result = await run_subprocess(command, timeout=900, env=job_environment(job_id), job=job) # 15 min timeout
+        except subprocess.CalledProcessError as e:
+            # Ensure stdout/stderr are strings, even if None or bytes
+            stdout_str = e.stdout.decode(errors='ignore') if isinstance(e.stdout, bytes) else str(e.stdout) if e.stdout is not None else ""
+            stderr_str = e.stderr.decode(errors='ignore') if isinstance(e.stderr, bytes) else str(e.stderr) if e.stderr is not None else ""
         
-        error_detail = "Text processing script failed."
-        if stdout_str: error_detail += f" STDOUT: {stdout_str}"
-        if stderr_str: error_detail += f" STDERR: {stderr_str}"
+            error_detail = "Text processing script failed."
+            if stdout_str: error_detail += f" STDOUT: {stdout_str}"
+            if stderr_str: error_detail += f" STDERR: {stderr_str}"
         
-        print(f"Error during text processing script execution for job {job_id}:")
-        print(f"Command: {' '.join(map(str, command))}")
-        print(f"Return code: {e.returncode}")
-        if stdout_str: print(f"Stdout: {stdout_str}")
-        if stderr_str: print(f"Stderr: {stderr_str}")
-        raise HTTPException(status_code=500, detail=error_detail)
-    except subprocess.TimeoutExpired as e:
-        stdout_decoded = e.stdout.decode(errors='ignore') if isinstance(e.stdout, bytes) else str(e.stdout) if e.stdout is not None else ""
-        stderr_decoded = e.stderr.decode(errors='ignore') if isinstance(e.stderr, bytes) else str(e.stderr) if e.stderr is not None else ""
+            print(f"Error during text processing script execution for job {job_id}:")
+            print(f"Command: {' '.join(map(str, command))}")
+            print(f"Return code: {e.returncode}")
+            if stdout_str: print(f"Stdout: {stdout_str}")
+            if stderr_str: print(f"Stderr: {stderr_str}")
+            raise HTTPException(status_code=500, detail=error_detail)
+        except subprocess.TimeoutExpired as e:
+            stdout_decoded = e.stdout.decode(errors='ignore') if isinstance(e.stdout, bytes) else str(e.stdout) if e.stdout is not None else ""
+            stderr_decoded = e.stderr.decode(errors='ignore') if isinstance(e.stderr, bytes) else str(e.stderr) if e.stderr is not None else ""
         
-        detail_message = "Text processing timed out after 15 minutes."
-        if stdout_decoded: detail_message += f" STDOUT: {stdout_decoded}"
-        if stderr_decoded: detail_message += f" STDERR: {stderr_decoded}"
+            detail_message = "Text processing timed out after 15 minutes."
+            if stdout_decoded: detail_message += f" STDOUT: {stdout_decoded}"
+            if stderr_decoded: detail_message += f" STDERR: {stderr_decoded}"
         
-        print(f"Text processing script timed out for job {job_id}:")
-        print(f"Command: {' '.join(map(str, command))}")
-        if stdout_decoded: print(f"Stdout: {stdout_decoded}")
-        if stderr_decoded: print(f"Stderr: {stderr_decoded}")
-        raise HTTPException(status_code=504, detail=detail_message)
-    except FileNotFoundError:
-        print(f"Text processing script or Python interpreter not found for job {job_id}. Script path: {absolute_script_path}")
-        raise HTTPException(status_code=500, detail=f"Text processing script not found at {str(absolute_script_path)} or Python interpreter not in PATH.")
-    except Exception as e: # Catch any other unexpected errors
-        print(f"An unexpected error occurred during text processing for job {job_id}: {str(e)}")
-        print(f"Command: {' '.join(map(str, command))}")
-        raise HTTPException(status_code=500, detail=f"An unexpected error occurred during text processing: {str(e)}")
-
-    generated_files = []
-    outputs_root_for_relative_paths = project_root / "outputs" # Base for making paths relative
+            print(f"Text processing script timed out for job {job_id}:")
+            print(f"Command: {' '.join(map(str, command))}")
+            if stdout_decoded: print(f"Stdout: {stdout_decoded}")
+            if stderr_decoded: print(f"Stderr: {stderr_decoded}")
+            raise HTTPException(status_code=504, detail=detail_message)
+        except FileNotFoundError:
+            print(f"Text processing script or Python interpreter not found for job {job_id}. Script path: {absolute_script_path}")
+            raise HTTPException(status_code=500, detail=f"Text processing script not found at {str(absolute_script_path)} or Python interpreter not in PATH.")
+        except JobCancelled:
+            # DELETE /jobs/{job_id} stopped the script's process tree
+            raise HTTPException(status_code=409, detail=f"Job {job_id} was cancelled.")
+        except Exception as e: # Catch any other unexpected errors
+            print(f"An unexpected error occurred during text processing for job {job_id}: {str(e)}")
+            print(f"Command: {' '.join(map(str, command))}")
+            raise HTTPException(status_code=500, detail=f"An unexpected error occurred during text processing: {str(e)}")
+
+        generated_files = []
+        outputs_root_for_relative_paths = project_root / "outputs" # Base for making paths relative
     
-    for root_dir_str, _, files_in_dir in os.walk(absolute_output_dir):
-        root_dir_path = Path(root_dir_str)
-        for file_name in files_in_dir:
-            full_path = root_dir_path / file_name
-            try:
-                # Make path relative to project_root/outputs for the response
-                # e.g., "text_model_outputs/{job_id}/file.mp4"
-                relative_path_to_outputs_root = full_path.relative_to(outputs_root_for_relative_paths)
-                generated_files.append(str(relative_path_to_outputs_root))
-            except ValueError: # pragma: no cover
-                # Fallback if path is not under outputs_root_for_relative_paths (should not happen with correct setup)
-                # This might happen if absolute_output_dir was outside the expected 'outputs' structure
-                # For robustness, make it relative to the job directory and then prepend a known base.
-                relative_to_job_dir = full_path.relative_to(absolute_output_dir)
-                generated_files.append(str(Path("text_model_outputs") / job_id / relative_to_job_dir))
+        for root_dir_str, _, files_in_dir in os.walk(absolute_output_dir):
+            root_dir_path = Path(root_dir_str)
+            for file_name in files_in_dir:
+                full_path = root_dir_path / file_name
+                try:
+                    # Make path relative to project_root/outputs for the response
+                    # e.g., "text_model_outputs/{job_id}/file.mp4"
+                    relative_path_to_outputs_root = full_path.relative_to(outputs_root_for_relative_paths)
+                    generated_files.append(str(relative_path_to_outputs_root))
+                except ValueError: # pragma: no cover
+                    # Fallback if path is not under outputs_root_for_relative_paths (should not happen with correct setup)
+                    # This might happen if absolute_output_dir was outside the expected 'outputs' structure
+                    # For robustness, make it relative to the job directory and then prepend a known base.
+                    relative_to_job_dir = full_path.relative_to(absolute_output_dir)
+                    generated_files.append(str(Path("text_model_outputs") / job_id / relative_to_job_dir))
             
-    if not generated_files and result.stdout: # Check stdout if no files found, for debugging
-        print(f"Job {job_id} (text) completed but no files found in {absolute_output_dir}. Script stdout: {result.stdout}")
+        # Outputs recorded as render recipes are listed too; they are rendered on their first request
+        generated_files.extend(str(Path("text_model_outputs") / job_id / relative_output)
+                               for relative_output in pending_outputs(absolute_output_dir))
 
-    return {
-        "job_id": job_id,
-        "output_base_directory": f"outputs/text_model_outputs/{job_id}", # Relative to project root
-        "generated_files": generated_files,
-        "stdout": result.stdout # For debugging
-    }
+        if not generated_files and result.stdout: # Check stdout if no files found, for debugging
+            print(f"Job {job_id} (text) completed but no files found in {absolute_output_dir}. Script stdout: {result.stdout}")
+
+        return {
+            "job_id": job_id,
+            "output_base_directory": f"outputs/text_model_outputs/{job_id}", # Relative to project root
+            "generated_files": generated_files,
+            "stdout": result.stdout # For debugging
+        }
+
+    return await run_job(job, execute, respond_async)
 
 @app.post("/transcribe/video/")
-async def transcribe_video_endpoint(request: TranscriptionRequest):
+async def transcribe_video_endpoint(request: TranscriptionRequest, http_request: Request):
+    return await start_transcription_job(request, str(uuid.uuid4()), scheduler_user(http_request), prefers_async(http_request))
+
+async def start_transcription_job(request, job_id, user, respond_async, requeued=False):
     project_root = Path(__file__).resolve().parent.parent
     absolute_video_path = project_root / request.server_video_file_path
 
@@ -342,68 +628,111 @@ async def transcribe_video_endpoint(request: TranscriptionRequest):
         "--output_format", request.output_format,
         "--model_name", request.model_name or "base" # Pass model_name or default
     ]
+    if request.engine:
+        command.extend(["--engine", request.engine])
 
-    try:
-        # Transcription can be lengthy
-        result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=1800) # 30 min timeout
-        
-        output_lines = result.stdout.strip().split('\n')
-        transcript_file_path_str = None
-        # Try to find the path from "Saving transcript to: <path>"
-        for line in reversed(output_lines):
-            if line.startswith("Saving transcript to: "):
-                transcript_file_path_str = line.replace("Saving transcript to: ", "").strip()
-                break
+    job = await admit_job(job_id, "transcribe", request, absolute_video_path, request.model_name, user, requeued)
+
+    async def execute():
+        try:
+            # Transcription can be lengthy
+            async with scheduler.slot(job):
+                result = await run_subprocess(command, timeout=1800, env=job_environment(job_id), job=job) # 30 min timeout
         
-        # Fallback: if not found, assume the script prints only the path as the last non-empty line
-        if not transcript_file_path_str:
+            output_lines = result.stdout.strip().split('\n')
+            transcript_file_path_str = None
+            # Try to find the path from "Saving transcript to: <path>"
             for line in reversed(output_lines):
-                if line.strip(): # Check for non-empty line
-                    potential_path = Path(line.strip())
-                    # A basic check: if it's an absolute path and exists.
-                    # This is still a bit fragile. The script should ideally be more predictable.
-                    if potential_path.is_absolute() and potential_path.exists() and potential_path.is_file():
-                         # Check if it's within the expected output directory structure for safety
-                        if transcript_output_dir in potential_path.parents:
-                            transcript_file_path_str = str(potential_path)
-                            break
-                    # If it's not absolute, try resolving it against project_root (less likely for script output)
-                    elif not potential_path.is_absolute():
-                        resolved_potential_path = project_root / potential_path
-                        if resolved_potential_path.exists() and resolved_potential_path.is_file():
-                            if transcript_output_dir in resolved_potential_path.parents:
-                                transcript_file_path_str = str(resolved_potential_path)
+                if line.startswith("Saving transcript to: "):
+                    transcript_file_path_str = line.replace("Saving transcript to: ", "").strip()
+                    break
+        
+            # Fallback: if not found, assume the script prints only the path as the last non-empty line
+            if not transcript_file_path_str:
+                for line in reversed(output_lines):
+                    if line.strip(): # Check for non-empty line
+                        potential_path = Path(line.strip())
+                        # A basic check: if it's an absolute path and exists.
+                        # This is still a bit fragile. The script should ideally be more predictable.
+                        if potential_path.is_absolute() and potential_path.exists() and potential_path.is_file():
+                             # Check if it's within the expected output directory structure for safety
+                            if transcript_output_dir in potential_path.parents:
+                                transcript_file_path_str = str(potential_path)
                                 break
+                        # If it's not absolute, try resolving it against project_root (less likely for script output)
+                        elif not potential_path.is_absolute():
+                            resolved_potential_path = project_root / potential_path
+                            if resolved_potential_path.exists() and resolved_potential_path.is_file():
+                                if transcript_output_dir in resolved_potential_path.parents:
+                                    transcript_file_path_str = str(resolved_potential_path)
+                                    break
         
-        if not transcript_file_path_str or not Path(transcript_file_path_str).is_file():
-            print(f"Transcription script stdout: {result.stdout}")
-            print(f"Transcription script stderr: {result.stderr}")
-            raise HTTPException(status_code=500, detail="Transcription completed but output path not found or file not created from stdout.")
-
-        # Make path relative to project root for the response
-        relative_transcript_path = Path(transcript_file_path_str).relative_to(project_root)
-
-    except subprocess.CalledProcessError as e:
-        error_detail = f"Transcription script failed. STDERR: {e.stderr}"
-        if e.stdout: error_detail += f" STDOUT: {e.stdout}"
-        raise HTTPException(status_code=500, detail=error_detail)
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=504, detail="Transcription timed out after 30 minutes.")
-    except Exception as e: # Catch any other unexpected errors
-        print(f"An unexpected error occurred during transcription: {str(e)}")
-        print(f"Command: {' '.join(map(str, command))}")
-        raise HTTPException(status_code=500, detail=f"An unexpected error occurred during transcription: {str(e)}")
+            if not transcript_file_path_str or not Path(transcript_file_path_str).is_file():
+                print(f"Transcription script stdout: {result.stdout}")
+                print(f"Transcription script stderr: {result.stderr}")
+                raise HTTPException(status_code=500, detail="Transcription completed but output path not found or file not created from stdout.")
+
+            # Make path relative to project root for the response
+            relative_transcript_path = Path(transcript_file_path_str).relative_to(project_root)
+
+        except subprocess.CalledProcessError as e:
+            error_detail = f"Transcription script failed. STDERR: {e.stderr}"
+            if e.stdout: error_detail += f" STDOUT: {e.stdout}"
+            raise HTTPException(status_code=500, detail=error_detail)
+        except subprocess.TimeoutExpired:
+            raise HTTPException(status_code=504, detail="Transcription timed out after 30 minutes.")
+        except JobCancelled:
+            # DELETE /jobs/{job_id} stopped the script's process tree
+            raise HTTPException(status_code=409, detail=f"Job {job_id} was cancelled.")
+        except Exception as e: # Catch any other unexpected errors
+            print(f"An unexpected error occurred during transcription: {str(e)}")
+            print(f"Command: {' '.join(map(str, command))}")
+            raise HTTPException(status_code=500, detail=f"An unexpected error occurred during transcription: {str(e)}")
     
-    return {
-        "message": "Transcription successful",
-        "transcript_file_path": str(relative_transcript_path),
-        "stdout_preview": result.stdout[:500] # For debugging, preview of stdout
-    }
+        return {
+            "message": "Transcription successful",
+            "transcript_file_path": str(relative_transcript_path),
+            "stdout_preview": result.stdout[:500] # For debugging, preview of stdout
+        }
+
+    return await run_job(job, execute, respond_async)
+
+# Jobs run again from their records (POST /jobs/{job_id}/retry, re-queued jobs) through these starters
+from api.jobs import register_job_starter, resubmit_job
+register_job_starter("motion", MotionRequest, start_motion_job)
+register_job_starter("text", TextProcessRequest, start_text_job)
+register_job_starter("transcribe", TranscriptionRequest, start_transcription_job)
+
+@app.on_event("startup")
+async def requeue_interrupted_jobs():
+    """Jobs that a stopped worker was running or had queued are queued again, in the background."""
+    async def requeue():
+        for record in await run_in_threadpool(claim_interrupted_jobs):
+            # Scripts the stopped worker left running would still write into the job directory
+            await run_in_threadpool(terminate_job_processes, record["job_id"])
+            try:
+                await resubmit_job(record, requeued=True)
+                print(f"Re-queued job {record['job_id']} ({record['pipeline']}, attempt {record['attempts'] + 1}) after a worker restart")
+            except HTTPException as e:
+                await run_in_threadpool(finish_job_record, record["job_id"], "failed", e.detail)
+    task = asyncio.create_task(requeue())
+    requeue_tasks.add(task)
+    task.add_done_callback(requeue_tasks.discard)
+
+@app.on_event("shutdown")
+def mark_worker_shutting_down():
+    global worker_shutting_down
+    worker_shutting_down = True
+
 # API routers
 from api.upload import router as upload_router
+from api.jobs import router as jobs_router
+from api.resumable_uploads import router as resumable_uploads_router
 # from .api import highlights_router # Example for future highlights-specific endpoints
 
 app.include_router(upload_router, prefix="/api")
+app.include_router(jobs_router)
+app.include_router(resumable_uploads_router)
 # app.include_router(highlights_router, prefix="/api")
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+
+from ml_core.cache_utils import CACHE_ROOT, atomic_write_json, file_lock
+from ml_core.media_utils import probe_media
+
+# Admission control. Every job gets a predicted runtime and peak memory before it is queued, from
+# the runtimes and peaks of earlier jobs of the same kind (pipeline, whisper model, resolution class;
+# exponentially smoothed per second of input) or, without history, from the prior factors below.
+# The scheduler forecasts the queue with these predictions: a job whose predicted wait exceeds
+# ADMISSION_MAX_QUEUE_WAIT is rejected with 429 + Retry-After, and a queued job only starts while
+# the predicted memory of the running jobs stays under ADMISSION_MEMORY_LIMIT_MB.
+ADMISSION_MAX_QUEUE_WAIT = float(os.environ.get("ADMISSION_MAX_QUEUE_WAIT", "1800"))
+JOB_HISTORY_PATH = CACHE_ROOT / "job_history.json"
+JOB_HISTORY_SMOOTHING = 0.3  # weight of the newest job in the running averages
+# Assumed duration (seconds) when a source can not be probed
+DEFAULT_SOURCE_DURATION = float(os.environ.get("DEFAULT_SOURCE_DURATION", "600"))
+
+# Priors: seconds of work per second of video (measured on CPU-only hosts; for "render", the on-demand
+# render of one recorded output, per second of output)...
+PIPELINE_COST_FACTORS = {"motion": 0.3, "text": 1.0, "transcribe": 0.6, "render": 0.5}
+# ...scaled by the whisper model size (the text pipeline and /transcribe/video/ default to "base")
+MODEL_COST_FACTORS = {"tiny": 0.5, "base": 1.0, "small": 2.5, "medium": 6.0, "large": 12.0}
+# Peak resident memory: pipeline baseline + whisper model + decoded frames (moviepy/OpenCV buffers)
+PIPELINE_MEMORY_MB = {"motion": 700, "text": 900, "transcribe": 300, "render": 400}
+MODEL_MEMORY_MB = {"tiny": 500, "base": 800, "small": 1800, "medium": 4200, "large": 8500}
+MEMORY_PER_MEGAPIXEL_MB = 600
+
+
+def _default_memory_limit():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024 * 0.8
+    except OSError:
+        pass
+    return 0  # unknown: no memory limit
+
+
+ADMISSION_MEMORY_LIMIT_MB = float(os.environ.get("ADMISSION_MEMORY_LIMIT_MB", str(_default_memory_limit())))
+
+
+def url_metadata(url):
+    """Duration and resolution a URL's extractor reports (metadata request only); missing values are None."""
+    try:
+        import yt_dlp
+        with yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True, "noplaylist": True, "socket_timeout": 15}) as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+        return {"duration": info.get("duration"), "width": info.get("width"), "height": info.get("height")}
+    except Exception as e:
+        logging.info(f"Could not read the metadata of {url}: {e}")
+        return {"duration": None, "width": None, "height": None}
+
+
+def describe_source(source):
+    """{"duration", "width", "height"} of a local file (ffprobe) or a URL. Blocking."""
+    if str(source).startswith(("http://", "https://")):
+        return url_metadata(str(source))
+    info = probe_media(source) or {}
+    return {"duration": info.get("duration"), "width": info.get("width"), "height": info.get("height")}
+
+
+def resolution_class(height):
+    if not height:
+        return "unknown"
+    for name, limit in (("sd", 480), ("hd", 720), ("fhd", 1080)):
+        if height <= limit:
+            return name
+    return "uhd"
+
+
+def history_key(pipeline, model, height):
+    model = (model or "base").split(".")[0] if pipeline not in ("motion", "render") else "-"
+    return f"{pipeline}:{model}:{resolution_class(height)}"
+
+
+def load_job_history():
+    try:
+        with open(JOB_HISTORY_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def predict_job(pipeline, source_info, model=None, history=None):
+    """
+    Predicted {"runtime" (s), "memory_mb", "duration", "key"} of a job on a source described by
+    describe_source. The runtime also orders the queue (shortest job first).
+    """
+    duration = source_info.get("duration") or DEFAULT_SOURCE_DURATION
+    key = history_key(pipeline, model, source_info.get("height"))
+    stats = (history if history is not None else load_job_history()).get(key)
+    model_name = key.split(":")[1]
+    if stats:
+        runtime = duration * stats["seconds_per_second"]
+        memory_mb = stats["peak_memory_mb"]
+    else:
+        runtime = duration * PIPELINE_COST_FACTORS.get(pipeline, 1.0) * MODEL_COST_FACTORS.get(model_name, 1.0)
+        megapixels = (source_info.get("width") or 1280) * (source_info.get("height") or 720) / 1e6
+        memory_mb = (PIPELINE_MEMORY_MB.get(pipeline, 800) + MODEL_MEMORY_MB.get(model_name, 0)
+                     + MEMORY_PER_MEGAPIXEL_MB * megapixels)
+    return {"runtime": runtime, "memory_mb": memory_mb, "duration": duration, "key": key}
+
+
+def record_job(prediction, runtime, peak_memory_mb):
+    """Folds a finished job's measured runtime and peak memory into the history of its kind."""
+    with file_lock(CACHE_ROOT / "job_history.lock"):
+        history = load_job_history()
+        stats = history.get(prediction["key"])
+        observed_rate = runtime / prediction["duration"]
+        if stats is None:
+            stats = {"seconds_per_second": observed_rate, "peak_memory_mb": peak_memory_mb or prediction["memory_mb"],
+                     "jobs": 0}
+        else:
+            stats["seconds_per_second"] += JOB_HISTORY_SMOOTHING * (observed_rate - stats["seconds_per_second"])
+            if peak_memory_mb:
+                stats["peak_memory_mb"] += JOB_HISTORY_SMOOTHING * (peak_memory_mb - stats["peak_memory_mb"])
+        stats["jobs"] += 1
+        history[prediction["key"]] = stats
+        atomic_write_json(JOB_HISTORY_PATH, history)
+
@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import subprocess
+import threading
+
+import cv2
+import librosa
+import numpy as np
+
+from ml_core.cache_utils import CACHE_ROOT, atomic_write_json, file_content_hash, file_lock
+from ml_core.cpu_budget import ffmpeg_threads
+
+# Single-decode analysis pass: video is decoded once at ANALYSIS_WIDTH and audio once at 16 kHz,
+# and every signal the pipelines need is stored as a feature index per content hash.
+ANALYSIS_INDEX_ENABLED = os.environ.get("ANALYSIS_INDEX", "on") != "off"
+ANALYSIS_DIR = CACHE_ROOT / "analysis"
+ANALYSIS_WIDTH = int(os.environ.get("ANALYSIS_WIDTH", "320"))
+
+# Bump whenever a feature is computed differently; old indexes are then rebuilt on first use
+ANALYSIS_INDEX_VERSION = 1
+
+SAMPLE_RATE = 16000  # whisper.audio.SAMPLE_RATE; not imported so the motion model does not load torch/whisper
+
+# The motion model blurs full-resolution frames with a 21x21 kernel; scaled to a 1920 px reference width
+MOTION_BLUR_REFERENCE_WIDTH = 1920
+MOTION_BLUR_KERNEL = 21
+
+# RMS hop of the original librosa peak picking (512 samples at 44.1 kHz), kept in seconds so the
+# peak_pick window sizes below mean the same time spans at 16 kHz
+AUDIO_HOP_LENGTH = int(round(SAMPLE_RATE * 512 / 44100))
+AUDIO_FRAME_LENGTH = 4 * AUDIO_HOP_LENGTH
+
+
+def _video_metadata(video_path):
+    capture = cv2.VideoCapture(str(video_path))
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        capture.release()
+    return fps, width, height
+
+
+def _decode_audio(video_path, output, stdin=None):
+    """
+    Decodes the audio track to 16 kHz mono int16 PCM (the same samples whisper.load_audio produces).
+    With stdin (a pipe fd, see ml_core/ingest.py) the container is read from it instead of video_path.
+    """
+    cmd = ["ffmpeg", "-loglevel", "error", "-threads", ffmpeg_threads(), "-i", "pipe:0" if stdin is not None else str(video_path),
+           "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"]
+    if stdin is None:
+        cmd.insert(1, "-nostdin")
+    try:
+        result = subprocess.run(cmd, stdin=stdin, capture_output=True, check=True)
+        output["pcm"] = np.frombuffer(result.stdout, np.int16).copy()
+    except subprocess.CalledProcessError as e:
+        # No audio stream: keep the index usable for video-only signals
+        logging.warning(f"Audio decode failed for {video_path}: {e.stderr.decode(errors='ignore')[:200]}")
+        output["pcm"] = np.zeros(0, dtype=np.int16)
+
+
+def _analyze_video(video_path, width, height, fps, stdin=None):
+    """
+    Streams frames at analysis resolution from one ffmpeg decode and computes, per frame transition:
+    motion energy (blurred grayscale absdiff, like detect_motion_intervals) and a scene-cut score
+    (mean HSV delta, like scenedetect's ContentDetector). stdin: read the container from a pipe fd.
+    """
+    analysis_width = min(ANALYSIS_WIDTH, width) if width else ANALYSIS_WIDTH
+    analysis_width -= analysis_width % 2
+    analysis_height = int(round(height * analysis_width / width / 2)) * 2 if width else analysis_width * 9 // 16
+    frame_bytes = analysis_width * analysis_height * 3
+    blur = max(3, int(round(MOTION_BLUR_KERNEL * analysis_width / MOTION_BLUR_REFERENCE_WIDTH)) | 1)
+
+    cmd = ["ffmpeg", "-loglevel", "error", "-threads", ffmpeg_threads(), "-i", "pipe:0" if stdin is not None else str(video_path), "-an",
+           "-vf", f"scale={analysis_width}:{analysis_height}", "-fps_mode", "passthrough",
+           "-pix_fmt", "bgr24", "-f", "rawvideo", "-"]
+    if stdin is None:
+        cmd.insert(1, "-nostdin")
+    process = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    motion, cut_scores = [], []
+    prev_gray, prev_hsv = None, None
+    frame_count = 0
+    try:
+        while True:
+            data = process.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                break
+            frame = np.frombuffer(data, np.uint8).reshape(analysis_height, analysis_width, 3)
+            frame_count += 1
+            gray = cv2.GaussianBlur(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (blur, blur), 0)
+            hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV).astype(np.int16)
+            if prev_gray is not None:
+                motion.append(np.sum(cv2.absdiff(prev_gray, gray)) / 255)
+                cut_scores.append(float(np.mean(np.abs(hsv - prev_hsv))))
+            prev_gray, prev_hsv = gray, hsv
+    finally:
+        process.stdout.close()
+        process.wait()
+
+    return {
+        "returncode": process.returncode,
+        "motion": np.asarray(motion, dtype=np.float32),
+        "cut_scores": np.asarray(cut_scores, dtype=np.float32),
+        "frame_count": frame_count,
+        "analysis_size": [analysis_width, analysis_height],
+    }
+
+
+def build_feature_index(video_path, index_dir):
+    """Runs the single-decode analysis pass (video and audio decoded concurrently) and writes the index."""
+    fps, width, height = _video_metadata(video_path)
+    audio_output = {}
+    audio_thread = threading.Thread(target=_decode_audio, args=(video_path, audio_output))
+    audio_thread.start()
+    video_features = _analyze_video(video_path, width, height, fps)
+    audio_thread.join()
+    return write_feature_index(index_dir, video_path, fps, video_features, audio_output["pcm"])
+
+
+def write_feature_index(index_dir, video_path, fps, video_features, pcm):
+    """Derives the audio features from the decoded PCM and stores everything as the index in index_dir."""
+    from ml_core.transcription import VAD_FRAME_SECONDS, energy_vad
+
+    audio = pcm.astype(np.float32) / 32768.0
+    if len(audio):
+        rms = librosa.feature.rms(y=audio, frame_length=AUDIO_FRAME_LENGTH, hop_length=AUDIO_HOP_LENGTH)[0]
+        speech = energy_vad(audio)
+    else:
+        rms, speech = np.zeros(0, dtype=np.float32), np.zeros(0, dtype=bool)
+
+    index_dir.mkdir(parents=True, exist_ok=True)
+    features_path = index_dir / "features.npz"
+    with open(index_dir / ".features.npz.tmp", "wb") as f:
+        np.savez(f, motion=video_features["motion"], cut_scores=video_features["cut_scores"],
+                 rms=rms.astype(np.float32), speech=speech, pcm=pcm)
+    os.replace(index_dir / ".features.npz.tmp", features_path)
+    meta = {
+        "version": ANALYSIS_INDEX_VERSION,
+        "source": str(video_path),
+        "fps": fps,
+        "frame_count": video_features["frame_count"],
+        "duration": video_features["frame_count"] / fps if fps else 0.0,
+        "analysis_size": video_features["analysis_size"],
+        "sample_rate": SAMPLE_RATE,
+        "audio_hop_length": AUDIO_HOP_LENGTH,
+        "vad_frame_seconds": VAD_FRAME_SECONDS,
+    }
+    # index.json is written last: its presence marks a complete index
+    atomic_write_json(index_dir / "index.json", meta)
+    return meta
+
+
+class FeatureIndex:
+    """Read access to a video's stored analysis features. Arrays are loaded lazily."""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(index_dir / "index.json", "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self._arrays = None
+
+    @property
+    def fps(self):
+        return self.meta["fps"]
+
+    @property
+    def duration(self):
+        return self.meta["duration"]
+
+    def array(self, name):
+        if self._arrays is None:
+            self._arrays = np.load(self.index_dir / "features.npz")
+        return self._arrays[name]
+
+    def motion_scores(self):
+        """Motion energy of each frame transition (frame i -> i+1)."""
+        return self.array("motion")
+
+    def scene_cuts(self, threshold=30.0, min_scene_seconds=0.5):
+        """Cut times (seconds) where the HSV delta crosses threshold, at least min_scene_seconds apart."""
+        scores = self.array("cut_scores")
+        min_gap = max(1, int(round(min_scene_seconds * self.fps)))
+        cuts, last_cut = [], -min_gap
+        for transition in np.flatnonzero(scores >= threshold):
+            frame = int(transition) + 1  # the new scene starts at the frame after the transition
+            if frame - last_cut >= min_gap:
+                cuts.append(round(frame / self.fps, 3))
+                last_cut = frame
+        return cuts
+
+    def scenes(self, threshold=30.0, min_scene_seconds=0.5):
+        """Scene list [(start, end), ...] like detect_scenes (empty if there is no cut)."""
+        cuts = self.scene_cuts(threshold, min_scene_seconds)
+        if not cuts:
+            return []
+        boundaries = [0.0] + cuts + [self.duration]
+        return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+    def audio_peaks(self, delta=0.05):
+        """RMS peak times (seconds) with the same peak_pick settings get_audio_peaks used."""
+        rms = self.array("rms")
+        if rms.size == 0:
+            return []
+        peaks = librosa.util.peak_pick(x=rms, pre_max=50, post_max=50, pre_avg=50, post_avg=50, delta=delta, wait=10)
+        return [round(p * AUDIO_HOP_LENGTH / SAMPLE_RATE, 2) for p in peaks]
+
+    def speech_activity(self):
+        """Boolean speech mask, one entry per VAD frame (vad_frame_seconds)."""
+        return self.array("speech")
+
+    def audio(self):
+        """Decoded 16 kHz mono float32 PCM, as whisper.load_audio returns it."""
+        return self.array("pcm").astype(np.float32) / 32768.0
+
+
+def index_dir_for(video_path):
+    return ANALYSIS_DIR / file_content_hash(video_path) / f"v{ANALYSIS_INDEX_VERSION}"
+
+
+def existing_feature_index(video_path):
+    """The feature index of a video if it was already built, otherwise None (never decodes)."""
+    if not ANALYSIS_INDEX_ENABLED:
+        return None
+    try:
+        index_dir = index_dir_for(video_path)
+        if (index_dir / "index.json").exists():
+            return FeatureIndex(index_dir)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def load_feature_index(video_path):
+    """
+    Returns the feature index of a video, running the analysis pass if it does not exist yet.
+    Concurrent callers for the same content wait for one analysis instead of decoding in parallel.
+    """
+    index_dir = index_dir_for(video_path)
+    if (index_dir / "index.json").exists():
+        return FeatureIndex(index_dir)
+    with file_lock(index_dir.parent / ".lock"):
+        if not (index_dir / "index.json").exists():
+            logging.info(f"Building analysis feature index for {video_path}")
+            build_feature_index(video_path, index_dir)
+    return FeatureIndex(index_dir)
@@ -0,0 +1,282 @@
+import argparse
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter, deque
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+import numpy as np
+import torch
+import whisper
+from whisper.audio import HOP_LENGTH, N_FRAMES, N_SAMPLES
+from whisper.timing import add_word_timestamps
+from whisper.tokenizer import get_tokenizer
+
+# Make the shared backend modules (ml_core) importable when this file is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ml_core.cache_utils import CACHE_ROOT
+from ml_core.transcription import DEFAULT_ENGINE, SAMPLE_RATE, load_model
+
+# Batched transcription service. Jobs connect over a unix socket; their audio is cut into 30 s
+# windows, and windows from all concurrent jobs that use the same model are decoded together.
+ASR_SERVICE_ADDRESS = os.environ.get("ASR_SERVICE_ADDRESS", str(CACHE_ROOT / "asr_service.sock"))
+# Shared secret of the socket; the API generates one at startup and passes it to the service and the job scripts
+ASR_SERVICE_AUTHKEY = os.environ.get("ASR_SERVICE_AUTHKEY", "").encode("utf-8")
+ASR_BATCH_SIZE = int(os.environ.get("ASR_BATCH_SIZE", "8"))
+ASR_BATCH_MAX_WAIT = float(os.environ.get("ASR_BATCH_MAX_WAIT_MS", "200")) / 1000  # latency bound for a batch
+
+# Transcript cache decode path of service results: fixed 30 s windows at temperature 0, no seek and no
+# conditioning on the previous text, so they are not interchangeable with whisper.transcribe() results.
+# Bump when _decode_batch changes.
+ASR_SERVICE_DECODER = "service-v1"
+
+TIME_PRECISION = 0.02  # seconds per timestamp token
+NO_SPEECH_THRESHOLD = 0.6  # same silence rule as whisper.transcribe
+LOGPROB_THRESHOLD = -1.0
+
+
+class _Job:
+    def __init__(self, window_count):
+        self.windows = [None] * window_count
+        self.remaining = window_count
+        self.error = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def finish_window(self, index, value=None, error=None):
+        with self.lock:
+            self.windows[index] = value
+            self.error = self.error or error
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.done.set()
+
+
+def split_windows(audio):
+    """Cuts PCM into consecutive 30 s windows, Whisper's fixed encoder input length."""
+    return [(start, audio[start:start + N_SAMPLES]) for start in range(0, max(len(audio), 1), N_SAMPLES)]
+
+
+def parse_timestamp_tokens(tokens, tokenizer, window_duration):
+    """
+    Splits a decoded token sequence into segments at its timestamp tokens
+    (<|t0|> text <|t1|><|t1|> text <|t2|> ...). Times are relative to the window.
+    """
+    segments = []
+    start, text_tokens = None, []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            timestamp = (token - tokenizer.timestamp_begin) * TIME_PRECISION
+            if start is not None and text_tokens:
+                segments.append((start, timestamp, text_tokens))
+                start, text_tokens = None, []
+            else:
+                start = timestamp
+        elif token < tokenizer.eot:
+            text_tokens.append(token)
+    if text_tokens:
+        # Unterminated last segment: it runs to the end of the window
+        segments.append((start or 0.0, window_duration, text_tokens))
+    return [
+        {"start": min(seg_start, window_duration), "end": min(max(seg_end, seg_start), window_duration),
+         "tokens": seg_tokens, "text": tokenizer.decode(seg_tokens)}
+        for seg_start, seg_end, seg_tokens in segments
+    ]
+
+
+class ModelBatcher:
+    """
+    Owns one model and a request queue. A single thread decodes batches of windows, so the model's
+    kv-cache hooks are never shared between concurrent decodes. A batch is closed when it is full or
+    ASR_BATCH_MAX_WAIT after its first window arrived, whichever comes first.
+    """
+
+    def __init__(self, model_name, engine, batch_size=ASR_BATCH_SIZE, max_wait=ASR_BATCH_MAX_WAIT):
+        self.model_name = model_name
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.model = load_model(model_name, engine)
+        self.device = next(self.model.parameters()).device
+        self.thread = threading.Thread(target=self._run, name=f"asr-{model_name}-{engine}", daemon=True)
+        self.thread.start()
+
+    def submit(self, job, index, start_sample, window, options):
+        self.queue.put((job, index, start_sample, window, options))
+
+    def _next_batch(self, pending):
+        if not pending:
+            pending.append(self.queue.get())
+        deadline = time.monotonic() + self.max_wait
+        while len(pending) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        # Decode options (language, task) are per batch; windows with other options wait for the next one
+        first_options = pending[0][4]
+        batch = [item for item in pending if item[4] == first_options][:self.batch_size]
+        for item in batch:
+            pending.remove(item)
+        return batch
+
+    def _run(self):
+        pending = deque()
+        while True:
+            batch = self._next_batch(pending)
+            try:
+                self._decode_batch(batch)
+            except Exception as e:
+                logging.error(f"Batch decode failed ({self.model_name}): {e}")
+                for job, index, *_ in batch:
+                    job.finish_window(index, error=str(e))
+
+    def _decode_batch(self, batch):
+        options = batch[0][4]
+        mels = [whisper.log_mel_spectrogram(whisper.pad_or_trim(window), self.model.dims.n_mels)
+                for _job, _index, _start, window, _options in batch]
+        mel_batch = torch.stack(mels).to(self.device)
+        decode_options = whisper.DecodingOptions(
+            task=options.get("task", "transcribe"), language=options.get("language"),
+            temperature=0.0, fp16=False, without_timestamps=False,
+        )
+        started = time.perf_counter()
+        results = whisper.decode(self.model, mel_batch, decode_options)
+        logging.info(f"Decoded a batch of {len(batch)} windows ({self.model_name}, {self.engine}) in {time.perf_counter() - started:.2f}s")
+
+        for (job, index, start_sample, window, _options), mel, result in zip(batch, mels, results):
+            window_duration = len(window) / SAMPLE_RATE
+            if result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD:
+                job.finish_window(index, {"language": result.language, "segments": []})
+                continue
+
+            tokenizer = get_tokenizer(self.model.is_multilingual, num_languages=self.model.num_languages,
+                                      language=result.language, task=decode_options.task)
+            segments = parse_timestamp_tokens(result.tokens, tokenizer, window_duration)
+            for segment in segments:
+                segment.update({"seek": 0, "temperature": 0.0, "avg_logprob": result.avg_logprob,
+                                "compression_ratio": result.compression_ratio,
+                                "no_speech_prob": result.no_speech_prob})
+            if options.get("word_timestamps") and segments:
+                add_word_timestamps(segments=segments, model=self.model, tokenizer=tokenizer, mel=mel.to(self.device),
+                                    num_frames=min(N_FRAMES, len(window) // HOP_LENGTH), last_speech_timestamp=0.0)
+
+            offset = start_sample / SAMPLE_RATE
+            for segment in segments:
+                segment["start"] += offset
+                segment["end"] += offset
+                segment["seek"] = start_sample // HOP_LENGTH
+                for word in segment.get("words", []):
+                    word["start"] += offset
+                    word["end"] += offset
+            job.finish_window(index, {"language": result.language, "segments": segments})
+
+
+def assemble_result(job):
+    """Concatenates a job's windows (in order) into Whisper's usual result schema."""
+    segments = [segment for window in job.windows for segment in window["segments"]]
+    for index, segment in enumerate(segments):
+        segment["id"] = index
+    languages = Counter(window["language"] for window in job.windows if window["segments"])
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": languages.most_common(1)[0][0] if languages else None,
+    }
+
+
+class TranscriptionService:
+    def __init__(self, address=ASR_SERVICE_ADDRESS, authkey=ASR_SERVICE_AUTHKEY):
+        self.address = address
+        self.authkey = authkey
+        self.batchers = {}
+        self.batchers_lock = threading.Lock()
+
+    def batcher_for(self, model_name, engine):
+        with self.batchers_lock:
+            key = (model_name, engine)
+            if key not in self.batchers:
+                logging.info(f"Starting batch queue for whisper model '{model_name}' ({engine})")
+                self.batchers[key] = ModelBatcher(model_name, engine)
+            return self.batchers[key]
+
+    def transcribe(self, audio, model_name, engine, options):
+        batcher = self.batcher_for(model_name, engine)
+        windows = split_windows(audio)
+        job = _Job(len(windows))
+        decode_options = {"language": options.get("language"), "task": options.get("task", "transcribe"),
+                          "word_timestamps": bool(options.get("word_timestamps"))}
+        for index, (start_sample, window) in enumerate(windows):
+            batcher.submit(job, index, start_sample, window, decode_options)
+        job.done.wait()
+        if job.error:
+            raise RuntimeError(job.error)
+        return assemble_result(job)
+
+    def _handle(self, connection):
+        with connection:
+            try:
+                request = connection.recv()
+                result = self.transcribe(np.asarray(request["audio"], dtype=np.float32), request["model"],
+                                         request.get("engine") or DEFAULT_ENGINE, request.get("options") or {})
+                connection.send({"result": result})
+            except EOFError:
+                return
+            except Exception as e:
+                logging.error(f"Transcription request failed: {e}")
+                try:
+                    connection.send({"error": str(e)})
+                except OSError:
+                    pass
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)  # stale socket from a previous run
+        Path(self.address).parent.mkdir(parents=True, exist_ok=True)
+        with Listener(self.address, family="AF_UNIX", authkey=self.authkey) as listener:
+            logging.info(f"ASR service listening on {self.address} (batch {ASR_BATCH_SIZE}, max wait {ASR_BATCH_MAX_WAIT * 1000:.0f} ms)")
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:  # failed handshake of a single client
+                    logging.warning(f"Rejected ASR service connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+
+def service_available(address=ASR_SERVICE_ADDRESS):
+    return os.environ.get("ASR_SERVICE", "on") != "off" and bool(ASR_SERVICE_AUTHKEY) and os.path.exists(address)
+
+
+def transcribe_via_service(audio, model_name="base", engine=None, address=ASR_SERVICE_ADDRESS, **options):
+    """Sends PCM to the batched transcription service and returns the Whisper-style result."""
+    with Client(address, family="AF_UNIX", authkey=ASR_SERVICE_AUTHKEY) as connection:
+        connection.send({"audio": audio, "model": model_name, "engine": engine, "options": options})
+        response = connection.recv()
+    if "error" in response:
+        raise RuntimeError(f"ASR service error: {response['error']}")
+    return response["result"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Batched Whisper transcription service shared by concurrent jobs.")
+    parser.add_argument("--address", default=ASR_SERVICE_ADDRESS, help="Unix socket path to listen on.")
+    parser.add_argument("--preload", nargs="*", default=[], help="Models to load at startup, e.g. base or base:int8.")
+    args = parser.parse_args()
+    if not ASR_SERVICE_AUTHKEY:
+        parser.error("ASR_SERVICE_AUTHKEY is not set (the API generates it when it starts the service)")
+
+    service = TranscriptionService(args.address)
+    for spec in args.preload:
+        name, _, engine = spec.partition(":")
+        service.batcher_for(name, engine or DEFAULT_ENGINE)
+    service.serve_forever()
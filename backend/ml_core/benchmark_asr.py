@@ -0,0 +1,122 @@
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+# Make the shared backend modules (ml_core) importable when this file is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ml_core.transcription import ENGINES, SAMPLE_RATE, load_audio, load_model, transcribe_options
+
+MEDIA_EXTENSIONS = {".mp4", ".mkv", ".mov", ".webm", ".wav", ".mp3", ".m4a", ".flac"}
+
+
+def normalize_words(text):
+    """Lowercases and strips punctuation so WER only counts real word differences."""
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_error_rate(reference, hypothesis):
+    """WER = (substitutions + deletions + insertions) / reference words, via word-level Levenshtein distance."""
+    ref, hyp = normalize_words(reference), normalize_words(hypothesis)
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i] + [0] * len(hyp)
+        for j, hyp_word in enumerate(hyp, 1):
+            current[j] = min(previous[j] + 1,                            # deletion
+                             current[j - 1] + 1,                         # insertion
+                             previous[j - 1] + (ref_word != hyp_word))   # substitution
+        previous = current
+    return previous[-1] / len(ref)
+
+
+def benchmark(clip_dir, model_name="base", engines=ENGINES, language=None):
+    """
+    Transcribes every clip in clip_dir with each engine and reports the realtime factor
+    (transcription seconds / audio seconds, lower is faster) and the WER of each engine against the
+    fp32 transcript. If a clip has a reference transcript next to it (<clip>.txt), WER against it is
+    reported as well.
+    """
+    clips = sorted(p for p in Path(clip_dir).iterdir() if p.suffix.lower() in MEDIA_EXTENSIONS)
+    if not clips:
+        print(f"No clips found in {clip_dir}")
+        return None
+
+    engines = list(engines)
+    if "fp32" not in engines:
+        engines.insert(0, "fp32")  # fp32 is the WER baseline
+
+    for engine in engines:
+        # Load (and quantize) outside the timed region, the service keeps models warm too
+        load_model(model_name, engine)
+
+    rows = []
+    for clip in clips:
+        audio = load_audio(clip)
+        duration = len(audio) / SAMPLE_RATE
+        reference_path = clip.with_suffix(".txt")
+        reference = reference_path.read_text(encoding="utf-8") if reference_path.exists() else None
+
+        texts = {}
+        for engine in engines:
+            model = load_model(model_name, engine)
+            started = time.perf_counter()
+            result = model.transcribe(audio, **transcribe_options(engine, fp16=False, language=language))
+            elapsed = time.perf_counter() - started
+            texts[engine] = result["text"]
+            rows.append({
+                "clip": clip.name,
+                "engine": engine,
+                "audio_seconds": round(duration, 2),
+                "seconds": round(elapsed, 2),
+                "rtf": round(elapsed / duration, 4) if duration else None,
+                "wer_vs_fp32": None,
+                "wer_vs_reference": round(word_error_rate(reference, result["text"]), 4) if reference else None,
+            })
+        for row in rows[-len(engines):]:
+            row["wer_vs_fp32"] = round(word_error_rate(texts["fp32"], texts[row["engine"]]), 4)
+
+    summary = {}
+    for engine in engines:
+        engine_rows = [row for row in rows if row["engine"] == engine]
+        audio_seconds = sum(row["audio_seconds"] for row in engine_rows)
+        seconds = sum(row["seconds"] for row in engine_rows)
+        summary[engine] = {
+            "rtf": round(seconds / audio_seconds, 4) if audio_seconds else None,
+            "mean_wer_vs_fp32": round(sum(row["wer_vs_fp32"] for row in engine_rows) / len(engine_rows), 4),
+        }
+    return {"model": model_name, "clips": rows, "summary": summary}
+
+
+def print_report(report):
+    print(f"{'clip':40} {'engine':6} {'audio s':>8} {'RTF':>7} {'WER/fp32':>9} {'WER/ref':>8}")
+    for row in report["clips"]:
+        wer_ref = f"{row['wer_vs_reference']:.3f}" if row["wer_vs_reference"] is not None else "-"
+        print(f"{row['clip'][:40]:40} {row['engine']:6} {row['audio_seconds']:8.1f} "
+              f"{row['rtf']:7.3f} {row['wer_vs_fp32']:9.3f} {wer_ref:>8}")
+    print()
+    baseline_rtf = report["summary"]["fp32"]["rtf"]
+    for engine, stats in report["summary"].items():
+        speedup = baseline_rtf / stats["rtf"] if stats["rtf"] else 0.0
+        print(f"{engine}: RTF {stats['rtf']:.3f} ({speedup:.2f}x vs fp32), mean WER vs fp32 {stats['mean_wer_vs_fp32']:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Whisper inference engines (realtime factor and WER vs fp32) on a local clip set.")
+    parser.add_argument("clip_dir", help="Directory with the benchmark clips (optional <clip>.txt reference transcripts).")
+    parser.add_argument("--model_name", default="base", help="Whisper model to benchmark (default: base).")
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES), help="Engines to compare.")
+    parser.add_argument("--language", default=None, help="Force a language instead of auto-detection (keeps runs comparable).")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the full report to this JSON file.")
+    args = parser.parse_args()
+
+    report = benchmark(args.clip_dir, args.model_name, args.engines, args.language)
+    if not report:
+        sys.exit(1)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
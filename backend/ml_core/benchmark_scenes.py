@@ -0,0 +1,91 @@
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+# Make the shared backend modules (ml_core) importable when this file is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ml_core.scenes import SCENE_THRESHOLD, detect_scene_cuts
+
+VIDEO_EXTENSIONS = {".mp4", ".mkv", ".mov", ".webm", ".avi"}
+
+# (label, downscale, frame_skip, workers); the first entry is the full-quality reference
+DEFAULT_CONFIGS = [
+    ("full-res, every frame", 1, 0, 1),
+    ("auto downscale", 0, 0, 1),
+    ("auto downscale, skip 1", 0, 1, 1),
+    ("auto downscale, skip 2", 0, 2, 1),
+    ("auto downscale, skip 1, sharded", 0, 1, None),
+    ("downscale 8, skip 3, sharded", 8, 3, None),
+]
+
+
+def match_cuts(reference, candidate, tolerance):
+    """Greedy one-to-one matching of cut times within tolerance seconds. Returns the number of matches."""
+    matched = 0
+    used = set()
+    for cut in reference:
+        best = None
+        for index, other in enumerate(candidate):
+            if index in used or abs(other - cut) > tolerance:
+                continue
+            if best is None or abs(other - cut) < abs(candidate[best] - cut):
+                best = index
+        if best is not None:
+            used.add(best)
+            matched += 1
+    return matched
+
+
+def benchmark(corpus_dir, configs=DEFAULT_CONFIGS, tolerance=0.5, threshold=SCENE_THRESHOLD):
+    """
+    Runs every detection config on each video of the corpus and reports latency and the recall /
+    precision of its cuts against the reference config (full resolution, every frame, one process).
+    These are the ml_core/scenes.py settings, which only run when ANALYSIS_INDEX=off; by default
+    scenes come from the feature index (FeatureIndex.scenes), which this benchmark does not measure.
+    """
+    videos = sorted(p for p in Path(corpus_dir).iterdir() if p.suffix.lower() in VIDEO_EXTENSIONS)
+    rows = []
+    for video in videos:
+        reference = None
+        for label, downscale, frame_skip, workers in configs:
+            started = time.perf_counter()
+            cuts = detect_scene_cuts(video, threshold, downscale, frame_skip, workers)
+            elapsed = time.perf_counter() - started
+            if reference is None:
+                reference = cuts
+            matched = match_cuts(reference, cuts, tolerance)
+            rows.append({
+                "video": video.name,
+                "config": label,
+                "seconds": round(elapsed, 2),
+                "cuts": len(cuts),
+                "recall": round(matched / len(reference), 3) if reference else 1.0,
+                "precision": round(matched / len(cuts), 3) if cuts else 1.0,
+            })
+    return rows
+
+
+def print_report(rows):
+    print(f"{'video':30} {'config':34} {'seconds':>8} {'cuts':>5} {'recall':>7} {'precision':>9}")
+    for row in rows:
+        print(f"{row['video'][:30]:30} {row['config']:34} {row['seconds']:8.2f} {row['cuts']:5d} "
+              f"{row['recall']:7.3f} {row['precision']:9.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the recall/latency trade-off of scene detection settings on a local corpus.")
+    parser.add_argument("corpus_dir", help="Directory with test videos.")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Max distance in seconds for a cut to match the reference.")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the rows to this JSON file.")
+    args = parser.parse_args()
+
+    rows = benchmark(args.corpus_dir, tolerance=args.tolerance)
+    if not rows:
+        print(f"No videos found in {args.corpus_dir}")
+        sys.exit(1)
+    print_report(rows)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
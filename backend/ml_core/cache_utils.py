@@ -0,0 +1,188 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+# Root directory for all on-disk caches (rendered segments, transcripts, analysis features, ...)
+PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
+CACHE_ROOT = Path(os.environ.get("HIGHLIGHTS_CACHE_DIR", PROJECT_ROOT / "cache"))
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def payload_hash(payload):
+    """Stable sha256 of any JSON-serializable value (dict keys are sorted)."""
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def atomic_write_bytes(path, data):
+    """Writes data to path via a temp file in the same directory and os.replace, so readers never see partial files."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def atomic_write_json(path, payload):
+    atomic_write_bytes(path, json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8"))
+
+
+def atomic_copy(src, dst):
+    """
+    Copies src to dst atomically. Hard links are deliberately not used: ffmpeg -y truncates an
+    existing output in place, which would corrupt every other name of a linked file.
+    """
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{dst.name}.", suffix=".tmp", dir=dst.parent)
+    os.close(fd)
+    try:
+        shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dst)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@contextmanager
+def file_lock(lock_path):
+    """Exclusive advisory lock shared between processes (fcntl.flock on lock_path)."""
+    lock_path = Path(lock_path)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def file_content_hash(path):
+    """
+    sha256 of a file's content. The digest is memoized on disk by (absolute path, size, mtime),
+    so asking again for an unchanged file costs a stat instead of reading the whole video.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    memo_path = _content_hash_memo_path(path)
+    try:
+        with open(memo_path, "r", encoding="utf-8") as f:
+            memo = json.load(f)
+        if memo.get("size") == stat.st_size and memo.get("mtime_ns") == stat.st_mtime_ns:
+            return memo["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+    content_hash = digest.hexdigest()
+    remember_content_hash(path, content_hash)
+    return content_hash
+
+
+def _content_hash_memo_path(path):
+    return CACHE_ROOT / "file_hashes" / f"{hashlib.sha1(str(path).encode('utf-8')).hexdigest()}.json"
+
+
+def remember_content_hash(path, content_hash):
+    """Memoizes a sha256 computed elsewhere (e.g. incrementally while the file was written) for file_content_hash."""
+    path = Path(path).resolve()
+    stat = path.stat()
+    try:
+        atomic_write_json(_content_hash_memo_path(path), {"path": str(path), "size": stat.st_size,
+                                                          "mtime_ns": stat.st_mtime_ns, "sha256": content_hash})
+    except OSError as e:
+        logging.warning(f"Could not memoize content hash for {path}: {e}")
+
+
+class DiskLRUCache:
+    """
+    Size-capped on-disk cache of files, one file per key.
+
+    Entries are written atomically (temp file + rename), so concurrent jobs can share a cache
+    directory. The mtime of an entry is its last use; eviction removes the least recently used
+    entries until the total size is under max_bytes.
+    """
+
+    def __init__(self, root, max_bytes, suffix=""):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, key):
+        # Two-level fan-out keeps directories small
+        return self.root / key[:2] / f"{key}{self.suffix}"
+
+    def get(self, key):
+        """Returns the entry path and marks it as recently used, or None on a miss."""
+        entry_path = self.path_for(key)
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        return entry_path
+
+    def fetch(self, key, output_path):
+        """Copies the entry for key to output_path. Returns True on a hit."""
+        entry_path = self.get(key)
+        if entry_path is None:
+            return False
+        try:
+            atomic_copy(entry_path, output_path)
+        except FileNotFoundError:
+            # Evicted between get() and the copy
+            return False
+        return True
+
+    def put(self, key, src_path):
+        """Stores a copy of src_path under key and evicts old entries if the cache is over its size cap."""
+        entry_path = self.path_for(key)
+        try:
+            atomic_copy(src_path, entry_path)
+        except OSError as e:
+            logging.warning(f"Could not store cache entry {key} in {self.root}: {e}")
+            return None
+        self.evict()
+        return entry_path
+
+    def evict(self):
+        with file_lock(self.root / ".lock"):
+            entries = []
+            total_size = 0
+            for entry_path in self.root.glob(f"*/*{self.suffix}"):
+                if entry_path.name.startswith("."):
+                    continue
+                try:
+                    stat = entry_path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_size += stat.st_size
+
+            if total_size <= self.max_bytes:
+                return
+            for _mtime, size, entry_path in sorted(entries):
+                try:
+                    entry_path.unlink()
+                except FileNotFoundError:
+                    continue
+                total_size -= size
+                if total_size <= self.max_bytes:
+                    break
@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+from ml_core.cache_utils import atomic_write_json, file_content_hash, payload_hash
+
+# Stage checkpoints. Each pipeline stage (download, scenes, peaks, transcription, scoring) stores its
+# result in <job_dir>/checkpoints/<stage>.json with a fingerprint of its inputs: the content hashes
+# of the files it read, its parameters and CHECKPOINT_VERSION. A retried or re-queued job runs again
+# in the same job directory and skips every stage whose fingerprint still matches; a stage whose
+# inputs changed (and everything computed from its result) runs again. Rendered outputs are checked
+# the same way against their recipes when the recipes are recorded (render_recipes._update_recipe_file).
+CHECKPOINTS_ENABLED = os.environ.get("CHECKPOINTS", "on") != "off"
+CHECKPOINTS_DIR_NAME = "checkpoints"
+
+# Bump whenever a stage's result is computed or stored differently; old checkpoints then stop matching
+CHECKPOINT_VERSION = 1
+
+
+def file_fingerprint(path):
+    """Content hash of a stage's input file, None if there is no such file."""
+    try:
+        return file_content_hash(path) if path else None
+    except OSError:
+        return None
+
+
+def stage_fingerprint(stage, inputs):
+    return payload_hash({"version": CHECKPOINT_VERSION, "stage": stage, "inputs": inputs})
+
+
+def _checkpoint_path(job_dir, stage):
+    return Path(job_dir) / CHECKPOINTS_DIR_NAME / f"{stage}.json"
+
+
+def load_checkpoint(job_dir, stage, fingerprint):
+    """The stored result of a stage if it was computed from the same inputs (and its files still exist), else None."""
+    try:
+        with open(_checkpoint_path(job_dir, stage), "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get("fingerprint") != fingerprint:
+        logging.info(f"Stage {stage}: inputs changed since the checkpoint, running it again")
+        return None
+    if not all(os.path.exists(path) for path in checkpoint.get("files", [])):
+        logging.info(f"Stage {stage}: checkpointed files are gone, running it again")
+        return None
+    return checkpoint["result"]
+
+
+def save_checkpoint(job_dir, stage, fingerprint, result, files=()):
+    try:
+        atomic_write_json(_checkpoint_path(job_dir, stage), {"stage": stage, "fingerprint": fingerprint,
+                                                             "files": [str(path) for path in files], "result": result})
+    except (OSError, TypeError, ValueError) as e:
+        logging.warning(f"Could not checkpoint stage {stage} in {job_dir}: {e}")
+
+
+def run_stage(job_dir, stage, inputs, compute, files=None):
+    """
+    Returns the checkpointed result of a stage when its fingerprint (stage name + inputs, a
+    JSON-serializable dict) matches, otherwise compute() and checkpoints it. files(result) lists the
+    files a result refers to, which must still exist for the checkpoint to count. None results (a
+    failed stage) are not checkpointed; without a job_dir the stage just runs.
+    """
+    if not CHECKPOINTS_ENABLED or job_dir is None:
+        return compute()
+    fingerprint = stage_fingerprint(stage, inputs)
+    result = load_checkpoint(job_dir, stage, fingerprint)
+    if result is not None:
+        logging.info(f"Stage {stage}: skipped, checkpoint matches its inputs")
+        return result
+    result = compute()
+    if result is not None:
+        save_checkpoint(job_dir, stage, fingerprint, result, files(result) if files else ())
+    return result
@@ -0,0 +1,126 @@
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from ml_core.cpu_budget import thread_allotment
+
+# Parallel encode of one long timeline in GOP-aligned chunks. The motion pipeline uses it only when the
+# rendered-segment cache is off: by default its reels are assembled from per-segment renders
+# (motion_processor.save_timeline_from_segments), which already encode segments in parallel. The x264
+# settings below are shared by all reel encodes either way.
+
+# Encoder settings shared by the single-process and the chunked path, so that a chunked output
+# has the same profile/level/pix_fmt and GOP structure as a regular one.
+GOP_SECONDS = 2.0
+X264_COMPAT_PARAMS = ["-profile:v", "high", "-level", "4.2", "-pix_fmt", "yuv420p"]
+
+
+def x264_gop_params(fps, gop_seconds=GOP_SECONDS):
+    """Fixed-length closed GOPs without scene-cut keyframes, so chunk boundaries always land on an IDR frame."""
+    gop = max(1, int(round(fps * gop_seconds)))
+    return ["-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0", "-flags", "+cgop"]
+
+
+def x264_output_params(fps, gop_seconds=GOP_SECONDS):
+    """All extra x264 parameters used for reel encodes (pass as moviepy's ffmpeg_params)."""
+    return X264_COMPAT_PARAMS + x264_gop_params(fps, gop_seconds)
+
+
+def plan_gop_aligned_chunks(duration, fps, num_chunks, gop_seconds=GOP_SECONDS):
+    """
+    Splits a timeline of `duration` seconds into at most `num_chunks` pieces whose boundaries are
+    multiples of the GOP length. Returns a list of (start_frame, end_frame) tuples (end exclusive).
+    """
+    total_frames = int(math.floor(duration * fps + 1e-6))
+    if total_frames <= 0:
+        return []
+    gop = max(1, int(round(fps * gop_seconds)))
+    total_gops = math.ceil(total_frames / gop)
+    gops_per_chunk = max(1, math.ceil(total_gops / max(1, num_chunks)))
+
+    chunks = []
+    start_frame = 0
+    while start_frame < total_frames:
+        end_frame = min(total_frames, start_frame + gops_per_chunk * gop)
+        chunks.append((start_frame, end_frame))
+        start_frame = end_frame
+    return chunks
+
+
+def concat_chunks(chunk_paths, audio_path, output_path):
+    """Joins encoded video chunks with the concat demuxer (stream copy) and muxes the audio track in."""
+    list_fd, list_path = tempfile.mkstemp(suffix=".txt", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        with os.fdopen(list_fd, "w") as f_concat:
+            for chunk_path in chunk_paths:
+                f_concat.write(f"file '{os.path.abspath(chunk_path)}'\n")
+
+        ffmpeg_cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error",
+                      "-f", "concat", "-safe", "0", "-i", list_path]
+        if audio_path:
+            ffmpeg_cmd.extend(["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"])
+        ffmpeg_cmd.extend(["-c", "copy", "-movflags", "+faststart", "-y", str(output_path)])
+        subprocess.run(ffmpeg_cmd, capture_output=True, text=True, check=True)
+    finally:
+        if os.path.exists(list_path):
+            os.remove(list_path)
+
+
+def encode_chunked(render_chunk, render_audio, render_args, duration, fps, output_path,
+                   workers=None, gop_seconds=GOP_SECONDS):
+    """
+    Encodes a timeline in parallel GOP-aligned chunks and joins them with concat stream copy.
+
+    render_chunk(*render_args, start_time, end_time, chunk_path, threads) must encode the video
+    of [start_time, end_time) without audio, using x264_output_params(fps, gop_seconds).
+    render_audio(*render_args, audio_path) must write the whole audio track (aac), or return None
+    if the timeline has no audio. Both are called in worker processes, so they have to be
+    module-level functions and render_args must be picklable.
+
+    Returns output_path on success, otherwise None.
+    """
+    workers = workers or thread_allotment()
+    chunks = plan_gop_aligned_chunks(duration, fps, workers, gop_seconds)
+    if not chunks:
+        logging.warning(f"Nothing to encode for {output_path} (duration {duration:.2f}s).")
+        return None
+
+    # Split the job's threads between the chunk encoders instead of letting every x264 spawn a thread per core
+    threads_per_chunk = max(1, thread_allotment() // len(chunks))
+    work_dir = tempfile.mkdtemp(prefix="chunks_", dir=os.path.dirname(os.path.abspath(output_path)))
+    logging.info(f"Encoding {output_path} in {len(chunks)} chunks with {workers} workers ({threads_per_chunk} threads each).")
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks) + 1)) as executor:
+            audio_path = os.path.join(work_dir, "audio.m4a")
+            audio_future = executor.submit(render_audio, *render_args, audio_path)
+
+            chunk_futures = []
+            for index, (start_frame, end_frame) in enumerate(chunks):
+                chunk_path = os.path.join(work_dir, f"chunk_{index:04d}.mp4")
+                # End half a frame early so the frame grid of every chunk matches the single-pass grid exactly
+                start_time = start_frame / fps
+                end_time = (end_frame - 0.5) / fps
+                chunk_futures.append((chunk_path, executor.submit(
+                    render_chunk, *render_args, start_time, end_time, chunk_path, threads_per_chunk
+                )))
+
+            chunk_paths = []
+            for chunk_path, future in chunk_futures:
+                future.result()
+                chunk_paths.append(chunk_path)
+            audio_result = audio_future.result()
+
+        concat_chunks(chunk_paths, audio_path if audio_result else None, output_path)
+        return str(output_path)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Joining chunks for {output_path} failed: {e.stderr}")
+        return None
+    except Exception as e:
+        logging.error(f"Chunked encode of {output_path} failed: {e}")
+        return None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+from ml_core.cache_utils import CACHE_ROOT, atomic_write_json
+
+# Process-wide CPU thread budget. Without it every library sizes its pool for the whole machine
+# (torch, OpenCV, BLAS, x264), and a few concurrent jobs oversubscribe the host many times over.
+# The API process splits CPU_THREAD_BUDGET evenly between the jobs the scheduler is running and
+# writes each job's share to CPU_BUDGET_DIR/<job_id>.json whenever a job starts or finishes. The job
+# scripts read their share at every stage (thread_allotment) and size torch, OpenCV, BLAS, process
+# pools and ffmpeg/x264 -threads from it, so a running job grows or shrinks with the load. Steps of
+# one job that run concurrently (ml_core/pipeline_graph.py) split the job's share between them.
+CPU_THREAD_BUDGET = int(os.environ.get("CPU_THREAD_BUDGET", str(os.cpu_count() or 1)))
+CPU_BUDGET_DIR = CACHE_ROOT / "cpu_budget"
+# Set in a job's environment: the job id whose share the scripts follow, or a fixed thread count
+CPU_BUDGET_JOB_ENV = "CPU_BUDGET_JOB"
+CPU_THREADS_ENV = "CPU_THREADS"
+# Read by the BLAS / OpenMP runtimes when they load, so they are set when a job is started
+BLAS_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                        "VECLIB_MAXIMUM_THREADS")
+
+# API process: job_id -> current share
+_allotments = {}
+
+# Job script: pipeline steps running concurrently (ml_core/pipeline_graph.py) split the job's share
+_concurrent_steps = 0
+_concurrent_steps_lock = threading.Lock()
+
+
+def rebalance(job_ids):
+    """Splits the budget between the running jobs and publishes the new shares."""
+    job_ids = list(job_ids)
+    share, remainder = divmod(CPU_THREAD_BUDGET, max(1, len(job_ids)))
+    new_allotments = {job_id: max(1, share + (1 if index < remainder else 0)) for index, job_id in enumerate(job_ids)}
+    for job_id in set(_allotments) - set(new_allotments):
+        try:
+            (CPU_BUDGET_DIR / f"{job_id}.json").unlink()
+        except OSError:
+            pass
+    for job_id, threads in new_allotments.items():
+        if _allotments.get(job_id) != threads:
+            atomic_write_json(CPU_BUDGET_DIR / f"{job_id}.json", {"threads": threads})
+    _allotments.clear()
+    _allotments.update(new_allotments)
+    if job_ids:
+        logging.info(f"CPU budget {CPU_THREAD_BUDGET} threads: {share}+ per job for {len(job_ids)} running jobs")
+    return dict(_allotments)
+
+
+def job_environment(job_id=None):
+    """
+    Environment for a job script. A job the scheduler runs (pipelines and on-demand renders) follows
+    its published share; other work gets a fixed fair share of the current load.
+    """
+    env = dict(os.environ)
+    if job_id in _allotments:
+        threads = _allotments[job_id]
+        env[CPU_BUDGET_JOB_ENV] = job_id
+    else:
+        threads = max(1, CPU_THREAD_BUDGET // (len(_allotments) + 1))
+    # Also what background renders a job leaves behind use once its share is withdrawn
+    env[CPU_THREADS_ENV] = str(threads)
+    for name in BLAS_THREAD_ENV_VARS:
+        env[name] = str(threads)
+    return env
+
+
+def job_thread_allotment():
+    """Threads this job may use right now (the whole budget when the script runs on its own)."""
+    job_id = os.environ.get(CPU_BUDGET_JOB_ENV)
+    if job_id:
+        try:
+            with open(CPU_BUDGET_DIR / f"{job_id}.json", "r", encoding="utf-8") as f:
+                return max(1, int(json.load(f)["threads"]))
+        except (OSError, ValueError, KeyError):
+            pass
+    if os.environ.get(CPU_THREADS_ENV):
+        return max(1, int(os.environ[CPU_THREADS_ENV]))
+    return CPU_THREAD_BUDGET
+
+
+def thread_allotment():
+    """Threads the calling pipeline step may use right now: the job's share, split between its concurrent steps."""
+    return max(1, job_thread_allotment() // max(1, _concurrent_steps))
+
+
+@contextmanager
+def concurrent_step():
+    """Counts a pipeline step that runs alongside others of the same job while the block runs."""
+    global _concurrent_steps
+    with _concurrent_steps_lock:
+        _concurrent_steps += 1
+    try:
+        yield
+    finally:
+        with _concurrent_steps_lock:
+            _concurrent_steps -= 1
+
+
+def apply_thread_allotment():
+    """Sizes the thread pools of the libraries this process has loaded to the current share."""
+    threads = thread_allotment()
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    if "cv2" in sys.modules:
+        sys.modules["cv2"].setNumThreads(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+    return threads
+
+
+def ffmpeg_threads():
+    """Value for ffmpeg's -threads option (decoder, filters and x264) and moviepy's threads argument."""
+    return str(thread_allotment())
@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+import yt_dlp
+from yt_dlp.utils import download_range_func
+
+from ml_core.cache_utils import CACHE_ROOT, DiskLRUCache, atomic_write_json, file_lock, payload_hash
+from ml_core.cpu_budget import ffmpeg_threads
+from ml_core.media_utils import probe_media
+
+# URL downloads are cached by (extractor, canonical video id, selected format), so the same video is
+# downloaded once however its URL is spelled, and the motion and text pipelines share one download.
+# Concurrent requests for the same entry (across processes) wait for a single in-flight download.
+DOWNLOAD_CACHE_ENABLED = os.environ.get("DOWNLOAD_CACHE", "on") != "off"
+DOWNLOAD_CACHE_DIR = CACHE_ROOT / "downloads"
+DOWNLOAD_CACHE_MAX_BYTES = int(float(os.environ.get("DOWNLOAD_CACHE_MAX_GB", "20")) * 1024 ** 3)
+DOWNLOAD_LOCK_DIR = CACHE_ROOT / "download_locks"
+
+# Download profiles: a URL job only downloads what its analysis needs. The text pipeline starts from
+# the audio stream (transcription, audio peaks) and the motion pipeline from a low-resolution stream
+# (muxed, so previews keep their sound); the full-quality stream is only fetched when an output is
+# rendered (see fetch_full_source).
+ANALYSIS_DOWNLOAD_HEIGHT = int(os.environ.get("ANALYSIS_DOWNLOAD_HEIGHT", "360"))
+DOWNLOAD_PROFILES = {
+    "full": "best[ext=mp4]/best",
+    "audio": "bestaudio[ext=m4a]/bestaudio/worst[ext=mp4]/worst",
+    "analysis": f"best[height<={ANALYSIS_DOWNLOAD_HEIGHT}][ext=mp4]/best[height<={ANALYSIS_DOWNLOAD_HEIGHT}]/worst[ext=mp4]/worst",
+}
+
+# Renders of URL jobs fetch only the time ranges they read from the full-quality stream (yt-dlp
+# download_ranges; ffmpeg copies each range from the keyframe before it, keeping the source
+# timestamps so the part maps exactly onto the source timeline). Every range is padded by
+# RANGE_FETCH_PADDING seconds so cuts never land on the edge of a partial file. Fetched ranges are
+# kept in the sources dir and reused by any later render whose range they contain, so the bytes a
+# job downloads scale with its highlights, not with the length of the video.
+RANGE_FETCH_ENABLED = os.environ.get("RANGE_FETCH", "on") != "off"
+RANGE_FETCH_PADDING = float(os.environ.get("RANGE_FETCH_PADDING", "2.0"))
+# Outputs built from several ranges (reels) read one file: the ranges joined by a single encode at this quality
+RANGE_ASSEMBLY_CRF = int(os.environ.get("RANGE_ASSEMBLY_CRF", "14"))
+
+
+def download_cache_key(info):
+    """Key of a resolved yt-dlp info dict: extractor, canonical id and the format yt-dlp selected."""
+    return payload_hash({
+        "extractor": info.get("extractor_key") or info.get("extractor"),
+        "id": info.get("id"),
+        "format_id": info.get("format_id"),
+    })
+
+
+def _downloaded_path(ydl, info):
+    requested = info.get("requested_downloads") or [{}]
+    return requested[0].get("filepath") or ydl.prepare_filename(info)
+
+
+def download_with_cache(url, output_dir, format_selector, ydl_opts=None, filename="downloaded_video"):
+    """
+    Downloads url with yt-dlp into output_dir/<filename>.<ext> (served from the cache when possible).
+    ydl_opts: extra yt-dlp options (quiet, noplaylist, ...). Returns (path, info dict).
+    Raises yt_dlp's DownloadError like a plain download would.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    options = {**(ydl_opts or {}), "format": format_selector}
+    if not DOWNLOAD_CACHE_ENABLED:
+        options["outtmpl"] = os.path.join(output_dir, f"{filename}.%(ext)s")
+        with yt_dlp.YoutubeDL(options) as ydl:
+            info = ydl.extract_info(url, download=True)
+            return _downloaded_path(ydl, info), info
+
+    DOWNLOAD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".staging_", dir=DOWNLOAD_CACHE_DIR)
+    try:
+        options["outtmpl"] = os.path.join(staging_dir, "%(id)s.%(ext)s")
+        with yt_dlp.YoutubeDL(options) as ydl:
+            # Resolving the id and format needs only the metadata request, not the download
+            info = ydl.extract_info(url, download=False)
+            key = download_cache_key(info)
+            cache = DiskLRUCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_MAX_BYTES, suffix=".video")
+            output_path = os.path.join(output_dir, f"{filename}.{info.get('ext') or 'mp4'}")
+
+            if cache.fetch(key, output_path):
+                logging.info(f"Download cache hit for {info.get('extractor_key')}:{info.get('id')} ({info.get('format_id')})")
+                return output_path, info
+            with file_lock(DOWNLOAD_LOCK_DIR / f"{key}.lock"):
+                # Another job may have finished the same download while we waited
+                if cache.fetch(key, output_path):
+                    logging.info(f"Download of {info.get('id')} was completed by a concurrent request")
+                    return output_path, info
+                logging.info(f"Downloading {info.get('extractor_key')}:{info.get('id')} (format {info.get('format_id')})")
+                info = ydl.process_ie_result(info, download=True)
+                downloaded_path = _downloaded_path(ydl, info)
+                cache.put(key, downloaded_path)
+            shutil.move(downloaded_path, output_path)
+            return output_path, info
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def download_profile(url, output_dir, profile, ydl_opts=None, filename="downloaded_video"):
+    """download_with_cache with the format selector of a DOWNLOAD_PROFILES entry. Returns (path, info dict)."""
+    return download_with_cache(url, output_dir, DOWNLOAD_PROFILES[profile], ydl_opts, filename=filename)
+
+
+def _source_key(url):
+    return payload_hash({"url": url, "format": DOWNLOAD_PROFILES["full"]})
+
+
+def fetch_full_source(url, sources_dir):
+    """
+    Full-quality source of a URL job for rendering, kept as sources_dir/url_<hash>.<ext>. Only the
+    first render that needs it downloads it; concurrent renders wait for that download.
+    """
+    sources_dir = Path(sources_dir)
+    name = f"url_{_source_key(url)}"
+    with file_lock(DOWNLOAD_LOCK_DIR / f"{name}.lock"):
+        existing = sorted(sources_dir.glob(f"{name}.*"))
+        if existing:
+            return str(existing[0])
+        sources_dir.mkdir(parents=True, exist_ok=True)
+        # Downloaded next to its final name and renamed, so a source that exists is complete
+        staging_dir = tempfile.mkdtemp(prefix=".fetching_", dir=sources_dir)
+        try:
+            logging.info(f"Fetching the full-quality source of {url} for rendering")
+            path, _info = download_profile(url, staging_dir, "full", {"quiet": True, "noplaylist": True}, filename=name)
+            source_path = sources_dir / Path(path).name
+            os.replace(path, source_path)
+            return str(source_path)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _cached_ranges(sources_dir, key):
+    """(start, end, path) of the ranges of a source that were fetched before (names carry milliseconds)."""
+    cached = []
+    for path in sources_dir.glob(f"range_{key}_*"):
+        try:
+            start_ms, end_ms = path.stem.split("_")[-2:]
+            cached.append((int(start_ms) / 1000, int(end_ms) / 1000, path))
+        except ValueError:
+            continue
+    return cached
+
+
+def _containing_part(parts, start, end):
+    """The first (part start, part end, path) that holds the whole range, None if there is none."""
+    return next((part for part in parts if part[0] <= start and part[1] >= end), None)
+
+
+def _download_ranges(url, ranges, sources_dir, key):
+    """Fetches padded (start, end) ranges with yt-dlp; returns [(start, end, path), ...] (milliseconds, as cached)."""
+    staging_dir = tempfile.mkdtemp(prefix=".fetching_", dir=sources_dir)
+    try:
+        options = {
+            "quiet": True, "noplaylist": True, "format": DOWNLOAD_PROFILES["full"],
+            "outtmpl": os.path.join(staging_dir, "%(section_start)s-%(section_end)s.%(ext)s"),
+            "download_ranges": download_range_func(None, ranges),
+            # Re-encoding at the cut points would cost a full encode; the padding keeps cuts away from them
+            "force_keyframes_at_cuts": False,
+            # Keep the source timestamps, so the time a part starts at (a keyframe) can be probed
+            "external_downloader_args": {"ffmpeg_o": ["-copyts"]},
+        }
+        with yt_dlp.YoutubeDL(options) as ydl:
+            info = ydl.extract_info(url, download=True)
+        fetched = []
+        for requested in info.get("requested_downloads") or []:
+            start_ms, end_ms = round(float(requested["section_start"]) * 1000), round(float(requested["section_end"]) * 1000)
+            path = sources_dir / f"range_{key}_{start_ms}_{end_ms}{Path(requested['filepath']).suffix}"
+            os.replace(requested["filepath"], path)
+            fetched.append((start_ms / 1000, end_ms / 1000, path))
+        return fetched
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def fetch_source_ranges(url, ranges, sources_dir):
+    """
+    Full-quality (start, end) ranges of a URL's stream for rendering. Returns one (part start, part end,
+    path) per range: path holds at least the source from part start to part end (the padded range).
+    """
+    sources_dir = Path(sources_dir)
+    sources_dir.mkdir(parents=True, exist_ok=True)
+    key = _source_key(url)
+    # A source that was fetched whole already holds every range
+    full_source = sorted(sources_dir.glob(f"url_{key}.*"))
+    if full_source:
+        return [(0.0, float("inf"), full_source[0])] * len(ranges)
+    padded = [(round(max(0.0, start - RANGE_FETCH_PADDING), 3), round(end + RANGE_FETCH_PADDING, 3)) for start, end in ranges]
+    with file_lock(DOWNLOAD_LOCK_DIR / f"range_{key}.lock"):
+        cached = _cached_ranges(sources_dir, key)
+        parts = [_containing_part(cached, start, end) for start, end in padded]
+        missing = sorted({padded[i] for i, part in enumerate(parts) if part is None})
+        if missing:
+            logging.info(f"Fetching {len(missing)} of {len(padded)} ranges ({sum(end - start for start, end in missing):.1f}s) of {url}")
+            fetched = _download_ranges(url, missing, sources_dir, key)
+            # Matched by containment: padded ranges near the start of the video can share a start (0.0)
+            parts = [part or _containing_part(fetched, *padded[i]) for i, part in enumerate(parts)]
+            if None in parts:
+                raise RuntimeError(f"yt-dlp did not return every requested range of {url}")
+    return parts
+
+
+def _probe_part(path):
+    info = probe_media(path)
+    if not info or not info["duration"]:
+        raise RuntimeError(f"Could not probe fetched range {path}")
+    return info
+
+
+def assemble_ranges(paths, infos, output_path):
+    """Joins fetched parts into output_path with one encode. Returns the time each part starts at in the joined file."""
+    has_audio = all(info["has_audio"] for info in infos)
+    filters, labels = [], ""
+    for i, info in enumerate(infos):
+        # Every stream is cut to the span of the video (audio usually starts a little earlier), so
+        # each part begins with its first video frame and audio and video of later parts stay in sync
+        lead = info["video_start_time"] - info["start_time"]
+        span = f"start={lead:.6f}:end={lead + info['duration']:.6f}"
+        filters.append(f"[{i}:v:0]trim={span},setpts=PTS-STARTPTS[v{i}]")
+        labels += f"[v{i}]"
+        if has_audio:
+            filters.append(f"[{i}:a:0]atrim={span},asetpts=PTS-STARTPTS[a{i}]")
+            labels += f"[a{i}]"
+    filters.append(f"{labels}concat=n={len(paths)}:v=1:a={int(has_audio)}[v]" + ("[a]" if has_audio else ""))
+
+    ffmpeg_cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin"]
+    for path in paths:
+        ffmpeg_cmd.extend(["-i", str(path)])
+    ffmpeg_cmd.extend(["-filter_complex", ";".join(filters), "-map", "[v]"])
+    if has_audio:
+        ffmpeg_cmd.extend(["-map", "[a]", "-c:a", "aac", "-b:a", "192k"])
+    ffmpeg_cmd.extend(["-c:v", "libx264", "-preset", "veryfast", "-crf", str(RANGE_ASSEMBLY_CRF),
+                       "-pix_fmt", "yuv420p", "-threads", ffmpeg_threads(), "-movflags", "+faststart", "-y", str(output_path)])
+    subprocess.run(ffmpeg_cmd, check=True, capture_output=True)
+
+    offsets, position = [], 0.0
+    for info in infos:
+        offsets.append(position)
+        position += info["duration"]
+    return offsets
+
+
+def range_source(url, ranges, sources_dir):
+    """
+    The file a render of the given (start, end) source ranges reads, and for each range the
+    (source time, file time) pair that maps it: a single fetched part, or the parts joined.
+    """
+    parts = fetch_source_ranges(url, ranges, sources_dir)
+    paths = sorted({path for _start, _end, path in parts})
+    infos = {path: _probe_part(path) for path in paths}
+    if len(paths) == 1:
+        # Parts keep the source timestamps: file time 0 is the source time the part starts at
+        return str(paths[0]), [(infos[paths[0]]["start_time"], 0.0)] * len(parts)
+
+    # Reels list the same ranges for every orientation: their joined file is kept and shared
+    assembled = Path(sources_dir) / f"ranges_{payload_hash([url, [path.name for path in paths]])}.mp4"
+    offsets_path = assembled.with_suffix(".json")
+    with file_lock(DOWNLOAD_LOCK_DIR / f"{assembled.stem}.lock"):
+        if assembled.exists() and offsets_path.exists():
+            offsets = json.loads(offsets_path.read_text())
+        else:
+            logging.info(f"Joining {len(paths)} fetched ranges of {url}")
+            temp_path = assembled.with_name(f".joining-{assembled.name}")
+            try:
+                offsets = assemble_ranges(paths, [infos[path] for path in paths], temp_path)
+                atomic_write_json(offsets_path, offsets)
+                os.replace(temp_path, assembled)
+            finally:
+                temp_path.unlink(missing_ok=True)
+    offset_of = dict(zip(paths, offsets))
+    # In the joined file every part starts with its first video frame
+    return str(assembled), [(infos[path]["video_start_time"], offset_of[path]) for _start, _end, path in parts]
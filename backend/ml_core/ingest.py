@@ -0,0 +1,261 @@
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from pathlib import Path
+
+from ml_core.analysis import (
+    ANALYSIS_DIR, ANALYSIS_INDEX_ENABLED, ANALYSIS_INDEX_VERSION, _analyze_video, _decode_audio, _video_metadata,
+    build_feature_index, load_feature_index, write_feature_index
+)
+from ml_core.cache_utils import file_lock, remember_content_hash
+
+# Streaming ingest: the upload body is written to disk in chunks while it is hashed (sha256, the
+# content cache key) and, at the same time, piped into the analysis decoders (motion/scene-cut scoring
+# and audio peaks). By the time the upload completes, the feature index of the video usually exists.
+INGEST_CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", str(1024 * 1024)))
+# Containers that are not ISO BMFF (mkv, webm, flv, ...) are piped once this much has arrived,
+# which is enough for the decoder metadata (fps, frame size) to be read from the partial file
+INGEST_PROBE_BYTES = int(os.environ.get("INGEST_PROBE_BYTES", str(1024 * 1024)))
+
+ISO_BMFF_FIRST_BOXES = (b"ftyp", b"styp")
+
+
+class Mp4BoxSniffer:
+    """
+    Follows the top-level boxes of an MP4/MOV as bytes arrive (without buffering their payload) to
+    tell whether the file can be decoded from a pipe: the moov atom must precede the first mdat
+    (faststart or fragmented files). Otherwise the index is at the end and decoding has to wait for it.
+    """
+
+    def __init__(self):
+        self.offset = 0               # bytes seen so far
+        self.next_box = 0             # offset of the next top-level box header
+        self.header = b""             # header bytes received so far, starting at next_box
+        self.is_iso_bmff = None       # None until the first box header was read
+        self.moov_end = None          # offset right after the moov box, once its header was seen
+        self.mdat_before_moov = False
+        self.fragmented = False
+        self.open_ended = False       # a box with size 0 extends to the end of the file
+
+    def feed(self, data):
+        position = 0
+        while position < len(data) and not self.open_ended and self.is_iso_bmff is not False:
+            absolute = self.offset + position
+            if absolute < self.next_box:
+                # Inside a box payload: skip it
+                position += min(self.next_box - absolute, len(data) - position)
+                continue
+            # Up to 16 header bytes: 32-bit size, type and the 64-bit size used when size == 1
+            taken = min(16 - len(self.header), len(data) - position)
+            self.header += data[position:position + taken]
+            position += taken
+            if len(self.header) < 8:
+                continue
+            size, box_type = struct.unpack(">I4s", self.header[:8])
+            header_length = 8
+            if size == 1:
+                if len(self.header) < 16:
+                    continue
+                size, header_length = struct.unpack(">Q", self.header[8:16])[0], 16
+            box_start = self.next_box
+            self._on_box(box_type, box_start, size)
+            if size == 0:
+                self.open_ended = True
+            elif size < header_length:
+                self.is_iso_bmff = False  # corrupt, or not an MP4 after all
+            else:
+                self.next_box = box_start + size
+                # Header bytes read past a small box already belong to the next box's header
+                overshoot = box_start + len(self.header) - self.next_box
+                self.header = self.header[-overshoot:] if overshoot > 0 else b""
+        self.offset += len(data)
+
+    def _on_box(self, box_type, box_start, size):
+        if self.is_iso_bmff is None:
+            self.is_iso_bmff = box_type in ISO_BMFF_FIRST_BOXES
+            if not self.is_iso_bmff:
+                return
+        if box_type == b"moov" and self.moov_end is None and size:
+            self.moov_end = box_start + size
+        elif box_type == b"mdat" and self.moov_end is None:
+            self.mdat_before_moov = True
+        elif box_type == b"moof":
+            self.fragmented = True
+
+    @property
+    def moov_available(self):
+        return self.moov_end is not None and self.offset >= self.moov_end
+
+    @property
+    def streamable(self):
+        """True/False once known (moov before any mdat), None while it is still undecided."""
+        if self.is_iso_bmff is False:
+            return None
+        if self.moov_end is not None and not self.mdat_before_moov:
+            return True
+        if self.mdat_before_moov:
+            return False
+        return None
+
+
+class StreamingIngest:
+    """
+    Receives an upload chunk by chunk (write() is blocking; call it from a worker thread). The file is
+    hashed as it is written and the analysis pass is started as early as the container allows:
+    piped alongside the upload for streamable files, from the partial file right after the moov atom
+    for MP4s with the index at the end, and after the upload for anything that could not be piped.
+    """
+
+    def __init__(self, save_path):
+        self.save_path = Path(save_path)
+        self.file = open(self.save_path, "wb")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.sniffer = Mp4BoxSniffer()
+        self.mode = None            # "pipe", "file" or "after_upload", once analysis was planned
+        self.pipes = {}             # {"video"/"audio": write fd} while piping
+        self.threads = []
+        self.results = {}
+        self.temp_index_dir = None
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        self.sniffer.feed(chunk)
+        if self.mode is None and ANALYSIS_INDEX_ENABLED:
+            self._maybe_start_analysis()
+        elif self.mode == "pipe":
+            self._feed_pipes(chunk)
+
+    def _maybe_start_analysis(self):
+        streamable = self.sniffer.streamable
+        if self.sniffer.is_iso_bmff:
+            if streamable and self.sniffer.moov_available:
+                self._start_pipe_analysis()
+            elif streamable is False and self.sniffer.moov_available:
+                self._start_file_analysis()
+        elif self.sniffer.is_iso_bmff is False and self.size >= INGEST_PROBE_BYTES:
+            self._start_pipe_analysis()
+
+    def _start_pipe_analysis(self):
+        self.file.flush()
+        # Decoder metadata (fps, frame size) is read from the header that is already on disk
+        fps, width, height = _video_metadata(self.save_path)
+        if not width or not height:
+            logging.info(f"Can not read stream metadata of {self.save_path.name} yet; analysing after the upload.")
+            self.mode = "after_upload"
+            return
+        self.mode = "pipe"
+        self.results["fps"] = fps
+        video_read, self.pipes["video"] = os.pipe()
+        audio_read, self.pipes["audio"] = os.pipe()
+
+        def run_video():
+            try:
+                self.results["video"] = _analyze_video(self.save_path, width, height, fps, stdin=video_read)
+            finally:
+                os.close(video_read)
+
+        def run_audio():
+            try:
+                _decode_audio(self.save_path, self.results, stdin=audio_read)
+            finally:
+                os.close(audio_read)
+
+        self.threads = [threading.Thread(target=run_video, daemon=True), threading.Thread(target=run_audio, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        logging.info(f"Analysing {self.save_path.name} while it is uploaded "
+                     f"({'fragmented' if self.sniffer.fragmented else 'streamable'} container)")
+        # Everything received before the decision is replayed from disk
+        with open(self.save_path, "rb") as head:
+            for block in iter(lambda: head.read(INGEST_CHUNK_SIZE), b""):
+                self._feed_pipes(block)
+
+    def _feed_pipes(self, data):
+        for name, fd in list(self.pipes.items()):
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            except OSError:
+                # The decoder stopped (no audio stream, unreadable input); the upload itself goes on
+                os.close(self.pipes.pop(name))
+
+    def _close_pipes(self):
+        for fd in self.pipes.values():
+            os.close(fd)
+        self.pipes = {}
+
+    def _start_file_analysis(self):
+        # moov sits after the media data: every sample is already on disk once it has arrived
+        self.file.flush()
+        self.mode = "file"
+        ANALYSIS_DIR.mkdir(parents=True, exist_ok=True)
+        self.temp_index_dir = Path(tempfile.mkdtemp(prefix="ingest_", dir=ANALYSIS_DIR))
+
+        def run():
+            try:
+                build_feature_index(self.save_path, self.temp_index_dir)
+                self.results["file_index"] = True
+            except Exception as e:
+                logging.error(f"Analysis of {self.save_path.name} during upload failed: {e}")
+
+        self.threads = [threading.Thread(target=run, daemon=True)]
+        self.threads[0].start()
+        logging.info(f"Analysing {self.save_path.name} from disk once its moov atom arrived")
+
+    def finish(self):
+        """
+        Completes the upload: closes the file, memoizes its sha256 for the content cache and, once the
+        running analysis has drained, stores its result as the video's feature index.
+        Returns (sha256, analysis state).
+        """
+        self.file.close()
+        content_hash = self.digest.hexdigest()
+        remember_content_hash(self.save_path, content_hash)
+        self._close_pipes()
+        for thread in self.threads:
+            thread.join()
+
+        index_dir = ANALYSIS_DIR / content_hash / f"v{ANALYSIS_INDEX_VERSION}"
+        if (index_dir / "index.json").exists():
+            self._discard_temp_index()
+            return content_hash, "cached"
+        if self.mode == "pipe":
+            video = self.results.get("video")
+            if video and video["returncode"] == 0 and video["frame_count"] > 0:
+                with file_lock(index_dir.parent / ".lock"):
+                    if not (index_dir / "index.json").exists():
+                        write_feature_index(index_dir, self.save_path, self.results["fps"], video, self.results["pcm"])
+                return content_hash, "streamed"
+            logging.warning(f"Piped analysis of {self.save_path.name} failed; analysing the uploaded file instead.")
+        elif self.mode == "file" and self.results.get("file_index"):
+            with file_lock(index_dir.parent / ".lock"):
+                if not (index_dir / "index.json").exists():
+                    index_dir.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(self.temp_index_dir, index_dir)
+            self._discard_temp_index()
+            return content_hash, "analysed_after_moov"
+        self._discard_temp_index()
+        if not ANALYSIS_INDEX_ENABLED:
+            return content_hash, "disabled"
+        load_feature_index(self.save_path)
+        return content_hash, "analysed_after_upload"
+
+    def abort(self):
+        self.file.close()
+        self._close_pipes()
+        for thread in self.threads:
+            thread.join()
+        self._discard_temp_index()
+        self.save_path.unlink(missing_ok=True)
+
+    def _discard_temp_index(self):
+        if self.temp_index_dir is not None and self.temp_index_dir.exists():
+            shutil.rmtree(self.temp_index_dir, ignore_errors=True)
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import time
+import uuid
+
+from ml_core.cache_utils import CACHE_ROOT, PROJECT_ROOT, atomic_write_json, file_lock
+from ml_core.process_tree import process_start_time
+
+# Every processing job writes into outputs/<pipeline>_outputs/<job_id>/ (served under /static/outputs)
+OUTPUTS_DIR = PROJECT_ROOT / "outputs"
+PIPELINE_OUTPUT_DIRS = {
+    "text": OUTPUTS_DIR / "text_model_outputs",
+    "motion": OUTPUTS_DIR / "motion_model_outputs",
+}
+
+
+def is_valid_job_id(job_id):
+    """Job ids are uuid4 strings; anything else is rejected before it can become a path."""
+    try:
+        return str(uuid.UUID(job_id)) == job_id
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+
+def find_job_dir(job_id):
+    """Returns (pipeline, output directory) of a job, or (None, None) if there is no such job."""
+    if not is_valid_job_id(job_id):
+        return None, None
+    for pipeline, base_dir in PIPELINE_OUTPUT_DIRS.items():
+        job_dir = base_dir / job_id
+        if job_dir.is_dir():
+            return pipeline, job_dir
+    return None, None
+
+
+# Durable job records: the request of every admitted job, so a failed job can be retried and the jobs
+# of a worker that stopped (crash, deploy) are re-queued when a worker starts. Retried and re-queued
+# jobs keep their job_id, and with it their output directory and stage checkpoints.
+JOB_RECORDS_DIR = CACHE_ROOT / "jobs"
+# A job is re-queued at most this many times in a row (a job that crashes its worker must not loop)
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+
+def worker_identity():
+    """pid and start time of this process; tells a dead worker from a new one that reused its pid."""
+    return f"{os.getpid()}:{process_start_time(os.getpid())}"
+
+
+def _worker_alive(identity):
+    pid, _, start_time = (identity or "").partition(":")
+    return pid.isdigit() and str(process_start_time(int(pid))) == start_time
+
+
+def _record_path(job_id):
+    return JOB_RECORDS_DIR / f"{job_id}.json"
+
+
+def load_job_record(job_id):
+    if not is_valid_job_id(job_id):
+        return None
+    try:
+        with open(_record_path(job_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_job_record(job_id, pipeline, request, user, requeued=False):
+    """
+    Records an admitted job as active in this worker. request: the endpoint's request body as JSON
+    data; requeued: the job is queued again after its worker stopped (counts towards JOB_MAX_ATTEMPTS).
+    """
+    with file_lock(JOB_RECORDS_DIR / ".lock"):
+        attempts = (load_job_record(job_id) or {}).get("attempts", 0) + 1 if requeued else 1
+        atomic_write_json(_record_path(job_id), {
+            "job_id": job_id, "pipeline": pipeline, "request": request, "user": user, "state": "active",
+            "attempts": attempts, "worker": worker_identity(), "updated": time.time(),
+        })
+
+
+def finish_job_record(job_id, state, error=None):
+    """Succeeded and cancelled jobs need no record; failed ones keep theirs for POST /jobs/{job_id}/retry."""
+    with file_lock(JOB_RECORDS_DIR / ".lock"):
+        if state != "failed":
+            _record_path(job_id).unlink(missing_ok=True)
+            return
+        record = load_job_record(job_id)
+        if record is not None:
+            record.update(state="failed", error=error, updated=time.time())
+            atomic_write_json(_record_path(job_id), record)
+
+
+def claim_interrupted_jobs():
+    """
+    Takes over the active jobs of workers that no longer run and returns their records, to be queued
+    again by this worker. Jobs that already used JOB_MAX_ATTEMPTS attempts are marked failed instead.
+    """
+    claimed = []
+    with file_lock(JOB_RECORDS_DIR / ".lock"):
+        for path in sorted(JOB_RECORDS_DIR.glob("*.json")):
+            record = load_job_record(path.stem)
+            if record is None or record["state"] != "active" or _worker_alive(record.get("worker")):
+                continue
+            if record["attempts"] >= JOB_MAX_ATTEMPTS:
+                logging.warning(f"Job {record['job_id']} was interrupted {record['attempts']} times, not re-queuing it")
+                record.update(state="failed", error=f"Interrupted {record['attempts']} times by worker restarts.")
+            else:
+                record["worker"] = worker_identity()
+                claimed.append(record)
+            record["updated"] = time.time()
+            atomic_write_json(path, record)
+    return claimed
@@ -0,0 +1,177 @@
+import json
+import logging
+import subprocess
+
+from ml_core.cpu_budget import ffmpeg_threads
+
+
+def probe_media(path):
+    """
+    Returns basic stream information for a media file using ffprobe:
+    duration (seconds), start time (of the file and of its video stream), width, height, fps and
+    whether an audio stream exists.
+    Returns None if the file cannot be probed.
+    """
+    probe_cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration,start_time:stream=codec_type,width,height,avg_frame_rate,duration,start_time",
+        "-of", "json", str(path)
+    ]
+    try:
+        result = subprocess.run(probe_cmd, capture_output=True, text=True, check=True)
+        info = json.loads(result.stdout)
+    except (subprocess.CalledProcessError, ValueError, FileNotFoundError) as e:
+        logging.error(f"ffprobe failed for {path}: {e}")
+        return None
+
+    streams = info.get("streams", [])
+    video_stream = next((s for s in streams if s.get("codec_type") == "video"), None)
+    has_audio = any(s.get("codec_type") == "audio" for s in streams)
+
+    duration = None
+    # Prefer the video stream duration: the container duration can include a trailing audio tail,
+    # which would make transition offsets land after the last video frame.
+    for candidate in (video_stream or {}).get("duration"), info.get("format", {}).get("duration"):
+        try:
+            duration = float(candidate)
+            break
+        except (TypeError, ValueError):
+            continue
+
+    fps = None
+    if video_stream and video_stream.get("avg_frame_rate", "0/0") != "0/0":
+        num, _, den = video_stream["avg_frame_rate"].partition("/")
+        try:
+            fps = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            fps = None
+
+    try:
+        start_time = float(info.get("format", {}).get("start_time", 0.0))
+    except (TypeError, ValueError):
+        start_time = 0.0
+    try:
+        video_start_time = float((video_stream or {}).get("start_time", start_time))
+    except (TypeError, ValueError):
+        video_start_time = start_time
+
+    return {
+        "duration": duration,
+        "start_time": start_time,
+        "video_start_time": video_start_time,
+        "width": video_stream.get("width") if video_stream else None,
+        "height": video_stream.get("height") if video_stream else None,
+        "fps": fps,
+        "has_audio": has_audio,
+    }
+
+
+def build_xfade_filter_graph(clip_infos, transition_duration, width, height, fps):
+    """
+    Builds a single ffmpeg filter graph that normalizes every input and chains them with
+    xfade (video) and acrossfade (audio). Inputs without audio get a silent track of the same length.
+
+    Returns (filter_graph, video_label, audio_label, total_duration).
+    """
+    filters = []
+    for i, info in enumerate(clip_infos):
+        # xfade requires identical size, frame rate, pixel format and timebase on both sides
+        filters.append(
+            f"[{i}:v]setpts=PTS-STARTPTS,scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p[v{i}]"
+        )
+        if info["has_audio"]:
+            filters.append(
+                # Padded/trimmed to the video duration the offsets are built from: audio that is a little
+                # longer or shorter (AAC priming, cut padding) would otherwise drift further with every clip
+                f"[{i}:a]aformat=sample_rates=44100:channel_layouts=stereo,asetpts=PTS-STARTPTS,"
+                f"apad,atrim=duration={info['duration']:.3f}[a{i}]"
+            )
+        else:
+            filters.append(
+                f"anullsrc=r=44100:cl=stereo,atrim=duration={info['duration']:.3f}[a{i}]"
+            )
+
+    if len(clip_infos) > 1 and transition_duration <= 0:
+        # No overlap requested: a plain concat keeps everything in the same single encode
+        concat_inputs = "".join(f"[v{i}][a{i}]" for i in range(len(clip_infos)))
+        filters.append(f"{concat_inputs}concat=n={len(clip_infos)}:v=1:a=1[vout][aout]")
+        total_duration = sum(info["duration"] for info in clip_infos)
+        return ";".join(filters), "[vout]", "[aout]", total_duration
+
+    video_label, audio_label = "[v0]", "[a0]"
+    total_duration = clip_infos[0]["duration"]
+    for i in range(1, len(clip_infos)):
+        offset = total_duration - transition_duration
+        filters.append(
+            f"{video_label}[v{i}]xfade=transition=fade:duration={transition_duration:.3f}:offset={offset:.3f}[vx{i}]"
+        )
+        filters.append(f"{audio_label}[a{i}]acrossfade=d={transition_duration:.3f}[ax{i}]")
+        video_label, audio_label = f"[vx{i}]", f"[ax{i}]"
+        total_duration += clip_infos[i]["duration"] - transition_duration
+
+    return ";".join(filters), video_label, audio_label, total_duration
+
+
+def merge_clips_with_xfade(clip_paths, output_file, transition_duration=0.1, preset="fast", crf=23):
+    """
+    Merges clips with crossfade transitions in a single ffmpeg encode.
+
+    The output is written directly in the web-compatible format (h264, yuv420p, even dimensions,
+    aac, faststart), so no second transcode is needed. Frames are streamed through the filter graph,
+    so memory use does not grow with the number of clips.
+
+    Returns the output path on success, otherwise None.
+    """
+    if not clip_paths:
+        logging.warning("No clips provided for xfade merge.")
+        return None
+
+    clip_infos = []
+    for path in clip_paths:
+        info = probe_media(path)
+        if not info or not info["duration"] or not info["width"] or not info["height"]:
+            logging.error(f"Could not probe clip {path} for merging.")
+            return None
+        clip_infos.append(info)
+
+    # A transition can not be longer than half of the shortest clip, otherwise offsets overlap
+    max_transition = min(info["duration"] for info in clip_infos) / 2
+    if transition_duration > max_transition:
+        logging.warning(f"Transition {transition_duration:.2f}s is too long for the shortest clip, using {max_transition:.2f}s.")
+        transition_duration = max_transition
+
+    # Use the first clip's geometry (rounded up to even dimensions) as the output canvas
+    width = clip_infos[0]["width"] + clip_infos[0]["width"] % 2
+    height = clip_infos[0]["height"] + clip_infos[0]["height"] % 2
+    fps = round(clip_infos[0]["fps"] or 24, 3)
+
+    filter_graph, video_label, audio_label, total_duration = build_xfade_filter_graph(
+        clip_infos, transition_duration, width, height, fps
+    )
+
+    ffmpeg_cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    for path in clip_paths:
+        ffmpeg_cmd.extend(["-i", str(path)])
+    ffmpeg_cmd.extend([
+        "-filter_complex", filter_graph,
+        "-map", video_label, "-map", audio_label,
+        "-c:v", "libx264", "-preset", preset, "-crf", str(crf),
+        "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k",
+        "-threads", ffmpeg_threads(),
+        "-movflags", "+faststart",
+        "-y", str(output_file)
+    ])
+
+    logging.info(f"Merging {len(clip_paths)} clips with xfade into {output_file} (expected duration {total_duration:.2f}s)")
+    try:
+        subprocess.run(ffmpeg_cmd, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"ffmpeg xfade merge failed: {e.stderr}")
+        return None
+    except FileNotFoundError:
+        logging.error("ffmpeg not found, can not merge clips with xfade.")
+        return None
+
+    return str(output_file)
@@ -0,0 +1,102 @@
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from ml_core.checkpoints import CHECKPOINTS_ENABLED, load_checkpoint, save_checkpoint, stage_fingerprint
+from ml_core.cpu_budget import concurrent_step, job_thread_allotment
+
+# Pipeline steps as a dependency graph. Every step declares the artifacts it reads (the outputs of
+# other steps) and its parameters; a step starts as soon as its inputs exist, so independent steps
+# (scene detection, audio peaks, transcription) run concurrently, at most PIPELINE_PARALLEL_STEPS at
+# a time and never more than the job has CPU threads (concurrent steps split the job's thread share).
+# A step's fingerprint covers its name, parameters and the fingerprints of its inputs, so changing a
+# parameter only invalidates that step and the steps downstream of it: all other steps are served
+# from their checkpoints in the job directory (ml_core/checkpoints.py).
+PIPELINE_PARALLEL_STEPS = int(os.environ.get("PIPELINE_PARALLEL_STEPS", "3"))
+
+
+class PipelineGraph:
+    """
+    Steps of one job. add_step() declares a step, run() executes the steps needed for its targets
+    and returns {step name: output}.
+    """
+
+    def __init__(self, job_dir=None, max_parallel=None):
+        self.job_dir = job_dir
+        self.max_parallel = max_parallel
+        self.steps = {}
+        self._outputs = {}
+
+    def add_step(self, name, func, inputs=(), params=None, checkpoint=True, fingerprint=None, files=None):
+        """
+        func(*outputs of inputs) computes the step's output. params: JSON-serializable settings the
+        output depends on. checkpoint: store the (JSON-serializable) output in the job directory.
+        fingerprint(output): content fingerprint of the output (e.g. a source file's hash) used instead
+        of the step's own, so everything downstream is reused when an unchanged file arrives again.
+        files(output): files a checkpointed output refers to, which must still exist to reuse it.
+        """
+        missing = [input_name for input_name in inputs if input_name not in self.steps]
+        if missing:
+            raise ValueError(f"Step {name} reads {', '.join(missing)}, which no earlier step produces")
+        self.steps[name] = {"func": func, "inputs": list(inputs), "params": params or {}, "checkpoint": checkpoint,
+                            "fingerprint": fingerprint, "files": files}
+
+    def output(self, name):
+        """
+        Future of a step's output, resolved as soon as run() has it. A running step can poll it to use
+        another step's output once it is there without declaring it as an input (and so without
+        waiting for it to start); it fails if the step does not finish in this run.
+        """
+        return self._outputs.setdefault(name, Future())
+
+    def _needed(self, targets):
+        needed, frontier = set(), list(targets)
+        while frontier:
+            name = frontier.pop()
+            if name not in needed:
+                needed.add(name)
+                frontier.extend(self.steps[name]["inputs"])
+        return needed
+
+    def _run_step(self, name, inputs, input_fingerprints):
+        step = self.steps[name]
+        fingerprint = stage_fingerprint(name, {"params": step["params"], "inputs": input_fingerprints})
+        checkpointed = step["checkpoint"] and self.job_dir is not None and CHECKPOINTS_ENABLED
+        output = load_checkpoint(self.job_dir, name, fingerprint) if checkpointed else None
+        if output is not None:
+            logging.info(f"Step {name}: skipped, checkpoint matches its inputs")
+        else:
+            with concurrent_step():
+                output = step["func"](*inputs)
+            if checkpointed and output is not None:
+                save_checkpoint(self.job_dir, name, fingerprint, output, step["files"](output) if step["files"] else ())
+        if step["fingerprint"] is not None:
+            fingerprint = step["fingerprint"](output)
+        return output, fingerprint
+
+    def run(self, targets=None):
+        """Runs every step the targets (default: all steps) need, independent steps concurrently."""
+        remaining = self._needed(targets or self.steps)
+        outputs, fingerprints, running = {}, {}, {}
+        max_parallel = max(1, min(self.max_parallel or PIPELINE_PARALLEL_STEPS, job_thread_allotment()))
+        pool = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="pipeline-step")
+        try:
+            while remaining or running:
+                for name in sorted(remaining):
+                    inputs = self.steps[name]["inputs"]
+                    if all(input_name in outputs for input_name in inputs):
+                        remaining.discard(name)
+                        running[pool.submit(self._run_step, name, [outputs[i] for i in inputs],
+                                            {i: fingerprints[i] for i in inputs})] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # A failed step fails the pipeline; steps that did not start yet are dropped
+                    outputs[name], fingerprints[name] = future.result()
+                    self.output(name).set_result(outputs[name])
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            for name, published in list(self._outputs.items()):
+                if not published.done():
+                    published.set_exception(RuntimeError(f"Step {name} did not finish"))
+        return outputs
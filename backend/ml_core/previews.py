@@ -0,0 +1,105 @@
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from ml_core.cpu_budget import ffmpeg_threads
+
+# Fast preview tier: every selected highlight first gets a small, quickly encoded preview (no burned-in
+# subtitles; they are published as a WebVTT sidecar instead), so a job has something viewable within
+# seconds of selection. Full-quality renders follow at lower priority (see ml_core/render_recipes.py).
+PREVIEWS_ENABLED = os.environ.get("PREVIEWS", "on") != "off"
+PREVIEW_HEIGHT = int(os.environ.get("PREVIEW_HEIGHT", "360"))
+PREVIEW_PRESET = os.environ.get("PREVIEW_PRESET", "ultrafast")
+PREVIEW_CRF = int(os.environ.get("PREVIEW_CRF", "30"))
+PREVIEW_DIR = "previews"
+PREVIEW_KINDS = ("preview", "subtitles_vtt")
+
+
+def preview_dimensions(aspect, height=PREVIEW_HEIGHT):
+    """(width, height) of a preview with the given (w, h) aspect ratio; both even for x264."""
+    width = int(round(height * aspect[0] / aspect[1] / 2)) * 2
+    return max(2, width), height - height % 2
+
+
+def preview_recipes(name, source, segments, aspect, full_outputs, subs=None):
+    """
+    Recipes for previews/<name>.mp4 (and previews/<name>.vtt if there are subtitles).
+    segments: [(start, end), ...] of the source, played back to back.
+    full_outputs: the full-quality outputs this preview stands for (rejecting the preview cancels them).
+    """
+    video_path = f"{PREVIEW_DIR}/{name}.mp4"
+    recipes = {video_path: {
+        "kind": "preview", "source": source, "segments": [[float(start), float(end)] for start, end in segments],
+        "aspect": list(aspect), "full_outputs": list(full_outputs),
+    }}
+    if subs:
+        subtitles_path = f"{PREVIEW_DIR}/{name}.vtt"
+        recipes[video_path]["subtitles"] = subtitles_path
+        recipes[subtitles_path] = {"kind": "subtitles_vtt", "subs": subs}
+    return recipes
+
+
+def format_vtt_timestamp(seconds):
+    milliseconds = int(round(max(0.0, seconds) * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    secs, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}.{milliseconds:03d}"
+
+
+def render_vtt_recipe(recipe, output_path, job_dir):
+    """Writes the subtitles (times relative to the clip start) as a WebVTT file."""
+    lines = ["WEBVTT", ""]
+    for cue in recipe["subs"]:
+        if cue["end"] <= 0:
+            continue
+        lines.append(f"{format_vtt_timestamp(cue['start'])} --> {format_vtt_timestamp(cue['end'])}")
+        lines.append(str(cue["text"]).strip())
+        lines.append("")
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def _encode_preview_segment(source, start, end, width, height, output_path):
+    # Input seeking (-ss before -i) is frame accurate here because the segment is re-encoded
+    ffmpeg_cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+                  "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", str(source),
+                  "-map", "0:v:0", "-map", "0:a:0?",
+                  "-vf", f"scale={width}:{height}:force_original_aspect_ratio=increase,crop={width}:{height},setsar=1",
+                  "-c:v", "libx264", "-preset", PREVIEW_PRESET, "-crf", str(PREVIEW_CRF), "-pix_fmt", "yuv420p",
+                  "-c:a", "aac", "-b:a", "64k", "-ac", "2", "-threads", ffmpeg_threads(),
+                  "-movflags", "+faststart", "-y", str(output_path)]
+    subprocess.run(ffmpeg_cmd, capture_output=True, text=True, check=True)
+
+
+def render_preview_recipe(recipe, output_path, job_dir):
+    """Cover-crops the segments to the preview size and encodes them with the fast preview settings."""
+    width, height = preview_dimensions(recipe["aspect"])
+    segments = [(start, end) for start, end in recipe["segments"] if end > start]
+    if not segments:
+        logging.warning(f"Preview {output_path} has no segments, skipping it.")
+        return
+    try:
+        if len(segments) == 1:
+            _encode_preview_segment(recipe["source"], *segments[0], width, height, output_path)
+            return
+
+        # Several segments (motion reels): encode each one, then join them with the concat demuxer (stream copy)
+        temp_dir = tempfile.mkdtemp(prefix="preview_", dir=os.path.dirname(os.path.abspath(output_path)))
+        try:
+            list_path = os.path.join(temp_dir, "segments.txt")
+            with open(list_path, "w") as f_concat:
+                for index, (start, end) in enumerate(segments):
+                    segment_path = os.path.join(temp_dir, f"segment_{index:04d}.mp4")
+                    _encode_preview_segment(recipe["source"], start, end, width, height, segment_path)
+                    f_concat.write(f"file '{segment_path}'\n")
+            subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+                            "-f", "concat", "-safe", "0", "-i", list_path,
+                            "-c", "copy", "-movflags", "+faststart", "-y", str(output_path)],
+                           capture_output=True, text=True, check=True)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Preview encode of {output_path} failed: {e.stderr}")
@@ -0,0 +1,111 @@
+import os
+import signal
+import time
+
+# Seconds a terminated process tree gets to exit (and remove its temp files) before SIGKILL
+PROCESS_KILL_GRACE = float(os.environ.get("PROCESS_KILL_GRACE", "5"))
+
+
+def _process_table():
+    """{pid: (parent pid, resident pages)} of every process, from /proc."""
+    table = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is in parentheses and may contain spaces; the fields after it are fixed
+        fields = stat[stat.rindex(")") + 2:].split()
+        table[int(entry)] = (int(fields[1]), int(fields[21]))
+    return table
+
+
+def process_tree(pid, table=None):
+    """pid and all of its living descendants, including those that started their own session."""
+    table = table if table is not None else _process_table()
+    children = {}
+    for child, (parent, _rss) in table.items():
+        children.setdefault(parent, []).append(child)
+    tree, frontier = set(), [pid]
+    while frontier:
+        current = frontier.pop()
+        if current in tree or current not in table:
+            continue
+        tree.add(current)
+        frontier.extend(children.get(current, []))
+    return tree
+
+
+def process_tree_memory_mb(pid):
+    """Resident memory of a process and all of its descendants (whisper workers, ffmpeg, ...)."""
+    table = _process_table()
+    return sum(table[p][1] for p in process_tree(pid, table)) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def _signal_tree(pid, pids, signum):
+    # The process group catches descendants that were already reparented; the pids catch the ones
+    # in other sessions (e.g. the detached background renderer)
+    try:
+        os.killpg(pid, signum)
+    except OSError:
+        pass
+    for member in pids:
+        try:
+            os.kill(member, signum)
+        except OSError:
+            pass
+
+
+def terminate_process_tree(pid, grace=PROCESS_KILL_GRACE):
+    """
+    Stops a job started with start_new_session=True (pid is its process group) and everything it
+    started: SIGTERM first, so scripts can clean up, then SIGKILL after `grace` seconds. Blocking.
+    """
+    pids = process_tree(pid)
+    _signal_tree(pid, pids, signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline:
+        if not any(os.path.exists(f"/proc/{member}") and not _is_zombie(member) for member in pids):
+            return
+        time.sleep(0.1)
+    # Children started during the grace period are killed too
+    _signal_tree(pid, pids | process_tree(pid), signal.SIGKILL)
+
+
+def process_start_time(pid):
+    """Start time of a process (clock ticks since boot), None if there is no such process. With the pid
+    it identifies a process across pid reuse, e.g. a restarted API worker that got its old pid again."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+        return int(stat[stat.rindex(")") + 2:].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def processes_with_env(name, value):
+    """Pids of the processes whose environment has name=value (those of other users are not visible)."""
+    needle = f"{name}={value}".encode("utf-8")
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/environ", "rb") as f:
+                if needle in f.read().split(b"\0"):
+                    pids.append(int(entry))
+        except OSError:
+            continue
+    return pids
+
+
+def _is_zombie(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+        return stat[stat.rindex(")") + 2] == "Z"
+    except OSError:
+        return True
@@ -0,0 +1,364 @@
+import argparse
+import fnmatch
+import hashlib
+import importlib
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+# Make the shared backend modules (ml_core) importable when this file is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ml_core.cache_utils import CACHE_ROOT, atomic_copy, atomic_write_json, file_content_hash, file_lock, payload_hash
+from ml_core.cpu_budget import apply_thread_allotment
+from ml_core.previews import PREVIEW_KINDS, PREVIEWS_ENABLED
+
+# Lazy rendering: pipelines finish after analysis and selection, recording every output file as a
+# render recipe in the job directory. A file is rendered the first time it is requested under
+# /static/outputs; only outputs matching EAGER_RENDER_OUTPUTS are rendered when the job finishes,
+# after the fast previews of ml_core/previews.py and at lower priority than them.
+LAZY_RENDER_ENABLED = os.environ.get("LAZY_RENDER", "on") != "off"
+DEFAULT_EAGER_RENDER_OUTPUTS = "youtube/youtube_clip_1.mp4,instagram/instagram_clip_1.mp4,merged_highlights_short_portrait.mp4"
+EAGER_RENDER_OUTPUTS = [pattern.strip() for pattern in
+                        os.environ.get("EAGER_RENDER_OUTPUTS", DEFAULT_EAGER_RENDER_OUTPUTS).split(",") if pattern.strip()]
+RENDER_TIMEOUT = int(os.environ.get("LAZY_RENDER_TIMEOUT", "1800"))
+# Full-quality renders started when a job finishes run after its previews, in a background process at
+# this niceness, so previews and analysis of other jobs are not slowed down by them
+FULL_RENDER_NICENESS = int(os.environ.get("FULL_RENDER_NICENESS", "10"))
+
+RECIPES_FILE = "render_recipes.json"
+RENDER_LOCK_DIR = CACHE_ROOT / "render_locks"
+# Downloaded sources are kept here (by content hash) so outputs can still be rendered after the job's temp dir is gone
+SOURCES_DIR = CACHE_ROOT / "sources"
+
+# Recipe kind -> "module:function" that renders it; resolved on first use so that reading recipes
+# (e.g. in the API process) never imports moviepy or the pipelines
+RENDERERS = {
+    "text_highlight": "text_model.process_video:render_highlight_recipe",
+    "text_frame": "text_model.process_video:render_frame_recipe",
+    "text_merged": "text_model.process_video:render_merged_recipe",
+    "shorts_clip": "text_model.process_shorts:render_shorts_recipe",
+    "motion_reel": "motion_model.motion_processor:render_reel_recipe",
+    "motion_frame": "motion_model.motion_processor:render_instagram_frame_recipe",
+    "preview": "ml_core.previews:render_preview_recipe",
+    "subtitles_vtt": "ml_core.previews:render_vtt_recipe",
+}
+
+
+def persist_source(video_path):
+    """Keeps a copy of a (temporary) source video under SOURCES_DIR and returns its path."""
+    video_path = Path(video_path)
+    persisted = SOURCES_DIR / f"{file_content_hash(video_path)}{video_path.suffix}"
+    if not persisted.exists():
+        atomic_copy(video_path, persisted)
+    return str(persisted)
+
+
+def _load_recipe_file(job_dir):
+    try:
+        with open(Path(job_dir) / RECIPES_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_recipes(job_dir):
+    return _load_recipe_file(job_dir).get("outputs", {})
+
+
+def load_rejected(job_dir):
+    """Outputs the user rejected; they are never rendered."""
+    return set(_load_recipe_file(job_dir).get("rejected", []))
+
+
+def _dependents(recipes, relative_paths):
+    """relative_paths and every output built from them (merged reels, shorts clips), transitively."""
+    found = set(relative_paths)
+    changed = True
+    while changed:
+        dependents = {rel for rel, recipe in recipes.items() if rel not in found and found.intersection(recipe.get("inputs", []))}
+        found |= dependents
+        changed = bool(dependents)
+    return found
+
+
+def _update_recipe_file(job_dir, outputs=None, rejected=()):
+    job_dir = Path(job_dir)
+    with file_lock(RENDER_LOCK_DIR / f"{_lock_name(job_dir, RECIPES_FILE)}.lock"):
+        data = _load_recipe_file(job_dir)
+        data["version"] = 1
+        previous = data.get("outputs", {})
+        data["outputs"] = {**previous, **(outputs or {})}
+        # A retried job records its recipes again: outputs rendered from a recipe that changed since (and
+        # everything built from them) are stale and removed, outputs of unchanged recipes are kept
+        changed = [rel for rel, recipe in (outputs or {}).items()
+                   if rel in previous and payload_hash(previous[rel]) != payload_hash(recipe)]
+        for relative_path in _dependents(data["outputs"], changed) if changed else ():
+            if (job_dir / relative_path).exists():
+                logging.info(f"Removing {relative_path}: it was rendered from a recipe that changed")
+                (job_dir / relative_path).unlink()
+        data["rejected"] = sorted(set(data.get("rejected", [])) | set(rejected))
+        atomic_write_json(job_dir / RECIPES_FILE, data)
+        return data
+
+
+def record_recipes(job_dir, recipes):
+    """Adds {relative output path: recipe} entries to the job's recipe file (several scripts write to one job)."""
+    _update_recipe_file(job_dir, outputs=recipes)
+
+
+def is_preview(recipe):
+    return recipe.get("kind") in PREVIEW_KINDS
+
+
+def source_ranges(recipe):
+    """(start, end) source ranges a recipe reads: its "segments", its "start"/"end" or its frame "time"."""
+    if "segments" in recipe:
+        return [(segment[0], segment[1]) for segment in recipe["segments"]]
+    if "start" in recipe and "end" in recipe:
+        return [(recipe["start"], recipe["end"])]
+    if "time" in recipe:
+        return [(recipe["time"], recipe["time"])]
+    return None
+
+
+def _with_local_times(recipe, source, starts):
+    """The recipe reading source, whose range i begins at file time starts[i][1] (source time starts[i][0])."""
+    def local(i, time):
+        # Rounded to drop the float noise of the subtraction (times on the frame grid stay on it)
+        return round(time - starts[i][0] + starts[i][1], 6)
+
+    recipe = {**recipe, "source": source}
+    if "segments" in recipe:
+        recipe["segments"] = [[local(i, segment[0]), local(i, segment[1]), *segment[2:]]
+                              for i, segment in enumerate(recipe["segments"])]
+    elif "start" in recipe and "end" in recipe:
+        recipe["start"], recipe["end"] = local(0, recipe["start"]), local(0, recipe["end"])
+    else:
+        recipe["time"] = local(0, recipe["time"])
+    return recipe
+
+
+def with_render_source(recipe):
+    """
+    Recipes of URL jobs carry the analysis download as "source" and the URL as "source_url". Previews
+    render from the analysis download; everything else from the full-quality stream: only the ranges
+    the recipe reads are fetched (download_cache.range_source) and its times moved onto them, or the
+    whole stream once (into SOURCES_DIR) when range fetches are off or fail.
+    """
+    if not recipe.get("source_url") or is_preview(recipe):
+        return recipe
+    # Imported here so reading recipes (e.g. in the API process) never imports yt-dlp
+    from ml_core.download_cache import RANGE_FETCH_ENABLED, fetch_full_source, range_source
+
+    ranges = source_ranges(recipe)
+    if RANGE_FETCH_ENABLED and ranges:
+        try:
+            return _with_local_times(recipe, *range_source(recipe["source_url"], ranges, SOURCES_DIR))
+        except Exception as e:
+            logging.warning(f"Fetching source ranges of {recipe['source_url']} failed, fetching the whole video: {e}")
+    return {**recipe, "source": fetch_full_source(recipe["source_url"], SOURCES_DIR)}
+
+
+def pending_outputs(job_dir):
+    """Relative paths of recorded outputs that have not been rendered yet (rejected ones excluded)."""
+    rejected = load_rejected(job_dir)
+    return sorted(rel for rel in load_recipes(job_dir)
+                  if rel not in rejected and not (Path(job_dir) / rel).exists())
+
+
+def is_eager(relative_path):
+    if not LAZY_RENDER_ENABLED:
+        return True
+    return any(fnmatch.fnmatch(relative_path, pattern) for pattern in EAGER_RENDER_OUTPUTS)
+
+
+def _lock_name(job_dir, relative_path):
+    return hashlib.sha1(f"{Path(job_dir).resolve()}/{relative_path}".encode("utf-8")).hexdigest()
+
+
+def _pid_file(job_dir, relative_path):
+    """Holds the process group of the background render of an output, so rejecting it can cancel the render."""
+    return RENDER_LOCK_DIR / f"{_lock_name(job_dir, relative_path)}.pid"
+
+
+def _renderer_for(kind):
+    module_name, _, function_name = RENDERERS[kind].partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def render_output(job_dir, relative_path, recipes=None, rejected=None):
+    """
+    Renders one recorded output (and the outputs it is built from) unless it already exists.
+    Concurrent requests for the same file wait for a single render. Returns the path or None.
+    """
+    job_dir = Path(job_dir)
+    output_path = job_dir / relative_path
+    if output_path.exists():
+        return output_path
+    recipes = recipes if recipes is not None else load_recipes(job_dir)
+    rejected = rejected if rejected is not None else load_rejected(job_dir)
+    recipe = recipes.get(relative_path)
+    if recipe is None:
+        return None
+    if relative_path in rejected:
+        logging.info(f"Not rendering {relative_path}: it was rejected")
+        return None
+
+    with file_lock(RENDER_LOCK_DIR / f"{_lock_name(job_dir, relative_path)}.lock"):
+        if output_path.exists():
+            return output_path
+        for input_path in recipe.get("inputs", []):
+            if render_output(job_dir, input_path, recipes, rejected) is None:
+                logging.error(f"Could not render {input_path}, needed for {relative_path}")
+                return None
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        # Rendered under a temp name (same extension, for ffmpeg/cv2) and renamed, so a file that exists is complete
+        temp_path = output_path.with_name(f".rendering-{output_path.name}")
+        logging.info(f"Rendering {relative_path} ({recipe['kind']}) for {job_dir.name}")
+        apply_thread_allotment()
+        try:
+            _renderer_for(recipe["kind"])(with_render_source(recipe), str(temp_path), str(job_dir))
+            if temp_path.exists():
+                os.replace(temp_path, output_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+    return output_path if output_path.exists() else None
+
+
+def render_previews(job_dir):
+    """Renders the fast preview (and subtitle sidecar) of every selected highlight."""
+    recipes = load_recipes(job_dir)
+    for relative_path in sorted(recipes):
+        if is_preview(recipes[relative_path]):
+            try:
+                render_output(job_dir, relative_path, recipes)
+            except Exception as e:
+                logging.error(f"Preview render of {relative_path} failed: {e}")
+
+
+def render_eager_outputs(job_dir):
+    """Renders the outputs this deployment wants ready when a job finishes (all of them with LAZY_RENDER=off)."""
+    recipes = load_recipes(job_dir)
+    for relative_path in sorted(recipes):
+        if is_eager(relative_path) and not is_preview(recipes[relative_path]):
+            try:
+                render_output(job_dir, relative_path, recipes)
+            except Exception as e:
+                logging.error(f"Eager render of {relative_path} failed: {e}")
+
+
+def publish_job_outputs(job_dir):
+    """
+    Called by a pipeline once its recipes are recorded: previews are rendered right away, the eager
+    full-quality outputs in a detached low-priority process (inline if previews are disabled).
+    """
+    if not PREVIEWS_ENABLED:
+        render_eager_outputs(job_dir)
+        return
+    render_previews(job_dir)
+    recipes = load_recipes(job_dir)
+    if not any(is_eager(rel) and not is_preview(recipe) for rel, recipe in recipes.items()):
+        return
+    RENDER_LOCK_DIR.mkdir(parents=True, exist_ok=True)
+    # The job's TMPDIR is removed when the job ends; the renders outlive it
+    env = {name: value for name, value in os.environ.items() if name != "TMPDIR"}
+    with open(RENDER_LOCK_DIR / f"{Path(job_dir).name}.log", "a") as log_file:
+        subprocess.Popen([sys.executable, str(Path(__file__).resolve()), str(Path(job_dir).resolve()), "--background"],
+                         stdin=subprocess.DEVNULL, stdout=log_file, stderr=log_file, start_new_session=True, env=env)
+    logging.info(f"Full-quality renders of {Path(job_dir).name} continue in the background")
+
+
+def run_background_renders(job_dir):
+    """
+    Renders the eager full-quality outputs one subprocess (and process group) at a time, at
+    FULL_RENDER_NICENESS, so reject_outputs can cancel a single render without stopping the others.
+    """
+    os.nice(FULL_RENDER_NICENESS)
+    recipes = load_recipes(job_dir)
+    for relative_path in sorted(recipes):
+        if not is_eager(relative_path) or is_preview(recipes[relative_path]):
+            continue
+        if not Path(job_dir).is_dir():
+            break  # the job was cancelled and discarded
+        if relative_path in load_rejected(job_dir) or (Path(job_dir) / relative_path).exists():
+            continue
+        pid_file = _pid_file(job_dir, relative_path)
+        # moviepy writes its temp audio into the working directory; a cancelled render must not leave it behind
+        work_dir = tempfile.mkdtemp(prefix="render_", dir=RENDER_LOCK_DIR)
+        process = subprocess.Popen([sys.executable, str(Path(__file__).resolve()), str(job_dir), relative_path],
+                                   cwd=work_dir, start_new_session=True)
+        pid_file.write_text(str(process.pid))
+        try:
+            if process.wait() != 0:
+                logging.warning(f"Background render of {relative_path} ended with code {process.returncode}")
+        finally:
+            pid_file.unlink(missing_ok=True)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def reject_outputs(job_dir, relative_paths):
+    """
+    Marks outputs as rejected and cancels their running background renders. Rejecting a preview
+    rejects the full-quality outputs it stands for; outputs built from a rejected output are rejected
+    too. Returns (rejected outputs, number of cancelled renders).
+    """
+    recipes = load_recipes(job_dir)
+    rejected = set()
+    for relative_path in relative_paths:
+        rejected.add(relative_path)
+        rejected.update(recipes.get(relative_path, {}).get("full_outputs", []))
+    # Anything assembled from a rejected output (a merged reel, a shorts clip) can not be rendered any more
+    rejected = _dependents(recipes, rejected) & set(recipes)
+    _update_recipe_file(job_dir, rejected=rejected)
+
+    cancelled = 0
+    for relative_path in rejected:
+        try:
+            os.killpg(int(_pid_file(job_dir, relative_path).read_text()), signal.SIGTERM)
+            cancelled += 1
+        except (OSError, ValueError):
+            pass
+    return sorted(rejected), cancelled
+
+
+def discard_job(job_dir):
+    """
+    Removes a cancelled job's outputs: every output is rejected first, which stops its background
+    renders and keeps them from starting, then the job directory is deleted. Returns the number of
+    files removed.
+    """
+    job_dir = Path(job_dir)
+    recipes = load_recipes(job_dir)
+    if recipes:
+        reject_outputs(job_dir, list(recipes))
+    removed = sum(1 for path in job_dir.rglob("*") if path.is_file())
+    shutil.rmtree(job_dir, ignore_errors=True)
+    return removed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Render one recorded output of a job (used by the lazy /static/outputs handler).")
+    parser.add_argument("job_dir", help="Job output directory containing render_recipes.json")
+    parser.add_argument("outputs", nargs="*", help="Output paths relative to the job directory (default: the eager set)")
+    parser.add_argument("--background", action="store_true",
+                        help="Render the eager full-quality outputs at low priority, one cancellable process each")
+    args = parser.parse_args()
+
+    # A cancelled render gets SIGTERM; exiting through SystemExit removes its partial temp file
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    if args.background:
+        run_background_renders(args.job_dir)
+    elif not args.outputs:
+        render_eager_outputs(args.job_dir)
+    for relative_output in args.outputs:
+        if render_output(args.job_dir, relative_output) is None:
+            print(f"Could not render {relative_output}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+from scenedetect import SceneManager, open_video
+from scenedetect.detectors import ContentDetector
+
+from ml_core.cache_utils import CACHE_ROOT, atomic_write_json, file_content_hash, payload_hash
+from ml_core.cpu_budget import thread_allotment
+
+# Scene detection settings. Downscaling and frame skipping trade a little cut-time precision for
+# a much cheaper decode; see benchmark_scenes.py for the recall/latency trade-off.
+# This module is the fallback path: with the feature index on (ANALYSIS_INDEX, the default),
+# detect_scenes takes its scenes from FeatureIndex.scenes (ml_core/analysis.py), which computes cuts
+# from frame features stored during ingest, and none of the settings below are used.
+SCENE_THRESHOLD = 30.0
+SCENE_DOWNSCALE = int(os.environ.get("SCENE_DOWNSCALE", "0"))  # 0 = scenedetect's automatic factor for the width
+SCENE_FRAME_SKIP = int(os.environ.get("SCENE_FRAME_SKIP", "1"))  # frames skipped between analyzed frames
+SCENE_MIN_SCENE_SECONDS = 0.5  # cuts closer than this are one cut (also used to reconcile shard seams)
+SCENE_SHARD_MIN_DURATION = float(os.environ.get("SCENE_SHARD_MIN_DURATION", "120"))
+SCENE_SHARD_WARMUP = 2.0  # seconds decoded before each shard so the detector has a previous frame
+SCENE_CACHE_DIR = CACHE_ROOT / "scenes"
+
+# Bump when detection changes in a way that makes stored cut lists stale
+SCENE_CACHE_VERSION = 1
+
+
+def video_duration(video_path):
+    capture = cv2.VideoCapture(str(video_path))
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0
+        frames = capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+        return frames / fps if fps else 0.0
+    finally:
+        capture.release()
+
+
+def detect_cuts_in_range(video_path, start_time=0.0, end_time=None, threshold=SCENE_THRESHOLD,
+                         downscale=SCENE_DOWNSCALE, frame_skip=SCENE_FRAME_SKIP):
+    """Returns the cut times (seconds) ContentDetector finds between start_time and end_time."""
+    cv2.setNumThreads(1)  # parallelism comes from the shards
+    video = open_video(str(video_path))
+    if start_time > 0:
+        video.seek(start_time)
+
+    scene_manager = SceneManager()
+    if downscale > 0:
+        scene_manager.auto_downscale = False
+        scene_manager.downscale = downscale
+    min_scene_len = max(1, int(round(SCENE_MIN_SCENE_SECONDS * video.frame_rate / (frame_skip + 1))))
+    scene_manager.add_detector(ContentDetector(threshold=threshold, min_scene_len=min_scene_len))
+    scene_manager.detect_scenes(video=video, end_time=end_time, frame_skip=frame_skip)
+    # The first scene starts where decoding started, every later scene start is a cut
+    return [scene[0].get_seconds() for scene in scene_manager.get_scene_list()[1:]]
+
+
+def plan_scene_shards(duration, workers):
+    if duration < SCENE_SHARD_MIN_DURATION or workers <= 1:
+        return [(0.0, None)]
+    shard_length = duration / workers
+    return [(i * shard_length, None if i == workers - 1 else (i + 1) * shard_length) for i in range(workers)]
+
+
+def reconcile_shard_cuts(shard_cuts, shards):
+    """
+    Joins per-shard cut lists. Each shard keeps only cuts inside its own range (its warm-up
+    region belongs to the previous shard), and cuts within SCENE_MIN_SCENE_SECONDS of each other
+    across a seam are merged into one.
+    """
+    cuts = []
+    for cut_list, (start, end) in zip(shard_cuts, shards):
+        cuts.extend(c for c in cut_list if c >= start and (end is None or c < end))
+    merged = []
+    for cut in sorted(cuts):
+        if merged and cut - merged[-1] < SCENE_MIN_SCENE_SECONDS:
+            continue
+        merged.append(cut)
+    return merged
+
+
+def detect_scene_cuts(video_path, threshold=SCENE_THRESHOLD, downscale=SCENE_DOWNSCALE,
+                      frame_skip=SCENE_FRAME_SKIP, workers=None, duration=None):
+    """Scene cut times of a video, detected in parallel time shards for long videos."""
+    duration = duration or video_duration(video_path)
+    workers = workers or thread_allotment()
+    shards = plan_scene_shards(duration, workers)
+    if len(shards) == 1:
+        return detect_cuts_in_range(video_path, 0.0, None, threshold, downscale, frame_skip)
+
+    logging.info(f"Detecting scenes of {duration:.0f}s video in {len(shards)} parallel shards.")
+    with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+        futures = [
+            executor.submit(detect_cuts_in_range, video_path, max(0.0, start - SCENE_SHARD_WARMUP), end,
+                            threshold, downscale, frame_skip)
+            for start, end in shards
+        ]
+        shard_cuts = [future.result() for future in futures]
+    return reconcile_shard_cuts(shard_cuts, shards)
+
+
+def cuts_to_scenes(cuts, duration):
+    """[(start, end), ...] scene list like SceneManager.get_scene_list(), empty if there is no cut."""
+    if not cuts:
+        return []
+    boundaries = [0.0] + list(cuts) + [duration]
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def detect_scenes_cached(video_path, threshold=SCENE_THRESHOLD, downscale=SCENE_DOWNSCALE,
+                         frame_skip=SCENE_FRAME_SKIP, workers=None):
+    """
+    Scene list of a video. Cut lists are stored per content hash and detection settings under
+    cache/scenes, so re-runs and other pipelines on the same upload do not decode it again.
+    """
+    key = payload_hash({
+        "version": SCENE_CACHE_VERSION,
+        "source": file_content_hash(video_path),
+        "threshold": threshold,
+        "downscale": downscale,
+        "frame_skip": frame_skip,
+    })
+    cache_path = SCENE_CACHE_DIR / f"{key}.json"
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        logging.info(f"Scene cache hit for {video_path}")
+        return cuts_to_scenes(cached["cuts"], cached["duration"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    duration = video_duration(video_path)
+    cuts = detect_scene_cuts(video_path, threshold, downscale, frame_skip, workers, duration)
+    try:
+        atomic_write_json(cache_path, {"cuts": cuts, "duration": duration})
+    except OSError as e:
+        logging.warning(f"Could not store scene cuts for {video_path}: {e}")
+    return cuts_to_scenes(cuts, duration)
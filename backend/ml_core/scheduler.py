@@ -0,0 +1,330 @@
+import asyncio
+import logging
+import math
+import os
+import shutil
+import subprocess
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from ml_core.admission import ADMISSION_MAX_QUEUE_WAIT, ADMISSION_MEMORY_LIMIT_MB, record_job
+from ml_core.cache_utils import CACHE_ROOT
+from ml_core.cpu_budget import rebalance
+from ml_core.process_tree import process_tree_memory_mb, processes_with_env, terminate_process_tree
+
+# Job scheduler for the processing endpoints (/process/motion/, /process/text/, /transcribe/video/).
+# At most SCHEDULER_SLOTS pipeline scripts run at once; queued jobs are started by:
+#   1. weighted fair queuing between users (X-API-Key, or the client address): the user that has
+#      received the least predicted work (divided by its weight) goes next, so one user's batch of
+#      long videos can not hold every slot while another user's clips wait;
+#   2. shortest predicted job first within a user, with aging: every second a job waits lowers its
+#      priority score by SCHEDULER_AGING_RATE seconds of runtime, so long jobs still start eventually.
+# Runtimes and peak memory are predicted by ml_core/admission.py, which also sets the admission limits.
+# Every job script runs in its own session with its own TMPDIR, so a timeout or DELETE /jobs/{job_id}
+# stops the whole process tree and leaves no temp files behind.
+SCHEDULER_SLOTS = int(os.environ.get("SCHEDULER_SLOTS", str(max(1, (os.cpu_count() or 2) // 2))))
+SCHEDULER_AGING_RATE = float(os.environ.get("SCHEDULER_AGING_RATE", "1.0"))
+# "key:weight,key:weight"; users that are not listed have weight 1
+SCHEDULER_USER_WEIGHTS = {
+    key.strip(): float(weight) for key, _, weight in
+    (entry.partition(":") for entry in os.environ.get("SCHEDULER_USER_WEIGHTS", "").split(",") if ":" in entry)
+}
+FINISHED_JOBS_KEPT = 1000  # finished jobs whose state GET /jobs/{job_id} still reports
+MEMORY_SAMPLE_INTERVAL = 1.0
+JOB_TEMP_DIR = CACHE_ROOT / "job_tmp"
+# Set in the environment of a job's scripts (inherited by everything they start)
+JOB_ID_ENV = "HIGHLIGHTS_JOB_ID"
+FINAL_STATES = ("succeeded", "failed", "cancelled")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, wait, limit, retry_after):
+        super().__init__(f"Server busy: predicted queue wait {wait:.0f}s exceeds {limit:.0f}s. Retry in {retry_after}s.")
+        self.wait = wait
+        self.retry_after = retry_after
+
+
+class JobCancelled(Exception):
+    def __init__(self, job_id):
+        super().__init__(f"Job {job_id} was cancelled.")
+        self.job_id = job_id
+
+
+def scheduler_user(request):
+    """The fair-share key of a request: its X-API-Key header, else the client address."""
+    return request.headers.get("x-api-key") or (request.client.host if request.client else "anonymous")
+
+
+class JobScheduler:
+    """Admits jobs to a fixed number of slots (see the module comment). Runs in the API event loop."""
+
+    def __init__(self, slots=SCHEDULER_SLOTS, aging_rate=SCHEDULER_AGING_RATE, weights=None,
+                 max_queue_wait=ADMISSION_MAX_QUEUE_WAIT, memory_limit_mb=ADMISSION_MEMORY_LIMIT_MB):
+        self.slots = slots
+        self.aging_rate = aging_rate
+        self.weights = SCHEDULER_USER_WEIGHTS if weights is None else weights
+        self.max_queue_wait = max_queue_wait
+        self.memory_limit_mb = memory_limit_mb
+        self.jobs = {}           # job_id -> job, queued, running and recently finished
+        self.finished = deque()  # finished job ids, oldest first
+        self.running = {}        # job_id -> job
+        self.queued = []         # jobs waiting for a slot, in arrival order
+        self.service = {}        # user -> predicted work started so far / weight (virtual time)
+        self.virtual_time = 0.0  # virtual time of the last job started
+
+    def _priority(self, job, now):
+        return job["runtime"] - self.aging_rate * (now - job["enqueued"])
+
+    def _user_service(self, service, user, queued):
+        if not any(job["user"] == user for job in queued):
+            # A user that was idle starts at the current virtual time, so it can not claim the
+            # service it did not use while idle
+            return max(service.get(user, 0.0), self.virtual_time)
+        return service[user]
+
+    def _next_job(self, queued, service, now):
+        best_by_user = {}
+        for job in queued:
+            best = best_by_user.get(job["user"])
+            if best is None or self._priority(job, now) < self._priority(best, now):
+                best_by_user[job["user"]] = job
+        # Least served user first; between equally served users, the better job
+        return min(best_by_user.values(), key=lambda job: (service[job["user"]], self._priority(job, now)))
+
+    def _fits_memory(self, job, running_memory):
+        # A job always runs on an idle server, even if its prediction alone exceeds the limit
+        return running_memory == 0 or self.memory_limit_mb <= 0 or running_memory + job["memory_mb"] <= self.memory_limit_mb
+
+    def _dispatch(self):
+        started = False
+        now = time.monotonic()
+        while self.queued and len(self.running) < self.slots:
+            job = self._next_job(self.queued, self.service, now)
+            if not self._fits_memory(job, sum(running["memory_mb"] for running in self.running.values())):
+                break  # deferred until enough memory is freed; not skipped, so big jobs can not starve
+            self.queued.remove(job)
+            self.virtual_time = self.service[job["user"]]
+            self.service[job["user"]] += job["runtime"] / self.weights.get(job["user"], 1.0)
+            job["started"] = time.monotonic()
+            job["state"] = "running"
+            self.running[job["job_id"]] = job
+            started = True
+            if not job["admitted"].done():
+                job["admitted"].set_result(None)
+        return started
+
+    def dispatch_order(self, extra=None):
+        """Queued jobs (and a hypothetical extra one) in the order they would start, if nothing else arrives."""
+        queued, service, now = list(self.queued), dict(self.service), time.monotonic()
+        if extra is not None:
+            service[extra["user"]] = self._user_service(service, extra["user"], queued)
+            queued.append(extra)
+        order = []
+        while queued:
+            job = self._next_job(queued, service, now)
+            queued.remove(job)
+            service[job["user"]] += job["runtime"] / self.weights.get(job["user"], 1.0)
+            order.append(job)
+        return order
+
+    def forecast(self, extra=None):
+        """{job_id: (predicted start, predicted end)} in time.monotonic() seconds, from the predicted runtimes."""
+        now = time.monotonic()
+        times = {}
+        slots = []  # (predicted end, memory) of every occupied slot
+        for job in self.running.values():
+            # A job that overran its prediction is assumed to finish soon
+            end = max(now + MEMORY_SAMPLE_INTERVAL, job["started"] + job["runtime"])
+            times[job["job_id"]] = (job["started"], end)
+            slots.append((end, job["memory_mb"]))
+        clock = now
+        for job in self.dispatch_order(extra):
+            while len(slots) >= self.slots or not self._fits_memory(job, sum(memory for _, memory in slots)):
+                slots.sort(key=lambda slot: slot[0])
+                clock = max(clock, slots.pop(0)[0])
+            times[job["job_id"]] = (clock, clock + job["runtime"])
+            slots.append((clock + job["runtime"], job["memory_mb"]))
+        return times
+
+    def admit(self, job_id, user, pipeline, prediction):
+        """
+        Queues a job (it may start right away), or raises AdmissionRejected if its predicted queue
+        wait is longer than max_queue_wait. prediction: ml_core.admission.predict_job.
+        """
+        now = time.monotonic()
+        job = {"job_id": job_id, "user": user, "pipeline": pipeline, "prediction": prediction,
+               "runtime": prediction["runtime"], "memory_mb": prediction["memory_mb"], "enqueued": now,
+               "state": "queued", "admitted": asyncio.get_running_loop().create_future()}
+        if self.max_queue_wait > 0:
+            wait = self.forecast(extra=job)[job_id][0] - now
+            if wait > self.max_queue_wait:
+                # By then the jobs ahead should have drained far enough for the wait to be acceptable
+                raise AdmissionRejected(wait, self.max_queue_wait, max(1, math.ceil(wait - self.max_queue_wait)))
+        self.service[user] = self._user_service(self.service, user, self.queued)
+        if job_id in self.finished:
+            # A retried job runs again under its job_id
+            self.finished.remove(job_id)
+        self.jobs[job_id] = job
+        self.queued.append(job)
+        if self._dispatch():
+            rebalance(self.running)
+        if job["state"] == "queued":
+            logging.info(f"Job {job_id} queued (predicted {job['runtime']:.0f}s, {job['memory_mb']:.0f} MB; "
+                         f"{len(self.queued)} waiting, {len(self.running)}/{self.slots} running)")
+        return job
+
+    def finish(self, job, state, error=None):
+        if job["state"] in FINAL_STATES:
+            return
+        if job in self.queued:
+            self.queued.remove(job)
+        finished = self.running.pop(job["job_id"], None) is not None
+        job.update(state=state, error=error, finished=time.time())
+        self.finished.append(job["job_id"])
+        while len(self.finished) > FINISHED_JOBS_KEPT:
+            self.jobs.pop(self.finished.popleft(), None)
+        if self._dispatch() or finished:
+            # New CPU shares for the running jobs (ml_core/cpu_budget.py)
+            rebalance(self.running)
+
+    @asynccontextmanager
+    async def slot(self, job):
+        """Waits until an admitted job may run, and frees its slot when the block exits (or the request is cancelled)."""
+        try:
+            await job["admitted"]
+        except (asyncio.CancelledError, JobCancelled):
+            self.finish(job, "cancelled")
+            raise
+        logging.info(f"Job {job['job_id']} started after {job['started'] - job['enqueued']:.1f}s in the queue")
+        job["temp_dir"] = JOB_TEMP_DIR / job["job_id"]
+        job["temp_dir"].mkdir(parents=True, exist_ok=True)
+        try:
+            yield job
+        except (asyncio.CancelledError, JobCancelled):
+            self.finish(job, "cancelled")
+            raise
+        except BaseException as e:
+            self.finish(job, "failed", getattr(e, "detail", None) or str(e) or type(e).__name__)
+            raise
+        finally:
+            await asyncio.to_thread(shutil.rmtree, job["temp_dir"], True)
+        runtime = time.monotonic() - job["started"]
+        self.finish(job, "succeeded")
+        try:
+            await asyncio.to_thread(record_job, job["prediction"], runtime, job.get("peak_memory_mb"))
+        except OSError as e:
+            logging.warning(f"Could not record the runtime of job {job['job_id']}: {e}")
+
+    async def cancel(self, job_id):
+        """
+        Cancels a queued or running job: a queued job leaves the queue, a running job's process tree
+        is terminated (its endpoint then raises JobCancelled). Returns False if the job is not active.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job["state"] not in ("queued", "running"):
+            return False
+        job["cancel_requested"] = True
+        logging.info(f"Cancelling {job['state']} job {job_id}")
+        if job["state"] == "queued":
+            job["admitted"].set_exception(JobCancelled(job_id))
+            self.finish(job, "cancelled")
+        elif job.get("pid"):
+            await asyncio.to_thread(terminate_process_tree, job["pid"])
+        return True
+
+    def track(self, job, task):
+        """Keeps the outcome of a job that runs in the background (see Prefer: respond-async) for its status."""
+        def store_outcome(finished_task):
+            if finished_task.cancelled():
+                return
+            if finished_task.exception() is None:
+                job["result"] = finished_task.result()
+            else:
+                # The endpoint's error response (HTTPException detail) instead of the script's exception
+                job["error"] = getattr(finished_task.exception(), "detail", None) or job.get("error")
+        task.add_done_callback(store_outcome)
+        job["task"] = task
+
+    def status(self, job_id):
+        """Scheduling state of a job with its predicted start/completion (unix time), or None if unknown."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        status = {"state": job["state"], "predicted_runtime": round(job["runtime"], 1),
+                  "predicted_memory_mb": round(job["memory_mb"])}
+        if job["state"] in ("queued", "running"):
+            now = time.monotonic()
+            to_wall_clock = time.time() - now
+            start, end = self.forecast()[job_id]
+            if job["state"] == "queued":
+                status["queue_position"] = [queued["job_id"] for queued in self.dispatch_order()].index(job_id)
+            status.update(estimated_start=round(start + to_wall_clock, 1), estimated_completion=round(end + to_wall_clock, 1),
+                          estimated_seconds_remaining=round(end - now, 1))
+        else:
+            status["finished"] = round(job["finished"], 1)
+            if job.get("error"):
+                status["error"] = job["error"]
+            if "result" in job:
+                status["result"] = job["result"]
+        return status
+
+
+scheduler = JobScheduler()
+
+
+def terminate_job_processes(job_id):
+    """Stops the scripts (and their children) a stopped worker left running for a job. Blocking."""
+    for pid in processes_with_env(JOB_ID_ENV, job_id):
+        logging.info(f"Terminating process {pid} left running for job {job_id}")
+        terminate_process_tree(pid)
+
+
+async def _sample_peak_memory(pid, job):
+    while True:
+        try:
+            memory_mb = await asyncio.to_thread(process_tree_memory_mb, pid)
+        except OSError:
+            memory_mb = 0
+        job["peak_memory_mb"] = max(job.get("peak_memory_mb") or 0, memory_mb)
+        await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+
+
+async def run_subprocess(command, timeout, env=None, job=None):
+    """
+    asyncio counterpart of subprocess.run(command, capture_output=True, text=True, check=True,
+    timeout=timeout): the event loop keeps serving requests while the script runs. Raises
+    CalledProcessError / TimeoutExpired like subprocess.run; a timeout terminates the whole process
+    tree. With a scheduler job, the script gets the job's TMPDIR, the peak memory of its process tree
+    is sampled into job["peak_memory_mb"], and JobCancelled is raised if the job was cancelled.
+    """
+    if job is not None:
+        if job.get("cancel_requested"):
+            raise JobCancelled(job["job_id"])
+        env = {**(env if env is not None else os.environ), "TMPDIR": str(job["temp_dir"]), JOB_ID_ENV: job["job_id"]}
+    # Own session: the process group holds the script's children (nested scripts, ffmpeg, yt-dlp, workers)
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                   env=env, start_new_session=True)
+    sampler = None
+    if job is not None:
+        job["pid"] = process.pid
+        sampler = asyncio.create_task(_sample_peak_memory(process.pid, job))
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        await asyncio.to_thread(terminate_process_tree, process.pid)
+        stdout, stderr = await process.communicate()
+        raise subprocess.TimeoutExpired(command, timeout, output=stdout, stderr=stderr)
+    except asyncio.CancelledError:
+        await asyncio.to_thread(terminate_process_tree, process.pid)
+        raise
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+            job.pop("pid", None)
+    if job is not None and job.get("cancel_requested"):
+        raise JobCancelled(job["job_id"])
+    stdout, stderr = stdout.decode(errors="replace"), stderr.decode(errors="replace")
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
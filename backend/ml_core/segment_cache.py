@@ -0,0 +1,46 @@
+import logging
+import os
+
+from ml_core.cache_utils import CACHE_ROOT, DiskLRUCache, payload_hash
+
+# Rendered-segment cache settings (shared by the text, shorts and motion pipelines)
+SEGMENT_CACHE_ENABLED = os.environ.get("SEGMENT_CACHE", "on") != "off"
+SEGMENT_CACHE_DIR = os.environ.get("SEGMENT_CACHE_DIR", str(CACHE_ROOT / "segments"))
+SEGMENT_CACHE_MAX_BYTES = int(os.environ.get("SEGMENT_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))  # 10 GB
+
+
+def segment_cache_key(source_hash, start, end, geometry, encode_profile, subtitles=None):
+    """
+    Cache key of a rendered segment: source content hash, time range, target geometry,
+    encode profile and a hash of the burned-in subtitle payload (None for no overlay).
+    Times are rounded to milliseconds so float noise does not cause misses.
+    """
+    return payload_hash({
+        "source": source_hash,
+        "start": round(float(start), 3),
+        "end": round(float(end), 3),
+        "geometry": geometry,
+        "profile": encode_profile,
+        "subtitles": payload_hash(subtitles) if subtitles else None,
+    })
+
+
+class SegmentCache(DiskLRUCache):
+    """LRU cache of rendered .mp4 segments. A hit is copied straight to the output path, skipping decode and encode."""
+
+    def __init__(self, root=SEGMENT_CACHE_DIR, max_bytes=SEGMENT_CACHE_MAX_BYTES, enabled=SEGMENT_CACHE_ENABLED):
+        super().__init__(root, max_bytes, suffix=".mp4")
+        self.enabled = enabled
+
+    def fetch(self, key, output_path):
+        if not self.enabled:
+            return False
+        hit = super().fetch(key, output_path)
+        if hit:
+            logging.info(f"Segment cache hit: {output_path}")
+        return hit
+
+    def store(self, key, rendered_path):
+        if not self.enabled or not rendered_path or not os.path.exists(rendered_path):
+            return None
+        return self.put(key, rendered_path)
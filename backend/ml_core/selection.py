@@ -0,0 +1,297 @@
+import json
+import logging
+import math
+from pathlib import Path
+
+import numpy as np
+
+from ml_core.cache_utils import atomic_write_json
+
+# Pure highlight selection logic shared by the pipelines and POST /jobs/{id}/select.
+# Nothing in here touches media, so re-selecting with new parameters takes milliseconds.
+
+SELECTION_FEATURES_FILE = "selection_features.json"
+SELECTION_FEATURES_VERSION = 1
+
+HIGHLIGHT_KEYWORDS = ["главное", "вопрос", "важно", "итог", "ответ",
+                      "ключевое", "education", "students", "learning", "school",
+                      "ai", "developers", "artificial", "intelligence", "coding"]
+
+# Motion model defaults (see motion_processor.py)
+MOTION_STD_FACTOR = 0.2
+MIN_MOTION_FRAMES = 3
+MOTION_MERGE_GAP = 1.0
+MIN_CLIP_DURATION = 1
+MAX_CLIP_DURATION = 25
+MIN_TOTAL_FRACTION = 0.1
+CLIP_TAIL_PADDING = 0.3
+SHORT_VIDEO_TARGET_DURATION = 58
+STORY_VIDEO_TARGET_DURATION = 15
+
+# Text shorts defaults (see process_shorts.py)
+INSTAGRAM_MAX_DURATION = 15
+YOUTUBE_MAX_DURATION = 59
+
+
+def write_selection_features(output_dir, pipeline, features):
+    """Stores the signals selection needs next to a job's outputs, so it can be re-run without the media."""
+    payload = {"version": SELECTION_FEATURES_VERSION, "pipeline": pipeline, **features}
+    atomic_write_json(Path(output_dir) / SELECTION_FEATURES_FILE, payload)
+
+
+def load_selection_features(job_dir):
+    with open(Path(job_dir) / SELECTION_FEATURES_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# === Text model ===
+
+# Highest score compute_score_enhanced gives a segment without keyword hits (peak + scene cut +
+# duration + punctuation); keep in sync with it. Every keyword hit adds KEYWORD_HIT_SCORE.
+TEXT_SCORE_MAX_WITHOUT_KEYWORDS = 3.5
+KEYWORD_HIT_SCORE = 2
+
+
+def compute_score_enhanced(segment, peaks, keywords, scenes):
+    """Scores a transcription segment for highlight selection."""
+    logging.debug(f"Entering compute_score_enhanced for segment: {segment.get('text', '')[:50]}...")
+    score = 0
+    start, end, text = segment['start'], segment['end'], segment['text']
+    if any(start - 0.5 <= p <= end + 0.5 for p in peaks):
+        score += 1
+    score += sum(text.lower().count(k.lower()) * KEYWORD_HIT_SCORE for k in keywords)
+    if any(abs(start - s[0]) < 1 for s in scenes):
+        score += 1.5
+    duration = end - start
+    score += 0.5 if 3 <= duration <= 20 else -0.5 if duration < 3 or duration > 30 else 0
+    if '?' in text or '!' in text:
+        score += 0.5
+    logging.debug(f"Exiting compute_score_enhanced with score: {score}")
+    return score
+
+
+def select_text_highlights(segments, peaks, scenes, full_text, num_clips, keywords=HIGHLIGHT_KEYWORDS):
+    """Scores transcript segments and returns the num_clips best ones (with score and hashtags), best first."""
+    found = [k for k in keywords if k in full_text.lower()]
+    data = []
+    for seg_idx, seg in enumerate(segments):
+        score = compute_score_enhanced(seg, peaks, keywords, scenes)
+        if score <= 0:
+            logging.debug(f"Segment {seg_idx + 1} (Start: {seg.get('start',0):.2f}s) failed filtering with score {score}.")
+            continue
+        logging.info(f"Segment {seg_idx + 1} (Start: {seg.get('start',0):.2f}s) passed filtering with score {score}.")
+        hashtags = list({f"#{w.lower()}" for w in seg['text'].split() if w.isalpha() and len(w)>3} |
+                        {f"#{k.lower()}" for k in found})
+        data.append({**seg, 'score': score, 'hashtags': hashtags})
+    return sorted(data, key=lambda x: -x['score'])[:num_clips]
+
+
+def committed_text_highlights(scores, num_clips, max_unseen_score=None):
+    """
+    Streaming selection: indices of the segments scored so far (scores in timeline order) whose place
+    in the top num_clips of select_text_highlights can not change any more, assuming no segment still
+    to come scores above max_unseen_score. Ties rank the earlier segment first, as the stable sort in
+    select_text_highlights does, so a segment scoring at least max_unseen_score is only ever outranked
+    by segments already seen. max_unseen_score=None commits the current top num_clips (a guess).
+    """
+    ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])[:num_clips]
+    if max_unseen_score is None:
+        return ranked
+    return [i for i in ranked if scores[i] >= max_unseen_score]
+
+
+def initial_highlight_count(num_clips, platform_max_durations):
+    """How many highlight segments process_shorts asks process_video for (enough ~5 s material per clip)."""
+    longest_platform_duration = max(platform_max_durations, default=0)
+    return max(10, num_clips * math.ceil(longest_platform_duration / 5.0 if longest_platform_duration > 0 else 1.0))
+
+
+def platform_configs_for(target_format, num_clips, max_duration_yt=YOUTUBE_MAX_DURATION):
+    configs = []
+    if target_format in ("youtube", "both"):
+        configs.append({"name": "youtube", "max_duration": min(YOUTUBE_MAX_DURATION, max_duration_yt), "num_clips_to_generate": num_clips})
+    if target_format in ("instagram", "both"):
+        configs.append({"name": "instagram", "max_duration": INSTAGRAM_MAX_DURATION, "num_clips_to_generate": num_clips})
+    return configs
+
+
+def plan_youtube_clips(durations, max_clip_duration, num_clips_to_generate):
+    """
+    Groups consecutive highlights into YouTube clips of up to max_clip_duration. A single highlight
+    longer than that becomes its own trimmed clip. Returns a list of clips, each a list of
+    (highlight_index, seconds_to_take).
+    """
+    clips = []
+    highlight_idx = 0
+    while len(clips) < num_clips_to_generate and highlight_idx < len(durations):
+        parts = []
+        current_total_duration = 0
+        while highlight_idx < len(durations):
+            duration = durations[highlight_idx]
+            if current_total_duration + duration <= max_clip_duration:
+                parts.append((highlight_idx, duration))
+                current_total_duration += duration
+                highlight_idx += 1
+            else:
+                if not parts and duration > max_clip_duration:
+                    parts.append((highlight_idx, max_clip_duration))
+                    highlight_idx += 1
+                break
+        if not parts:
+            break
+        clips.append(parts)
+    return clips
+
+
+def plan_instagram_clips(durations, max_clip_duration, num_clips_to_generate):
+    """One Instagram clip per highlight, trimmed to max_clip_duration; near-empty highlights are skipped."""
+    clips = []
+    for highlight_idx in range(min(num_clips_to_generate, len(durations))):
+        duration_to_use = min(durations[highlight_idx], max_clip_duration)
+        if duration_to_use > 0.1:
+            clips.append([(highlight_idx, duration_to_use)])
+    return clips
+
+
+def select_text_job(features, num_clips=3, max_duration_yt=YOUTUBE_MAX_DURATION, target_format="both"):
+    """
+    Recomputes a text job's highlights and platform clips from its stored features. Returns the
+    highlight segments and, per platform, each clip as a list of source time ranges.
+    """
+    configs = platform_configs_for(target_format, num_clips, max_duration_yt)
+    count = initial_highlight_count(num_clips, [c["max_duration"] for c in configs])
+    top = select_text_highlights(features["segments"], features["peaks"], features["scenes"],
+                                 features.get("full_text", ""), count)
+
+    duration = features.get("duration") or float("inf")
+    highlights = []
+    for number, clip_data in enumerate(top, 1):
+        start, end = clip_data["start"], min(clip_data["end"], duration)
+        if end - start >= 0.1:
+            highlights.append({"name": f"highlight_{number}.mp4", "start": start, "end": end,
+                               "score": clip_data["score"], "text": clip_data["text"].strip(),
+                               "hashtags": clip_data["hashtags"]})
+    # process_shorts reads the rendered highlights in file name order (highlight_1, highlight_10, highlight_2, ...)
+    ordered = sorted(highlights, key=lambda h: h["name"])
+    durations = [h["end"] - h["start"] for h in ordered]
+
+    platforms = {}
+    for config in configs:
+        planner = plan_youtube_clips if config["name"] == "youtube" else plan_instagram_clips
+        plan = planner(durations, config["max_duration"], config["num_clips_to_generate"])
+        platforms[config["name"]] = [
+            {"duration": round(sum(take for _idx, take in parts), 3),
+             "segments": [{"start": ordered[idx]["start"], "end": ordered[idx]["start"] + take, "highlight": ordered[idx]["name"]}
+                          for idx, take in parts]}
+            for parts in plan
+        ]
+    return {"highlights": highlights, "platforms": platforms}
+
+
+# === Motion model ===
+
+def motion_intervals_from_scores(motion_scores, fps, min_motion_frames=MIN_MOTION_FRAMES, std_factor=MOTION_STD_FACTOR):
+    """Runs of at least min_motion_frames frames whose motion is above mean + std_factor * std, in seconds."""
+    motion_scores = np.asarray(motion_scores)
+    if motion_scores.size == 0:
+        return []
+    threshold_score = np.mean(motion_scores) + std_factor * np.std(motion_scores)
+
+    intervals = []
+    start, count = None, 0
+    for i, score in enumerate(motion_scores):
+        if score > threshold_score:
+            if start is None:
+                start = i
+            count += 1
+        else:
+            if count >= min_motion_frames:
+                intervals.append((start / fps, (i - 1) / fps))
+            start, count = None, 0
+
+    return intervals
+
+
+def merge_intervals(intervals, max_gap=MOTION_MERGE_GAP):
+    if not intervals:
+        return []
+    merged = [intervals[0]]
+    for current in intervals[1:]:
+        prev = merged[-1]
+        if current[0] - prev[1] <= max_gap:
+            merged[-1] = (prev[0], max(prev[1], current[1]))
+        else:
+            merged.append(current)
+    return merged
+
+
+def select_main_segments(intervals, video_duration, min_clip_duration=MIN_CLIP_DURATION, max_clip_duration=MAX_CLIP_DURATION,
+                         min_total_fraction=MIN_TOTAL_FRACTION, merge_gap=MOTION_MERGE_GAP):
+    """
+    Picks the main reel: the longest valid motion segments until min_total_fraction of the video is
+    covered, returned as (start, end, duration) in chronological order.
+    """
+    min_total_duration = min_total_fraction * video_duration
+
+    # Объединяем интервалы
+    merged_intervals = merge_intervals(intervals, merge_gap)
+
+    # Фильтрация валидных клипов
+    valid_segments = []
+    for start, end in merged_intervals:
+        end = min(end + CLIP_TAIL_PADDING, video_duration)
+        duration = end - start
+        if min_clip_duration <= duration <= max_clip_duration:
+            valid_segments.append((start, end, duration))
+
+    # Отбор по убыванию длительности до набора 10%
+    valid_segments.sort(key=lambda x: x[2], reverse=True)
+
+    selected_segments_info = []
+    total_duration = 0
+    for start, end, dur in valid_segments:
+        selected_segments_info.append((start, end, dur))
+        total_duration += dur
+        if total_duration >= min_total_duration:
+            break
+
+    if not selected_segments_info:
+        raise ValueError("❌ Not enough valid highlights (3–23 sec) to build summary.")
+
+    # Chronological order for the reel
+    selected_segments_info.sort(key=lambda x: x[0])
+    return selected_segments_info
+
+
+def select_targeted_segments(all_chronological_highlight_segments, target_duration_seconds):
+    """Chronological segments that fit into target_duration_seconds (all of them if they already fit)."""
+    total_available_duration = sum(seg[2] for seg in all_chronological_highlight_segments)
+    if total_available_duration <= target_duration_seconds:
+        return list(all_chronological_highlight_segments)
+
+    selected_video_segments = []
+    current_total_duration = 0
+    for start, end, dur in all_chronological_highlight_segments:
+        if current_total_duration + dur <= target_duration_seconds:
+            selected_video_segments.append((start, end, dur))
+            current_total_duration += dur
+        else:
+            break
+    return selected_video_segments
+
+
+def select_motion_job(features, min_motion_frames=MIN_MOTION_FRAMES, std_factor=MOTION_STD_FACTOR,
+                      merge_gap=MOTION_MERGE_GAP, min_clip_duration=MIN_CLIP_DURATION,
+                      max_clip_duration=MAX_CLIP_DURATION, min_total_fraction=MIN_TOTAL_FRACTION,
+                      short_target=SHORT_VIDEO_TARGET_DURATION, story_target=STORY_VIDEO_TARGET_DURATION):
+    """Recomputes a motion job's main/short/story reels from its stored motion scores."""
+    intervals = motion_intervals_from_scores(features["motion_scores"], features["fps"], min_motion_frames, std_factor)
+    main = select_main_segments(intervals, features["duration"], min_clip_duration, max_clip_duration,
+                                min_total_fraction, merge_gap)
+    reels = {"main": main, "short": select_targeted_segments(main, short_target),
+             "story": select_targeted_segments(main, story_target)}
+    return {
+        name: {"duration": round(sum(seg[2] for seg in segments), 3),
+               "segments": [{"start": round(start, 3), "end": round(end, 3)} for start, end, _dur in segments]}
+        for name, segments in reels.items()
+    }
@@ -1,22 +1,37 @@
 import argparse
-import whisper
+import sys
 import os
 from pathlib import Path
 
-def transcribe_video(video_path: str, output_directory: str, output_format: str = "txt", model_name: str = "base"):
+# Make the shared backend modules (ml_core) importable when this file is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ml_core.transcription import ENGINES, transcribe_media
+
+# Output formats that include word-level timestamps. The cached transcript is shared by all formats
+# (ml_core/transcript_cache.py) and gains words the first time one of these is requested.
+WORD_TIMESTAMP_FORMATS = ("json",)
+
+def segment_level(result):
     """
-    Transcribes the given video file and saves the transcript.
+    The result without the segments' "words". whisper's subtitle writers cut cues at word times whenever
+    words are present; srt/vtt keep one cue per segment, so a cached transcript with words writes the
+    same files as one without.
     """
-    print(f"Loading whisper model '{model_name}'...")
-    try:
-        model = whisper.load_model(model_name)
-    except Exception as e:
-        print(f"Error loading whisper model: {e}")
-        return None
+    return {**result, "segments": [{key: value for key, value in segment.items() if key != "words"}
+                                   for segment in result.get("segments", [])]}
 
-    print(f"Transcribing video: {video_path}...")
+def transcribe_video(video_path: str, output_directory: str, output_format: str = "txt", model_name: str = "base",
+                     sharded: str = None, engine: str = None):
+    """
+    Transcribes the given video file and saves the transcript.
+    sharded: "auto", "on" or "off" - transcribe long videos in parallel shards (see ml_core.transcription).
+    engine: "fp32" or "int8" (dynamically quantized Linear layers, faster on CPU-only hosts).
+    """
+    # The model is only loaded on a transcript cache miss; a cached result goes straight to the writers
+    print(f"Transcribing video: {video_path} (whisper model '{model_name}', {engine or 'default engine'})...")
     try:
-        result = model.transcribe(video_path, verbose=False) # verbose=False to keep stdout cleaner
+        result = transcribe_media(video_path, model_name, sharded=sharded, engine=engine,
+                                  word_timestamps=output_format in WORD_TIMESTAMP_FORMATS, verbose=False) # verbose=False to keep stdout cleaner
     except Exception as e:
         print(f"Error during transcription: {e}")
         return None
@@ -45,7 +60,7 @@ def transcribe_video(video_path: str, output_directory: str, output_format: str
             # The call `writer(result, audio_path)` writes to `output_dir / Path(audio_path).stem + '.srt'`
             # So, if output_filepath is `output_dir / base_filename.srt`, this should align.
             # Let's ensure the `audio_path` argument to writer is just the filename for consistency.
-            writer(result, Path(video_path).name)
+            writer(segment_level(result), Path(video_path).name)
 
 
             # Manual SRT:
@@ -68,7 +83,7 @@ def transcribe_video(video_path: str, output_directory: str, output_format: str
             if output_format == "vtt":
                 from whisper.utils import WriteVTT
                 writer = WriteVTT(str(output_dir_path))
-                writer(result, Path(video_path).name)
+                writer(segment_level(result), Path(video_path).name)
             elif output_format == "tsv":
                 from whisper.utils import WriteTSV
                 writer = WriteTSV(str(output_dir_path))
@@ -118,7 +133,11 @@ if __name__ == "__main__":
     parser.add_argument("output_dir", help="Directory to save the transcript file.")
     parser.add_argument("--output_format", default="txt", choices=["txt", "srt", "vtt", "tsv", "json"], help="Format of the transcript (default: txt).")
     parser.add_argument("--model_name", default="base", help="Name of the Whisper model to use (e.g., tiny, base, small, medium, large).")
+    parser.add_argument("--sharded", choices=["auto", "on", "off"], default=None,
+                        help="Transcribe long videos in parallel shards split at silences (default: SHARDED_TRANSCRIPTION env or 'auto').")
+    parser.add_argument("--engine", choices=list(ENGINES), default=None,
+                        help="Inference engine: fp32 or int8 (quantized, CPU only) (default: ASR_ENGINE env or 'fp32').")
     
     args = parser.parse_args()
 
-    transcribe_video(args.input_video_path, args.output_dir, args.output_format, args.model_name)
\ No newline at end of file
+    transcribe_video(args.input_video_path, args.output_dir, args.output_format, args.model_name, args.sharded, args.engine)
\ No newline at end of file
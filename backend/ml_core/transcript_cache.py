@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import os
+
+from ml_core.cache_utils import CACHE_ROOT, DiskLRUCache, atomic_write_json, file_content_hash, payload_hash
+
+# Transcript cache settings (shared by /transcribe/video/ and the text highlight pipeline)
+TRANSCRIPT_CACHE_ENABLED = os.environ.get("TRANSCRIPT_CACHE", "on") != "off"
+TRANSCRIPT_CACHE_DIR = os.environ.get("TRANSCRIPT_CACHE_DIR", str(CACHE_ROOT / "transcripts"))
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.environ.get("TRANSCRIPT_CACHE_MAX_BYTES", str(1024 ** 3)))  # 1 GB
+
+# Bump when the stored result schema changes (e.g. new fields the writers rely on)
+TRANSCRIPT_CACHE_VERSION = 1
+
+# Options that change how a result is printed, not what it contains
+PRESENTATION_OPTIONS = {"verbose", "fp16"}
+# Not part of the key either: there is one entry per transcript, and an entry without word timestamps
+# is replaced by one with them the first time a caller asks for words (see has_word_timestamps)
+UPGRADE_OPTIONS = {"word_timestamps"}
+
+# Decode path of a transcript: whisper's own transcribe() (local or sharded). The batched ASR service
+# decodes differently (fixed windows, no temperature fallback) and keys its results with its own name.
+LOCAL_DECODER = "whisper-transcribe"
+
+
+def audio_content_hash(audio):
+    """sha256 of decoded PCM samples. Re-encoded or remuxed copies of the same audio share it."""
+    return hashlib.sha256(audio.tobytes()).hexdigest()
+
+
+def transcript_cache_key(audio_hash, model_name, engine, language=None, options=None, decoder=LOCAL_DECODER):
+    """Cache key of a transcript: audio content, model, engine, language (None = auto), decode options and decode path."""
+    decode_options = {k: v for k, v in (options or {}).items() if k not in PRESENTATION_OPTIONS | UPGRADE_OPTIONS | {"language"}}
+    return payload_hash({
+        "version": TRANSCRIPT_CACHE_VERSION,
+        "audio": audio_hash,
+        "model": model_name,
+        "engine": engine,
+        "language": language,
+        "options": decode_options,
+        "decoder": decoder,
+    })
+
+
+def has_word_timestamps(result):
+    """True if every segment of a Whisper result has its "words" (transcribed with word_timestamps=True)."""
+    return all("words" in segment for segment in result.get("segments", []))
+
+
+class TranscriptCache(DiskLRUCache):
+    """
+    LRU store of full Whisper results (text, segments, word timestamps once asked for, language) as JSON.
+    A file-hash -> audio-hash index lets repeat requests for the same upload skip audio decoding.
+    """
+
+    def __init__(self, root=TRANSCRIPT_CACHE_DIR, max_bytes=TRANSCRIPT_CACHE_MAX_BYTES, enabled=TRANSCRIPT_CACHE_ENABLED):
+        super().__init__(root, max_bytes, suffix=".json")
+        self.enabled = enabled
+        self.index_dir = self.root / "audio_index"
+
+    def audio_hash_for_file(self, path):
+        """Returns the audio hash recorded for this file's content, or None if it was never decoded."""
+        try:
+            with open(self.index_dir / f"{file_content_hash(path)}.txt", "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def remember_audio_hash(self, path, audio):
+        audio_hash = audio_content_hash(audio)
+        try:
+            index_path = self.index_dir / f"{file_content_hash(path)}.txt"
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+            index_path.write_text(audio_hash, encoding="utf-8")
+        except OSError as e:
+            logging.warning(f"Could not record audio hash for {path}: {e}")
+        return audio_hash
+
+    def load(self, key):
+        if not self.enabled:
+            return None
+        entry_path = self.get(key)
+        if entry_path is None:
+            return None
+        try:
+            with open(entry_path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        logging.info(f"Transcript cache hit: {key[:12]}")
+        return result
+
+    def store(self, key, result):
+        if not self.enabled:
+            return None
+        entry_path = self.path_for(key)
+        try:
+            atomic_write_json(entry_path, result)
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning(f"Could not store transcript {key[:12]}: {e}")
+            return None
+        self.evict()
+        return entry_path
@@ -0,0 +1,461 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import whisper
+
+from ml_core.cpu_budget import apply_thread_allotment, thread_allotment
+from ml_core.transcript_cache import (
+    LOCAL_DECODER, TranscriptCache, audio_content_hash, has_word_timestamps, transcript_cache_key
+)
+
+SAMPLE_RATE = whisper.audio.SAMPLE_RATE  # 16 kHz mono, what Whisper expects
+
+# Sharded transcription: "auto" shards audio of at least SHARDED_MIN_DURATION seconds when
+# more than one core is available, "on"/"off" force it.
+SHARDED_TRANSCRIPTION_MODE = os.environ.get("SHARDED_TRANSCRIPTION", "auto")
+SHARDED_MIN_DURATION = float(os.environ.get("SHARDED_MIN_DURATION", str(15 * 60)))
+SHARD_TARGET_SECONDS = float(os.environ.get("SHARD_TARGET_SECONDS", str(5 * 60)))
+SHARD_SEARCH_SECONDS = 20.0  # how far from the target cut point we look for silence
+SHARD_OVERLAP_SECONDS = 1.0
+
+VAD_FRAME_SECONDS = 0.03
+
+# Sparse transcription: only windows around candidate anchors (audio peaks, scene cuts) are decoded.
+# Windows are padded so that whole sentences around an anchor end up in the transcript.
+SPARSE_TRANSCRIPTION_MODE = os.environ.get("SPARSE_TRANSCRIPTION", "off")
+SPARSE_WINDOW_PADDING = float(os.environ.get("SPARSE_WINDOW_PADDING", "15"))
+SPARSE_MERGE_GAP = 5.0  # windows closer than this are decoded as one
+SPARSE_MIN_SPEECH_FRACTION = 0.05  # windows with less detected speech than this are skipped
+SPARSE_MAX_COVERAGE = float(os.environ.get("SPARSE_MAX_COVERAGE", "0.8"))  # above this a full pass is cheaper
+
+# Inference engines: "fp32" is plain Whisper, "int8" dynamically quantizes the Linear layers
+# (attention projections and MLPs, most of the CPU time) to int8 weights for CPU inference.
+ENGINES = ("fp32", "int8")
+DEFAULT_ENGINE = os.environ.get("ASR_ENGINE", "fp32")
+
+_MODELS = {}
+_WORKER_MODEL = None
+
+
+def quantize_model_int8(model):
+    """
+    Quantizes the Linear layers of a Whisper model to int8 (dynamic quantization) and returns it.
+    Works in place: the model passed in is moved to the CPU in fp32 and its Linear layers are
+    replaced, so only pass a model nothing else uses (load_model loads a fresh one for this).
+    Whisper uses its own Linear subclass (casts the weight to the input dtype), which torch's
+    quantizer does not recognize, so those layers are turned back into plain nn.Linear first;
+    in fp32 on CPU both compute the same thing.
+    """
+    import torch
+
+    model = model.cpu().float()
+    for module in model.modules():
+        if isinstance(module, whisper.model.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_model(model_name="base", engine=None):
+    """Loads a Whisper model once per process and engine (fp32, or int8 quantized on the CPU)."""
+    engine = engine or DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown ASR engine '{engine}', expected one of {ENGINES}")
+    key = (model_name, engine)
+    if key not in _MODELS:
+        logging.info(f"Loading whisper model '{model_name}' ({engine})...")
+        if engine == "int8":
+            model = whisper.load_model(model_name, device="cpu")
+            _MODELS[key] = quantize_model_int8(model)
+        else:
+            _MODELS[key] = whisper.load_model(model_name)
+    return _MODELS[key]
+
+
+def transcribe_options(engine=None, **options):
+    """Default decode options for an engine. The int8 model only runs in fp32 activations on the CPU."""
+    engine = engine or DEFAULT_ENGINE
+    if engine == "int8":
+        return {**options, "fp16": False}
+    return options
+
+
+def load_audio(path):
+    """
+    Decodes the audio track of a media file to 16 kHz mono float32 PCM. If the analysis pass
+    already ran for this file, its stored PCM is used instead of decoding again.
+    """
+    from ml_core.analysis import existing_feature_index  # analysis imports this module
+    index = existing_feature_index(path)
+    if index is not None:
+        return index.audio()
+    return whisper.load_audio(str(path))
+
+
+def frame_energy_db(audio, frame_seconds=VAD_FRAME_SECONDS):
+    """RMS energy in dB for consecutive non-overlapping frames of the PCM signal."""
+    frame_length = max(1, int(SAMPLE_RATE * frame_seconds))
+    frame_count = len(audio) // frame_length
+    if frame_count == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = audio[:frame_count * frame_length].reshape(frame_count, frame_length)
+    rms = np.sqrt(np.mean(frames.astype(np.float32) ** 2, axis=1))
+    return 20 * np.log10(rms + 1e-10)
+
+
+def energy_vad(audio, frame_seconds=VAD_FRAME_SECONDS):
+    """
+    Simple energy voice-activity detection. A frame counts as speech when it is clearly above the
+    noise floor (10th percentile) and not far below the loudest part of the file.
+    Returns a boolean array with one entry per frame.
+    """
+    energy = frame_energy_db(audio, frame_seconds)
+    if energy.size == 0:
+        return np.zeros(0, dtype=bool)
+    threshold = max(np.percentile(energy, 10) + 10.0, energy.max() - 50.0)
+    return energy > threshold
+
+
+def find_shard_cuts(audio, target_seconds=SHARD_TARGET_SECONDS, search_seconds=SHARD_SEARCH_SECONDS):
+    """
+    Picks cut points (in seconds) roughly every target_seconds, each moved to the quietest spot
+    within +/- search_seconds, so shard boundaries fall into pauses instead of mid-word.
+    """
+    duration = len(audio) / SAMPLE_RATE
+    if duration <= target_seconds * 1.5:
+        return []
+
+    energy = frame_energy_db(audio)
+    # Smooth over ~300 ms so a single quiet frame inside a word is not picked as a pause
+    smoothing = max(1, int(0.3 / VAD_FRAME_SECONDS))
+    smoothed = np.convolve(energy, np.ones(smoothing) / smoothing, mode="same")
+
+    cuts = []
+    target = target_seconds
+    while target < duration - target_seconds / 2:
+        lo = max(0, int((target - search_seconds) / VAD_FRAME_SECONDS))
+        hi = min(len(smoothed), int((target + search_seconds) / VAD_FRAME_SECONDS))
+        if hi <= lo:
+            break
+        quietest = lo + int(np.argmin(smoothed[lo:hi]))
+        # Cut in the middle of the pause that contains the quietest frame
+        quiet_level = smoothed[quietest] + 3.0
+        run_start, run_end = quietest, quietest
+        while run_start > lo and smoothed[run_start - 1] <= quiet_level:
+            run_start -= 1
+        while run_end < hi - 1 and smoothed[run_end + 1] <= quiet_level:
+            run_end += 1
+        cut = (run_start + run_end) / 2 * VAD_FRAME_SECONDS
+        cuts.append(cut)
+        target = cut + target_seconds
+    return cuts
+
+
+def plan_shards(audio, target_seconds=SHARD_TARGET_SECONDS, overlap_seconds=SHARD_OVERLAP_SECONDS):
+    """
+    Returns a list of shards as dicts with the decoded window (start/end, including overlap) and the
+    core range (core_start/core_end, between silence cuts) that the shard is responsible for.
+    """
+    duration = len(audio) / SAMPLE_RATE
+    boundaries = [0.0] + find_shard_cuts(audio, target_seconds) + [duration]
+    shards = []
+    for core_start, core_end in zip(boundaries[:-1], boundaries[1:]):
+        shards.append({
+            "start": max(0.0, core_start - overlap_seconds),
+            "end": min(duration, core_end + overlap_seconds),
+            "core_start": core_start,
+            "core_end": core_end,
+        })
+    return shards
+
+
+def offset_result(result, offset_seconds):
+    """Shifts all segment (and word) timestamps of a Whisper result by offset_seconds, in place."""
+    for segment in result.get("segments", []):
+        segment["start"] += offset_seconds
+        segment["end"] += offset_seconds
+        if "seek" in segment:
+            # seek is measured in mel frames (10 ms each)
+            segment["seek"] += int(round(offset_seconds * 100))
+        for word in segment.get("words", []) or []:
+            word["start"] += offset_seconds
+            word["end"] += offset_seconds
+    return result
+
+
+def merge_shard_results(shard_results, shards):
+    """
+    Stitches per-shard Whisper results back into one result with the usual schema.
+    Each shard keeps only the segments whose midpoint lies in its core range; segments that still
+    overlap the previously kept one by more than half (seam duplicates) are dropped.
+    """
+    segments = []
+    languages = []
+    for result, shard in zip(shard_results, shards):
+        if result.get("language"):
+            languages.append(result["language"])
+        for segment in result.get("segments", []):
+            midpoint = (segment["start"] + segment["end"]) / 2
+            if not (shard["core_start"] <= midpoint < shard["core_end"]):
+                continue
+            if segments:
+                previous = segments[-1]
+                overlap = min(previous["end"], segment["end"]) - max(previous["start"], segment["start"])
+                if overlap > 0.5 * max(segment["end"] - segment["start"], 1e-6):
+                    continue
+            segments.append(segment)
+
+    for index, segment in enumerate(segments):
+        segment["id"] = index
+
+    language = max(set(languages), key=languages.count) if languages else None
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": language,
+    }
+
+
+def plan_sparse_windows(anchors, duration, speech=None, padding=SPARSE_WINDOW_PADDING, merge_gap=SPARSE_MERGE_GAP,
+                        min_speech_fraction=SPARSE_MIN_SPEECH_FRACTION):
+    """
+    Turns candidate anchor times (seconds) into a sorted list of (start, end) windows to transcribe:
+    each anchor is padded on both sides, overlapping or nearly touching windows are merged, and
+    windows with (almost) no speech according to the VAD mask are dropped.
+    """
+    windows = []
+    for anchor in sorted(a for a in anchors if 0 <= a <= duration):
+        start, end = max(0.0, anchor - padding), min(duration, anchor + padding)
+        if windows and start - windows[-1][1] <= merge_gap:
+            windows[-1][1] = max(windows[-1][1], end)
+        else:
+            windows.append([start, end])
+
+    if speech is not None and len(speech):
+        kept = []
+        for start, end in windows:
+            frames = speech[int(start / VAD_FRAME_SECONDS):int(end / VAD_FRAME_SECONDS) + 1]
+            if frames.size and frames.mean() >= min_speech_fraction:
+                kept.append([start, end])
+        windows = kept
+    return [(start, end) for start, end in windows]
+
+
+def window_coverage(windows, duration):
+    """Fraction of the timeline covered by the windows."""
+    return sum(end - start for start, end in windows) / duration if duration else 0.0
+
+
+def _report_new_segments(on_segments, shard_results, shards, reported):
+    """
+    Calls on_segments(new segments, processed_until) with the merged segments of the leading finished
+    shards that were not reported yet; returns how many are reported now. Merging the prefix again
+    keeps the seam de-duplication exactly as in the final merge_shard_results.
+    """
+    segments = merge_shard_results(shard_results, shards[:len(shard_results)])["segments"]
+    if len(segments) > reported or len(shard_results) == len(shards):
+        on_segments(segments[reported:], shards[len(shard_results) - 1]["core_end"])
+    return len(segments)
+
+
+def transcribe_windows(audio, windows, model_name="base", engine=None, on_segments=None, **options):
+    """
+    Transcribes only the given (start, end) windows of the PCM signal and returns one result with
+    Whisper's usual schema, with all timestamps mapped back to the source timeline.
+    on_segments(segments, processed_until) is called with the new segments after every window.
+    """
+    model = load_model(model_name, engine)
+    apply_thread_allotment()
+    options = transcribe_options(engine, **options)
+    shards = [{"core_start": start, "core_end": end} for start, end in windows]
+    window_results = []
+    reported = 0
+    for start, end in windows:
+        window = audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)]
+        window_results.append(offset_result(model.transcribe(window, **options), start))
+        if on_segments is not None:
+            reported = _report_new_segments(on_segments, window_results, shards, reported)
+
+    result = merge_shard_results(window_results, shards)
+    result["windows"] = [[round(start, 3), round(end, 3)] for start, end in windows]
+    return result
+
+
+def _init_low_priority_worker(model_name, engine):
+    # Lowest CPU priority: this pass only fills in keywords and must not slow down the main pass
+    os.nice(19)
+    _init_transcription_worker(model_name, max(1, thread_allotment() // 2), engine)
+
+
+def _transcribe_text(audio, options):
+    return _WORKER_MODEL.transcribe(audio, **options)["text"]
+
+
+def start_low_priority_transcription(audio, model_name="tiny", engine=None, **options):
+    """
+    Starts a full-text transcription of the PCM signal in a niced background process and returns a
+    Future with the transcript text. Used for the keyword pass of sparse transcription.
+    """
+    context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(max_workers=1, mp_context=context,
+                                   initializer=_init_low_priority_worker, initargs=(model_name, engine))
+    future = executor.submit(_transcribe_text, audio, {"fp16": False, **transcribe_options(engine, **options)})
+    # Do not block here; the worker exits once the submitted pass is done
+    executor.shutdown(wait=False)
+    return future
+
+
+def _init_transcription_worker(model_name, threads, engine=None):
+    global _WORKER_MODEL
+    import torch
+    torch.set_num_threads(threads)
+    _WORKER_MODEL = load_model(model_name, engine)
+
+
+def _transcribe_shard(audio_window, offset_seconds, options):
+    result = _WORKER_MODEL.transcribe(audio_window, **options)
+    return offset_result(result, offset_seconds)
+
+
+def transcribe_sharded(audio, model_name="base", workers=None, shard_seconds=SHARD_TARGET_SECONDS,
+                       overlap_seconds=SHARD_OVERLAP_SECONDS, engine=None, on_segments=None, **options):
+    """
+    Transcribes long audio in parallel: the PCM is split at silences into overlapping windows,
+    each window is transcribed by a worker process holding a warm model, and the timestamps are
+    merged and de-duplicated at the seams. on_segments(segments, processed_until) is called with the
+    new segments in timeline order whenever the next shard of the timeline is done.
+    """
+    shards = plan_shards(audio, shard_seconds, overlap_seconds)
+    workers = max(1, min(workers or thread_allotment(), len(shards)))
+    threads = max(1, thread_allotment() // workers)
+    options = {"fp16": False, **transcribe_options(engine, **options)}
+    logging.info(f"Transcribing {len(audio) / SAMPLE_RATE:.1f}s of audio in {len(shards)} shards with {workers} workers ({engine or DEFAULT_ENGINE}).")
+
+    # spawn: forking a process that already initialized torch threads can deadlock
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_transcription_worker, initargs=(model_name, threads, engine)) as executor:
+        futures = []
+        for shard in shards:
+            window = audio[int(shard["start"] * SAMPLE_RATE):int(shard["end"] * SAMPLE_RATE)]
+            futures.append(executor.submit(_transcribe_shard, window, shard["start"], options))
+        shard_results = []
+        reported = 0
+        for future in futures:
+            shard_results.append(future.result())
+            if on_segments is not None:
+                reported = _report_new_segments(on_segments, shard_results, shards, reported)
+
+    return merge_shard_results(shard_results, shards)
+
+
+def should_shard(duration, mode=None):
+    mode = mode or SHARDED_TRANSCRIPTION_MODE
+    if mode == "on":
+        return True
+    if mode == "off":
+        return False
+    return duration >= SHARDED_MIN_DURATION and thread_allotment() >= 2
+
+
+def _transcript_cache_lookup(cache, source, model_name, engine, options, decoder=LOCAL_DECODER):
+    """
+    Returns (cache_key, cached_result, audio, audio_hash); audio is only decoded if the file is not indexed yet.
+    A cached transcript without word timestamps is a miss for a caller that asks for them: the result
+    transcribed for it replaces the entry, which then serves every caller.
+    """
+    is_path = isinstance(source, (str, os.PathLike))
+    audio = None if is_path else source
+    if is_path:
+        audio_hash = cache.audio_hash_for_file(source)
+        if audio_hash is None:
+            audio = load_audio(source)
+            audio_hash = cache.remember_audio_hash(source, audio)
+    else:
+        audio_hash = audio_content_hash(audio)
+    cache_key = transcript_cache_key(audio_hash, model_name, engine, options.get("language"), options, decoder)
+    cached = cache.load(cache_key)
+    if cached is not None and options["word_timestamps"] and not has_word_timestamps(cached):
+        logging.info(f"Cached transcript {cache_key[:12]} has no word timestamps; transcribing again with them")
+        cached = None
+    return cache_key, cached, audio, audio_hash
+
+
+def _decoder():
+    """Decode path a transcription started now would take (the batched service when it is running)."""
+    from ml_core.asr_service import ASR_SERVICE_DECODER, service_available  # asr_service imports this module
+    return ASR_SERVICE_DECODER if service_available() else LOCAL_DECODER
+
+
+def cached_transcript(source, model_name="base", engine=None, word_timestamps=False, **options):
+    """Returns the cached full transcript of a media file or PCM array, or None. Never runs ASR."""
+    cache = TranscriptCache()
+    if not cache.enabled:
+        return None
+    options["word_timestamps"] = word_timestamps
+    return _transcript_cache_lookup(cache, source, model_name, engine or DEFAULT_ENGINE, options, _decoder())[1]
+
+
+def transcribe_media(source, model_name="base", sharded=None, workers=None, engine=None, use_cache=True,
+                     on_segments=None, word_timestamps=False, **options):
+    """
+    Transcribes a media file (path) or decoded 16 kHz PCM (numpy array) and returns a result with
+    Whisper's usual schema (text, segments, language). Long inputs are transcribed in parallel shards.
+    engine selects fp32 or the int8 quantized CPU model (default: ASR_ENGINE env, fp32).
+    word_timestamps: also align every word (an extra pass per segment), only for writers that use them.
+    on_segments(segments, processed_until): receives the segments in timeline order while a sharded
+    transcription runs; cached, service and single-pass transcripts arrive in one call at the end.
+
+    Results are cached by audio content, model, engine, language and decode path (local whisper or the
+    batched service), so the text pipeline and /transcribe/video/ share one transcript; for a known file
+    not even the audio is decoded again. An entry gains word timestamps the first time a caller asks.
+    """
+    engine = engine or DEFAULT_ENGINE
+    options["word_timestamps"] = word_timestamps
+    from ml_core.asr_service import ASR_SERVICE_DECODER, service_available, transcribe_via_service  # asr_service imports this module
+    use_service = service_available()
+
+    cache = TranscriptCache() if use_cache else None
+    audio = None if isinstance(source, (str, os.PathLike)) else source
+    cache_key = audio_hash = None
+    if cache is not None and cache.enabled:
+        cache_key, cached, audio, audio_hash = _transcript_cache_lookup(
+            cache, source, model_name, engine, options, ASR_SERVICE_DECODER if use_service else LOCAL_DECODER)
+        if cached is not None:
+            if on_segments is not None:
+                on_segments(cached.get("segments", []), float("inf"))
+            return cached
+
+    if audio is None:
+        audio = load_audio(source)
+    duration = len(audio) / SAMPLE_RATE
+
+    result = None
+    if use_service:
+        # Concurrent jobs share the batched service instead of each running the model at batch size 1
+        try:
+            result = transcribe_via_service(audio, model_name, engine, **options)
+        except (OSError, EOFError, RuntimeError) as e:
+            logging.warning(f"ASR service unavailable, transcribing locally: {e}")
+            if cache_key is not None:
+                # The local result is cached under its own decode path
+                cache_key = transcript_cache_key(audio_hash, model_name, engine, options.get("language"), options)
+
+    if result is None and should_shard(duration, sharded):
+        result = transcribe_sharded(audio, model_name, workers, engine=engine, on_segments=on_segments, **options)
+    else:
+        if result is None:
+            model = load_model(model_name, engine)
+            apply_thread_allotment()
+            result = model.transcribe(audio, **transcribe_options(engine, **options))
+        if on_segments is not None:
+            on_segments(result.get("segments", []), duration)
+
+    if cache_key is not None:
+        stored = None if word_timestamps else cache.load(cache_key)
+        # A concurrent caller may have stored the transcript with words meanwhile; keep that one
+        if stored is None or not has_word_timestamps(stored):
+            cache.store(cache_key, result)
+    return result
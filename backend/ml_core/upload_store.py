@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from ml_core.cache_utils import CACHE_ROOT, HASH_CHUNK_SIZE, PROJECT_ROOT, atomic_write_json, file_lock, remember_content_hash
+
+# Uploaded videos (same directory /upload/video/ writes to); server_file_path values are relative to PROJECT_ROOT
+UPLOADED_VIDEOS_DIR = PROJECT_ROOT / "uploaded_videos"
+ALLOWED_VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv', '.wmv']
+
+# Resumable uploads: every session stages its bytes in UPLOAD_SESSIONS_DIR/<upload_id>/data until it
+# is finalized. Sessions untouched for UPLOAD_SESSION_TTL seconds are removed.
+UPLOAD_SESSIONS_DIR = CACHE_ROOT / "upload_sessions"
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", str(24 * 3600)))
+# sha256 of every stored upload -> its server_file_path, so a re-upload of the same video is detected
+UPLOAD_INDEX_DIR = CACHE_ROOT / "upload_index"
+
+# Running sha256 of the staged bytes per session, {upload_id: (offset, hash object)}. It lives in the
+# API process; after a restart the staged bytes are hashed once when the session continues.
+_running_hashes = {}
+
+
+def session_dir(upload_id):
+    return UPLOAD_SESSIONS_DIR / upload_id
+
+
+def create_session(filename, length=None):
+    """Starts a resumable upload. length (bytes) is optional; without it, finalize accepts what arrived."""
+    cleanup_stale_sessions()
+    upload_id = str(uuid.uuid4())
+    directory = session_dir(upload_id)
+    directory.mkdir(parents=True)
+    (directory / "data").touch()
+    session = {"upload_id": upload_id, "filename": filename, "extension": os.path.splitext(filename)[1].lower(),
+               "length": length, "offset": 0, "created": time.time()}
+    save_session(session)
+    _running_hashes[upload_id] = (0, hashlib.sha256())
+    return session
+
+
+def load_session(upload_id):
+    """The session's metadata, or None for unknown (or malformed) ids."""
+    try:
+        if str(uuid.UUID(upload_id)) != upload_id:
+            return None
+        with open(session_dir(upload_id) / "session.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return None
+
+
+def save_session(session):
+    atomic_write_json(session_dir(session["upload_id"]) / "session.json", session)
+
+
+def running_hash(session):
+    """The sha256 object of the staged bytes, rebuilt from disk if this process did not see them arrive."""
+    offset, digest = _running_hashes.get(session["upload_id"], (None, None))
+    if offset != session["offset"]:
+        logging.info(f"Rehashing {session['offset']} staged bytes of upload {session['upload_id']}")
+        digest = hashlib.sha256()
+        with open(session_dir(session["upload_id"]) / "data", "rb") as f:
+            remaining = session["offset"]
+            while remaining > 0:
+                block = f.read(min(HASH_CHUNK_SIZE, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+        _running_hashes[session["upload_id"]] = (session["offset"], digest)
+    return digest
+
+
+def advance_running_hash(session, digest):
+    _running_hashes[session["upload_id"]] = (session["offset"], digest)
+
+
+def discard_session(upload_id):
+    _running_hashes.pop(upload_id, None)
+    shutil.rmtree(session_dir(upload_id), ignore_errors=True)
+
+
+def cleanup_stale_sessions():
+    if not UPLOAD_SESSIONS_DIR.exists():
+        return
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for directory in UPLOAD_SESSIONS_DIR.iterdir():
+        try:
+            if (directory / "session.json").stat().st_mtime < cutoff:
+                logging.info(f"Removing stale upload session {directory.name}")
+                discard_session(directory.name)
+        except OSError:
+            continue
+
+
+def server_file_path(path):
+    return str(path.relative_to(PROJECT_ROOT))
+
+
+def store_upload(path, content_hash, extension):
+    """
+    Keeps a completely received upload unless the same content is already stored. path may be a staged
+    file (moved into UPLOADED_VIDEOS_DIR) or a file already there. Returns (stored path, duplicate).
+    """
+    index_path = UPLOAD_INDEX_DIR / f"{content_hash}.json"
+    with file_lock(UPLOAD_INDEX_DIR / f"{content_hash}.lock"):
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                existing = PROJECT_ROOT / json.load(f)["server_file_path"]
+            if existing.is_file() and existing.resolve() != path.resolve():
+                path.unlink()
+                return existing, True
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if path.parent.resolve() != UPLOADED_VIDEOS_DIR.resolve():
+            UPLOADED_VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
+            stored = UPLOADED_VIDEOS_DIR / f"{uuid.uuid4()}{extension}"
+            shutil.move(str(path), stored)
+            path = stored
+        remember_content_hash(path, content_hash)
+        atomic_write_json(index_path, {"server_file_path": server_file_path(path), "sha256": content_hash})
+    return path, False
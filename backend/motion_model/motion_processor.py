@@ -14,43 +14,79 @@
 # sudo apt-get install -y ffmpeg imagemagick
 
 import os
+import sys
 import shutil
 import tempfile
+from pathlib import Path
 import cv2
-import yt_dlp
 import numpy as np
 from moviepy.editor import VideoFileClip
 from moviepy.editor import concatenate_videoclips
 from moviepy.editor import vfx
 from moviepy.audio.AudioClip import AudioArrayClip
 
+# Make the shared backend modules (ml_core) importable when this file is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from concurrent.futures import ProcessPoolExecutor
+from ml_core.analysis import ANALYSIS_INDEX_ENABLED, load_feature_index
+from ml_core.chunked_encode import concat_chunks, encode_chunked, x264_output_params
+from ml_core.cpu_budget import apply_thread_allotment, thread_allotment
+from ml_core.cache_utils import file_content_hash
+from ml_core.checkpoints import file_fingerprint, run_stage
+from ml_core.download_cache import DOWNLOAD_PROFILES, download_profile
+from ml_core.previews import preview_recipes
+from ml_core.render_recipes import persist_source, publish_job_outputs, record_recipes
+from ml_core.segment_cache import SegmentCache, segment_cache_key
+from ml_core.selection import (
+    SHORT_VIDEO_TARGET_DURATION, STORY_VIDEO_TARGET_DURATION, motion_intervals_from_scores, select_main_segments,
+    select_targeted_segments, write_selection_features
+)
+
 # Target dimensions for output videos
 PORTRAIT_DIMENSIONS = (1080, 1920)  # width, height (9:16)
 LANDSCAPE_DIMENSIONS = (1920, 1080) # width, height (16:9)
+REEL_ORIENTATIONS = {"portrait": PORTRAIT_DIMENSIONS, "landscape": LANDSCAPE_DIMENSIONS}
 
 # Target dimensions for Instagram frames (4:5 aspect ratio)
 INSTAGRAM_FRAME_WIDTH = 1080
 INSTAGRAM_FRAME_HEIGHT = 1350 # 1080 * 5/4
 
-SHORT_VIDEO_TARGET_DURATION = 58 # Max duration for the short highlight video in seconds
-STORY_VIDEO_TARGET_DURATION = 15 # Max duration for the Instagram Story highlight video in seconds
-
 BASE_OUTPUT_DIR = "url_test" # Consistent with process_video.py structure
 
+# Chunked (parallel) encoding of long reels: "auto" enables it for reels of at least
+# CHUNKED_ENCODE_MIN_DURATION seconds on machines with 4+ cores, "on"/"off" force it.
+# By default reels are built from per-segment renders (save_timeline_from_segments), where this mode
+# only decides how many segments render in parallel; the GOP-aligned chunked encode itself is the
+# fallback used when the rendered-segment cache is off (SEGMENT_CACHE=off).
+CHUNKED_ENCODE_MODE = os.environ.get("CHUNKED_ENCODE", "auto")
+CHUNKED_ENCODE_MIN_DURATION = float(os.environ.get("CHUNKED_ENCODE_MIN_DURATION", "120"))
+
+# Identifies how reel segments are encoded (part of the rendered-segment cache key)
+MOTION_SEGMENT_ENCODE_PROFILE = "moviepy-libx264-medium-closedgop-videoonly-v1"
+
 # === 1. СКАЧИВАНИЕ ВИДЕО ===
-def download_video(url, output_path="input/video.mp4"):
-    ydl_opts = {
-        'format': 'best[ext=mp4]',
-        'outtmpl': output_path,
-        'quiet': True
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-    return output_path
+def download_video(url, output_path="input/video.mp4", profile="full"):
+    # Served from the shared download cache when this video (same id and format) was fetched before,
+    # e.g. by the text pipeline; returns the actual path (its extension is the downloaded format's).
+    # profile: "full" quality or the low-resolution "analysis" stream (see download_cache.DOWNLOAD_PROFILES)
+    output_dir, output_name = os.path.split(output_path)
+    downloaded_path, _info = download_profile(url, output_dir or ".", profile, {'quiet': True},
+                                              filename=os.path.splitext(output_name)[0])
+    return downloaded_path
 
 # === 2. АНАЛИЗ ДВИЖЕНИЯ (OpenCV) ===
-def detect_motion_intervals(video_path, min_motion_frames=3):
+def detect_motion_scores(video_path):
+    """Motion energy per frame transition and the video fps, from the shared feature index when enabled."""
+    apply_thread_allotment()
+    if ANALYSIS_INDEX_ENABLED:
+        try:
+            index = load_feature_index(video_path)
+            return index.motion_scores(), index.fps
+        except Exception as e:
+            print(f"⚠️ Feature index unavailable, analyzing motion directly: {e}")
+
     cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
     motion_scores = []
     prev_frame = None
 
@@ -71,82 +107,35 @@ def detect_motion_intervals(video_path, min_motion_frames=3):
         prev_frame = gray
 
     cap.release()
+    return np.array(motion_scores), fps
 
-    motion_scores = np.array(motion_scores)
-    mean_score = np.mean(motion_scores)
-    std_score = np.std(motion_scores)
-    threshold_score = mean_score + 0.2 * std_score
-
-    intervals = []
-    start, count = None, 0
-    for i, score in enumerate(motion_scores):
-        if score > threshold_score:
-            if start is None:
-                start = i
-            count += 1
-        else:
-            if count >= min_motion_frames:
-                intervals.append((start / 30, (i - 1) / 30))
-            start, count = None, 0
-
-    return intervals
-
-# === 2.5 ОБЪЕДИНЕНИЕ БЛИЗКИХ ИНТЕРВАЛОВ ===
-def merge_intervals(intervals, max_gap=1.0):
-    if not intervals:
-        return []
-    merged = [intervals[0]]
-    for current in intervals[1:]:
-        prev = merged[-1]
-        if current[0] - prev[1] <= max_gap:
-            merged[-1] = (prev[0], max(prev[1], current[1]))
-        else:
-            merged.append(current)
-    return merged
+
+def analyze_motion(video_path):
+    """Motion curve, fps and duration of a video: the checkpointed "motion" stage of a job."""
+    motion_scores, fps = detect_motion_scores(video_path)
+    with VideoFileClip(video_path) as probe_clip:
+        duration = probe_clip.duration
+    return {"motion_scores": motion_scores.tolist(), "dtype": str(motion_scores.dtype), "fps": float(fps), "duration": duration}
+
+
+def detect_motion_intervals(video_path, min_motion_frames=3):
+    motion_scores, fps = detect_motion_scores(video_path)
+    return motion_intervals_from_scores(motion_scores, fps, min_motion_frames)
 
 # === 3. СОЗДАНИЕ ХАЙЛАЙТ ВИДЕО ===
 def create_highlight_video(video_path, intervals):
     base_clip = VideoFileClip(video_path)
-    video_duration = base_clip.duration
-    min_total_duration = 0.1 * video_duration
-    min_clip_duration = 1  # Lowered minimum
-    max_clip_duration = 25 # Optionally increased maximum
-
-    # Объединяем интервалы
-    merged_intervals = merge_intervals(intervals)
-
-    # Фильтрация валидных клипов
-    valid_segments = []
-    for start, end in merged_intervals:
-        end = min(end + 0.3, base_clip.duration)
-        duration = end - start
-        if min_clip_duration <= duration <= max_clip_duration:
-            valid_segments.append((start, end, duration))
-
-    # Отбор по убыванию длительности до набора 10%
-    valid_segments.sort(key=lambda x: x[2], reverse=True)
-
-    selected_segments_info = [] # To store (start, end, dur) of selected segments
-    total_duration = 0
-    # First, select segments based on duration
-    for start, end, dur in valid_segments:
-        selected_segments_info.append((start, end, dur))
-        total_duration += dur
-        if total_duration >= min_total_duration:
-            break
-
-    if not selected_segments_info:
-        raise ValueError("❌ Not enough valid highlights (3–23 sec) to build summary.")
-
-    # Now, sort the selected_segments_info by their original start time (chronological order)
-    # x[0] corresponds to the 'start' time of the segment.
-    selected_segments_info.sort(key=lambda x: x[0])
+    # Longest segments up to 10% of the video, in chronological order (raises ValueError if there are none)
+    selected_segments_info = select_main_segments(intervals, base_clip.duration)
 
     # Create subclips in chronological order
-    subclips = []
-    for start, end, dur in selected_segments_info: # dur is not strictly needed here but kept for consistency
-        subclips.append(base_clip.subclip(start, end))
+    final_clip = concatenate_segments(base_clip, selected_segments_info)
+    
+    return final_clip, selected_segments_info # Return segments for frame extraction
 
+def concatenate_segments(base_clip, segments):
+    """Concatenates (start, end, duration) segments of base_clip, adding a silent track if there is no audio."""
+    subclips = [base_clip.subclip(start, end) for start, end, _dur in segments]
     final_clip = concatenate_videoclips(subclips, method='chain')
 
     # Обработка звука
@@ -154,8 +143,7 @@ def create_highlight_video(video_path, intervals):
         sr = 44100
         silence = AudioArrayClip(np.zeros((int(final_clip.duration * sr), 2)), fps=sr)
         final_clip = final_clip.set_audio(silence)
-    
-    return final_clip, selected_segments_info # Return segments for frame extraction
+    return final_clip
 
 # === 3.5 СОЗДАНИЕ ХАЙЛАЙТ ВИДЕО С ЦЕЛЕВОЙ ДЛИТЕЛЬНОСТЬЮ ===
 def create_targeted_duration_highlight_video(video_path, all_chronological_highlight_segments, target_duration_seconds, video_type_name="highlight"):
@@ -175,56 +163,27 @@ def create_targeted_duration_highlight_video(video_path, all_chronological_highl
                The concatenated highlight video clip, or None if no clips are selected.
                A list of (start, end, duration) tuples for the segments included in the video.
     """
-    base_clip = VideoFileClip(video_path)
-    selected_video_segments = []
-    current_total_duration = 0
-
-    # Calculate total duration of all available highlight segments
-    total_available_duration = sum(seg[2] for seg in all_chronological_highlight_segments)
-
     if not all_chronological_highlight_segments:
         print(f"⚠️ No highlight segments provided to create_targeted_duration_highlight_video for {video_type_name} video. Cannot create reel.")
-        if base_clip: base_clip.close()
         return None, []
 
-    # "Little Material" Case: If total duration of all clips is already less than or equal to target
+    # Calculate total duration of all available highlight segments
+    total_available_duration = sum(seg[2] for seg in all_chronological_highlight_segments)
     if total_available_duration <= target_duration_seconds:
+        # "Little Material" Case: all clips fit into the target
         print(f"ℹ️ Total duration of all highlights ({total_available_duration:.2f}s) is within target ({target_duration_seconds}s) for {video_type_name} video. Using all clips.")
-        selected_video_segments = list(all_chronological_highlight_segments) # Use a copy
     else:
-        # "Too Much Material" Case: Iterate and add clips chronologically until target duration is approached
+        # "Too Much Material" Case: clips are added chronologically until the next one would exceed the target
         print(f"ℹ️ Total duration of all highlights ({total_available_duration:.2f}s) exceeds target ({target_duration_seconds}s) for {video_type_name} video. Selecting clips chronologically.")
-        for start, end, dur in all_chronological_highlight_segments: # These are already chronologically sorted
-            if current_total_duration + dur <= target_duration_seconds:
-                selected_video_segments.append((start, end, dur))
-                current_total_duration += dur
-            else:
-                # Next clip would exceed the target duration
-                print(f"  Stopping clip addition for {video_type_name} video: current total {current_total_duration:.2f}s, next clip {dur:.2f}s would exceed {target_duration_seconds}s.")
-                break
+    selected_video_segments = select_targeted_segments(all_chronological_highlight_segments, target_duration_seconds)
     
     if not selected_video_segments:
         print(f"⚠️ No clips selected for the {video_type_name} highlight video (e.g., all individual clips too long or no highlights).")
-        if base_clip: base_clip.close()
         return None, []
 
-    # Create subclips from the selected segments
-    subclips = []
-    for start, end, dur in selected_video_segments:
-        subclips.append(base_clip.subclip(start, end))
-
-    if not subclips: # Should be caught by the previous check, but as a safeguard
-        print(f"⚠️ No subclips generated for {video_type_name} video concatenation.")
-        if base_clip: base_clip.close()
-        return None, selected_video_segments # Return empty list of segments
-
-    final_targeted_clip = concatenate_videoclips(subclips, method='chain')
-
-    # Handle audio for the clip
-    if final_targeted_clip.audio is None:
-        sr = 44100
-        silence = AudioArrayClip(np.zeros((int(final_targeted_clip.duration * sr), 2)), fps=sr)
-        final_targeted_clip = final_targeted_clip.set_audio(silence)
+    base_clip = VideoFileClip(video_path)
+    # Create subclips from the selected segments (audio is handled by concatenate_segments)
+    final_targeted_clip = concatenate_segments(base_clip, selected_video_segments)
     
     # base_clip.close() # Closing here might be too early if original_clip is needed later by other functions using the same path.
     # The subclips derived from base_clip (which form final_short_clip) need the base_clip's reader to remain open
@@ -239,99 +198,194 @@ def create_targeted_duration_highlight_video(video_path, all_chronological_highl
     return final_targeted_clip, selected_video_segments
 
 # === 4. СОХРАНЕНИЕ ВИДЕО ===
-def save_video(clip, base_output_name="output/highlight_final"):
-    if not hasattr(clip, 'size'):
-        print("⚠️ Error: Input clip does not have size attribute. Skipping video saving.")
-        return
-        
+def fit_clip_to_dimensions(clip, target_dims, label="output"):
+    """Scales the clip to cover target_dims (width, height) and center-crops it. Returns None if impossible."""
     original_w, original_h = clip.size
-    if original_w == 0 or original_h == 0: # Avoid division by zero for invalid clips
-        print(f"⚠️ Error: Original clip dimensions are zero ({original_w}x{original_h}). Skipping video saving.")
-        return
+    target_w, target_h = target_dims
 
-    output_fps = clip.fps if hasattr(clip, 'fps') and clip.fps and clip.fps > 0 else 30
-    common_write_args = {'codec': 'libx264', 'fps': output_fps, 'threads': 4, 'preset': 'medium'}
-
-    # --- Process and Save Portrait Video (9:16) ---
-    target_w_p, target_h_p = PORTRAIT_DIMENSIONS
-    
     # Calculate scaling factor to cover the target dimensions
-    scale_p = max(target_w_p / original_w, target_h_p / original_h)
-    resized_w_p, resized_h_p = int(original_w * scale_p), int(original_h * scale_p)
+    scale = max(target_w / original_w, target_h / original_h)
+    resized_w, resized_h = int(original_w * scale), int(original_h * scale)
 
     # Ensure dimensions are even for some codecs
-    if resized_w_p % 2 != 0: resized_w_p += 1
-    if resized_h_p % 2 != 0: resized_h_p += 1
-    
-    if resized_w_p <= 0 or resized_h_p <= 0:
-        print(f"⚠️ Error: Invalid resized dimensions for portrait ({resized_w_p}x{resized_h_p}). Skipping portrait video.")
-    else:
-        resized_clip_p = clip.resize(newsize=(resized_w_p, resized_h_p))
-        
-        # Ensure crop dimensions do not exceed resized clip dimensions
-        crop_width_p = min(target_w_p, resized_clip_p.w)
-        crop_height_p = min(target_h_p, resized_clip_p.h)
+    if resized_w % 2 != 0: resized_w += 1
+    if resized_h % 2 != 0: resized_h += 1
 
-        if crop_width_p <= 0 or crop_height_p <= 0:
-            print(f"⚠️ Error: Invalid crop dimensions for portrait ({crop_width_p}x{crop_height_p}). Skipping portrait video.")
-        else:
-            cropped_portrait_clip = resized_clip_p.fx(vfx.crop,
-                                                      x_center=resized_clip_p.w / 2,
-                                                      y_center=resized_clip_p.h / 2,
-                                                      width=crop_width_p,
-                                                      height=crop_height_p)
-            
-            portrait_output_path = f"{base_output_name}_portrait.mp4"
-            print(f"⏳ Saving portrait video to {portrait_output_path} ({crop_width_p}x{crop_height_p})...")
-            try:
-                cropped_portrait_clip.write_videofile(portrait_output_path, audio_codec='aac', **common_write_args)
-            except Exception as e:
-                print(f"⚠️ Error writing portrait video with audio: {e}. Trying without audio.")
-                try:
-                    cropped_portrait_clip.write_videofile(portrait_output_path, audio=False, **common_write_args)
-                except Exception as e2:
-                    print(f"❌ Failed to write portrait video: {e2}")
-            else:
-                print(f"✅ Portrait video saved: {portrait_output_path}")
+    if resized_w <= 0 or resized_h <= 0:
+        print(f"⚠️ Error: Invalid resized dimensions for {label} ({resized_w}x{resized_h}). Skipping {label} video.")
+        return None
 
-    # --- Process and Save Landscape Video (16:9) ---
-    target_w_l, target_h_l = LANDSCAPE_DIMENSIONS
+    resized_clip = clip.resize(newsize=(resized_w, resized_h))
 
-    scale_l = max(target_w_l / original_w, target_h_l / original_h)
-    resized_w_l, resized_h_l = int(original_w * scale_l), int(original_h * scale_l)
+    # Ensure crop dimensions do not exceed resized clip dimensions
+    crop_width = min(target_w, resized_clip.w)
+    crop_height = min(target_h, resized_clip.h)
 
-    if resized_w_l % 2 != 0: resized_w_l += 1
-    if resized_h_l % 2 != 0: resized_h_l += 1
+    if crop_width <= 0 or crop_height <= 0:
+        print(f"⚠️ Error: Invalid crop dimensions for {label} ({crop_width}x{crop_height}). Skipping {label} video.")
+        return None
 
-    if resized_w_l <= 0 or resized_h_l <= 0:
-        print(f"⚠️ Error: Invalid resized dimensions for landscape ({resized_w_l}x{resized_h_l}). Skipping landscape video.")
-    else:
-        resized_clip_l = clip.resize(newsize=(resized_w_l, resized_h_l))
+    return resized_clip.fx(vfx.crop,
+                           x_center=resized_clip.w / 2,
+                           y_center=resized_clip.h / 2,
+                           width=crop_width,
+                           height=crop_height)
+
+def should_use_chunked_encode(duration, mode=None):
+    """Decides whether a reel of `duration` seconds is encoded in parallel chunks."""
+    mode = mode or CHUNKED_ENCODE_MODE
+    if mode == "on":
+        return True
+    if mode == "off":
+        return False
+    return duration >= CHUNKED_ENCODE_MIN_DURATION and thread_allotment() >= 4
+
+def build_timeline_clip(video_path, segments):
+    """Rebuilds a highlight timeline from the source video; used by chunk encoders in worker processes."""
+    return concatenate_segments(VideoFileClip(video_path), segments)
+
+def _render_timeline_chunk(video_path, segments, target_dims, fps, start_time, end_time, chunk_path, threads):
+    timeline_clip = build_timeline_clip(video_path, segments)
+    try:
+        fitted_clip = fit_clip_to_dimensions(timeline_clip, target_dims)
+        if fitted_clip is None:
+            # Raised in the worker, so the chunked and per-segment encoders report it and fall back
+            raise ValueError(f"Can not fit the {timeline_clip.w}x{timeline_clip.h} timeline to {target_dims[0]}x{target_dims[1]}")
+        fitted_clip.subclip(start_time, end_time).write_videofile(
+            chunk_path, codec='libx264', fps=fps, audio=False, threads=threads, preset='medium',
+            ffmpeg_params=x264_output_params(fps), verbose=False, logger=None
+        )
+    finally:
+        timeline_clip.close()
+    return chunk_path
+
+def _render_timeline_audio(video_path, segments, target_dims, fps, audio_path):
+    timeline_clip = build_timeline_clip(video_path, segments)
+    try:
+        timeline_clip.audio.write_audiofile(audio_path, fps=44100, codec='aac', verbose=False, logger=None)
+    finally:
+        timeline_clip.close()
+    return audio_path
+
+def save_timeline_from_segments(timeline, target_dims, fps, output_path, segment_cache, workers=1):
+    """
+    Builds a reel from per-segment renders: every (start, end) segment of the timeline is encoded on its own
+    (or copied from the rendered-segment cache), the audio track is rendered once, and everything is joined
+    with concat stream copy. Reels that share segments (main/short/story, re-runs) reuse each other's renders.
+    """
+    video_path, segments = timeline
+    source_hash = file_content_hash(video_path)
+    geometry = f"cover:{target_dims[0]}x{target_dims[1]}@{fps:.3f}"
+    work_dir = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        segment_paths = []
+        missing_segments = []
+        for index, (start, end, dur) in enumerate(segments):
+            cache_key = segment_cache_key(source_hash, start, end, geometry, MOTION_SEGMENT_ENCODE_PROFILE)
+            segment_path = os.path.join(work_dir, f"segment_{index:04d}.mp4")
+            if not segment_cache.fetch(cache_key, segment_path):
+                missing_segments.append((cache_key, segment_path, (start, end, dur)))
+            segment_paths.append(segment_path)
+
+        if missing_segments:
+            print(f"  Rendering {len(missing_segments)} of {len(segments)} segments ({len(segments) - len(missing_segments)} cached)...")
+            threads = max(1, thread_allotment() // workers)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = []
+                for cache_key, segment_path, segment in missing_segments:
+                    frame_count = max(1, int(round(segment[2] * fps)))
+                    futures.append((cache_key, segment_path, executor.submit(
+                        _render_timeline_chunk, video_path, [segment], target_dims, fps,
+                        0, (frame_count - 0.5) / fps, segment_path, threads
+                    )))
+                for cache_key, segment_path, future in futures:
+                    future.result()
+                    segment_cache.store(cache_key, segment_path)
+
+        audio_path = _render_timeline_audio(video_path, segments, target_dims, fps, os.path.join(work_dir, "audio.m4a"))
+        concat_chunks(segment_paths, audio_path, output_path)
+        return output_path
+    except Exception as e:
+        print(f"⚠️ Error building {output_path} from segment renders: {e}")
+        return None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-        crop_width_l = min(target_w_l, resized_clip_l.w)
-        crop_height_l = min(target_h_l, resized_clip_l.h)
+def save_video(clip, base_output_name="output/highlight_final", timeline=None, chunked_encode=None,
+               orientations=("portrait", "landscape"), output_paths=None):
+    """
+    Saves the clip as portrait (9:16) and landscape (16:9) videos.
+
+    timeline: optional (video_path, segments) the clip was built from. When given, the reel is assembled from
+              cached per-segment renders; with the segment cache disabled and a long enough reel
+              (see should_use_chunked_encode), the timeline is encoded in parallel GOP-aligned chunks.
+    chunked_encode: "auto", "on" or "off"; defaults to the CHUNKED_ENCODE environment variable.
+    orientations: which of "portrait" / "landscape" to write (lazy rendering asks for one at a time).
+    output_paths: optional {orientation: path} instead of f"{base_output_name}_{orientation}.mp4".
+    """
+    if not hasattr(clip, 'size'):
+        print("⚠️ Error: Input clip does not have size attribute. Skipping video saving.")
+        return
         
-        if crop_width_l <= 0 or crop_height_l <= 0:
-            print(f"⚠️ Error: Invalid crop dimensions for landscape ({crop_width_l}x{crop_height_l}). Skipping landscape video.")
-        else:
-            cropped_landscape_clip = resized_clip_l.fx(vfx.crop,
-                                                       x_center=resized_clip_l.w / 2,
-                                                       y_center=resized_clip_l.h / 2,
-                                                       width=crop_width_l,
-                                                       height=crop_height_l)
-
-            landscape_output_path = f"{base_output_name}_landscape.mp4"
-            print(f"⏳ Saving landscape video to {landscape_output_path} ({crop_width_l}x{crop_height_l})...")
+    original_w, original_h = clip.size
+    if original_w == 0 or original_h == 0: # Avoid division by zero for invalid clips
+        print(f"⚠️ Error: Original clip dimensions are zero ({original_w}x{original_h}). Skipping video saving.")
+        return
+
+    output_fps = clip.fps if hasattr(clip, 'fps') and clip.fps and clip.fps > 0 else 30
+    common_write_args = {'codec': 'libx264', 'fps': output_fps, 'threads': thread_allotment(), 'preset': 'medium',
+                         'ffmpeg_params': x264_output_params(output_fps)}
+    use_chunked = timeline is not None and should_use_chunked_encode(clip.duration, chunked_encode)
+    segment_cache = SegmentCache()
+
+    for label in orientations:
+        target_dims = REEL_ORIENTATIONS[label]
+        output_path = (output_paths or {}).get(label) or f"{base_output_name}_{label}.mp4"
+
+        if timeline is not None and segment_cache.enabled:
+            print(f"⏳ Saving {label} video to {output_path} from per-segment renders...")
+            # Missing segments are rendered in parallel when chunked encoding would have been used
+            segment_workers = thread_allotment() if use_chunked else 1
+            if save_timeline_from_segments(timeline, target_dims, output_fps, output_path, segment_cache, segment_workers):
+                print(f"✅ {label.capitalize()} video saved: {output_path}")
+                continue
+            print(f"⚠️ Segment-based encoding of {label} video failed. Falling back to a single encoder.")
+        elif use_chunked:
+            print(f"⏳ Saving {label} video to {output_path} with chunked encoding ({clip.duration:.1f}s timeline)...")
+            video_path, segments = timeline
+            if encode_chunked(_render_timeline_chunk, _render_timeline_audio,
+                              (video_path, segments, target_dims, output_fps),
+                              clip.duration, output_fps, output_path):
+                print(f"✅ {label.capitalize()} video saved: {output_path}")
+                continue
+            print(f"⚠️ Chunked encoding of {label} video failed. Falling back to a single encoder.")
+
+        cropped_clip = fit_clip_to_dimensions(clip, target_dims, label)
+        if cropped_clip is None:
+            continue
+
+        print(f"⏳ Saving {label} video to {output_path} ({cropped_clip.w}x{cropped_clip.h})...")
+        try:
+            cropped_clip.write_videofile(output_path, audio_codec='aac', **common_write_args)
+        except Exception as e:
+            print(f"⚠️ Error writing {label} video with audio: {e}. Trying without audio.")
             try:
-                cropped_landscape_clip.write_videofile(landscape_output_path, audio_codec='aac', **common_write_args)
-            except Exception as e:
-                print(f"⚠️ Error writing landscape video with audio: {e}. Trying without audio.")
-                try:
-                    cropped_landscape_clip.write_videofile(landscape_output_path, audio=False, **common_write_args)
-                except Exception as e2:
-                    print(f"❌ Failed to write landscape video: {e2}")
-            else:
-                print(f"✅ Landscape video saved: {landscape_output_path}")
+                cropped_clip.write_videofile(output_path, audio=False, **common_write_args)
+            except Exception as e2:
+                print(f"❌ Failed to write {label} video: {e2}")
+        else:
+            print(f"✅ {label.capitalize()} video saved: {output_path}")
+
+def render_reel_recipe(recipe, output_path, job_dir):
+    """Renders one orientation of a recorded reel (see ml_core/render_recipes.py)."""
+    segments = [tuple(segment) for segment in recipe["segments"]]
+    base_clip = VideoFileClip(recipe["source"])
+    try:
+        reel_clip = concatenate_segments(base_clip, segments)
+        save_video(reel_clip, timeline=(recipe["source"], segments), chunked_encode=recipe.get("chunked_encode"),
+                   orientations=(recipe["orientation"],), output_paths={recipe["orientation"]: output_path})
+    finally:
+        base_clip.close()
 
 # === NEW: INSTAGRAM FRAME EXTRACTION ===
 def crop_frame_to_4_5(frame_array, target_w, target_h):
@@ -376,25 +430,20 @@ def crop_frame_to_4_5(frame_array, target_w, target_h):
         
     return cropped_frame
 
-def extract_and_save_instagram_frames(original_video_path, selected_segments,
-                                      output_dir="output/instagram_frames",
-                                      frames_per_segment_points=None):
+def plan_instagram_frames(selected_segments, video_duration, output_subdir="instagram_frames",
+                          frames_per_segment_points=None):
+    """
+    Plans the important frames of each highlight for Instagram as render recipes ({relative path: recipe});
+    a frame is grabbed from the source when it is first requested (see render_instagram_frame_recipe).
+    """
     if frames_per_segment_points is None:
         frames_per_segment_points = [0.25, 0.50, 0.75] # Extract at 25%, 50%, 75% of segment
 
-    os.makedirs(output_dir, exist_ok=True)
-
     if not selected_segments:
         print("⚠️ No segments selected for frame extraction.")
-        return
-
-    print(f"🎞️ Extracting important frames for Instagram to {output_dir} (up to {len(frames_per_segment_points)} per highlight)...")
-    try:
-        original_clip = VideoFileClip(original_video_path)
-    except Exception as e:
-        print(f"❌ Error opening original video {original_video_path} for frame extraction: {e}")
-        return
+        return {}
 
+    recipes = {}
     frame_count = 0
 
     for i, (start_time, end_time, duration) in enumerate(selected_segments):
@@ -410,37 +459,33 @@ def extract_and_save_instagram_frames(original_video_path, selected_segments,
                 extraction_time = start_time + duration * percentage
             
             # Ensure extraction_time is within the clip's bounds
-            extraction_time = min(max(extraction_time, 0), original_clip.duration - 0.01 if original_clip.duration > 0.01 else 0)
+            extraction_time = min(max(extraction_time, 0), video_duration - 0.01 if video_duration > 0.01 else 0)
 
-            try:
-                frame_rgb = original_clip.get_frame(extraction_time) # HxWxC, RGB
-                if frame_rgb is None:
-                    print(f"  ⚠️ Got None frame from segment {i+1} at time {extraction_time:.2f}s.")
-                    continue
-                frame_bgr = cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR)
-
-                processed_frame = crop_frame_to_4_5(frame_bgr, INSTAGRAM_FRAME_WIDTH, INSTAGRAM_FRAME_HEIGHT)
-
-                if processed_frame is not None and processed_frame.size > 0 :
-                    frame_count += 1
-                    output_filename = os.path.join(output_dir, f"frame_seg{i+1:02d}_pt{point_index+1:02d}_{frame_count:03d}.jpg")
-                    cv2.imwrite(output_filename, processed_frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
-                    # print(f"  🖼️ Saved: {output_filename}")
-                else:
-                    print(f"  ⚠️ Skipped saving frame from segment {i+1} (point {percentage*100:.0f}%) at time {extraction_time:.2f}s due to processing error.")
-
-            except Exception as e:
-                print(f"  ⚠️ Error extracting/processing frame from segment {i+1} (point {percentage*100:.0f}%) at time {extraction_time:.2f}s: {e}")
-
-    if original_clip:
+            frame_count += 1
+            recipes[f"{output_subdir}/frame_seg{i+1:02d}_pt{point_index+1:02d}_{frame_count:03d}.jpg"] = {
+                "kind": "motion_frame", "time": extraction_time,
+                "width": INSTAGRAM_FRAME_WIDTH, "height": INSTAGRAM_FRAME_HEIGHT,
+            }
+
+    print(f"🎞️ Planned {frame_count} Instagram frames in {output_subdir}/ (up to {len(frames_per_segment_points)} per highlight)")
+    return recipes
+
+def render_instagram_frame_recipe(recipe, output_path, job_dir):
+    """Grabs, crops to 4:5 and saves one recorded Instagram frame."""
+    original_clip = VideoFileClip(recipe["source"])
+    try:
+        frame_rgb = original_clip.get_frame(recipe["time"]) # HxWxC, RGB
+    finally:
         original_clip.close()
-    if frame_count > 0:
-        print(f"✅ {frame_count} Instagram frames saved to {output_dir}")
+    frame_bgr = cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR)
+    processed_frame = crop_frame_to_4_5(frame_bgr, recipe["width"], recipe["height"])
+    if processed_frame is not None and processed_frame.size > 0:
+        cv2.imwrite(output_path, processed_frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
     else:
-        print(f"⚠️ No Instagram frames were saved.")
+        print(f"  ⚠️ Skipped saving frame at time {recipe['time']:.2f}s due to processing error.")
 
 # === 5. ГЛАВНАЯ ФУНКЦИЯ ===
-def generate_highlights_from_url(input_source, base_output_dir="url_test"):
+def generate_highlights_from_url(input_source, base_output_dir="url_test", chunked_encode=None):
     # Create base output directory and subdirectories for frames
     os.makedirs(base_output_dir, exist_ok=True)
     os.makedirs(os.path.join(base_output_dir, "instagram_frames"), exist_ok=True)
@@ -459,11 +504,17 @@ def generate_highlights_from_url(input_source, base_output_dir="url_test"):
             # shutil.copy(input_source, temp_video_path)
             # video_filename = temp_video_path
         else:
-            print(f"Downloading video from URL: {input_source}")
+            # Motion analysis (and the previews) only need a low-resolution stream; the full-quality
+            # stream is fetched when a reel is rendered (render_recipes.with_render_source)
+            print(f"Downloading low-resolution analysis video from URL: {input_source}")
             downloaded_video_name = "downloaded_video.mp4" # Consistent name in temp_dir
             temp_video_path = os.path.join(temp_dir, downloaded_video_name)
             
-            actual_downloaded_path = download_video(input_source, temp_video_path)
+            # Kept under SOURCES_DIR and checkpointed, so a retried job does not download it again
+            actual_downloaded_path = run_stage(
+                base_output_dir, "download_analysis", {"url": input_source, "format": DOWNLOAD_PROFILES["analysis"]},
+                lambda: persist_source(download_video(input_source, temp_video_path, profile="analysis")),
+                files=lambda path: [path])
             
             if not os.path.exists(actual_downloaded_path):
                 print(f"❌ Failed to download video from {input_source} to {actual_downloaded_path}")
@@ -474,10 +525,23 @@ def generate_highlights_from_url(input_source, base_output_dir="url_test"):
             print(f"Video file not found or not processed: {video_filename}")
             return # temp_dir will be cleaned by finally
 
-        motion_intervals = detect_motion_intervals(video_filename)
+        # Checkpointed in the job directory: a retried job with the same video skips the analysis
+        motion = run_stage(base_output_dir, "motion", {"video": file_fingerprint(video_filename)},
+                           lambda: analyze_motion(video_filename))
+        motion_scores = np.asarray(motion["motion_scores"], dtype=motion["dtype"])
+        fps, video_duration = motion["fps"], motion["duration"]
+        # Keep the motion curve with the job so POST /jobs/{id}/select can re-threshold without the media
+        try:
+            write_selection_features(base_output_dir, "motion", {
+                "fps": float(fps), "duration": video_duration,
+                "motion_scores": [round(float(score), 3) for score in motion_scores],
+            })
+        except OSError as e:
+            print(f"⚠️ Could not store selection features: {e}")
+        motion_intervals = motion_intervals_from_scores(motion_scores, fps)
     
         try:
-            highlight_clip, selected_segments_for_main_reel = create_highlight_video(video_filename, motion_intervals)
+            selected_segments_for_main_reel = select_main_segments(motion_intervals, video_duration)
         except ValueError as e:
             print(e) # e.g., "❌ Not enough valid highlights..."
             return # temp_dir will be cleaned by finally
@@ -485,46 +549,50 @@ def generate_highlights_from_url(input_source, base_output_dir="url_test"):
             print(f"❌ Error creating highlight video: {e}")
             return # temp_dir will be cleaned by finally
 
-        save_video(highlight_clip, os.path.join(base_output_dir, "merged_highlights_main"))
-        extract_and_save_instagram_frames(video_filename, selected_segments_for_main_reel, os.path.join(base_output_dir, "instagram_frames"))
-
-        # Create and save the short highlight video
-        print("\n🎬 Creating short highlight video (<1 minute)...")
-        short_highlight_clip, _ = create_targeted_duration_highlight_video(
-            video_filename,
-            selected_segments_for_main_reel,
-            SHORT_VIDEO_TARGET_DURATION,
-            "short"
-        )
-
-        if short_highlight_clip:
-            save_video(short_highlight_clip, os.path.join(base_output_dir, "merged_highlights_short"))
-            print(f"   Short Portrait video: {os.path.join(base_output_dir, 'merged_highlights_short_portrait.mp4')}")
-            print(f"   Short Landscape video: {os.path.join(base_output_dir, 'merged_highlights_short_landscape.mp4')}")
-        else:
-            print("⚠️ Short highlight video (58s) could not be created or no segments were selected.")
-
-        # Create and save the Instagram Story highlight video
-        print("\n🎬 Creating Instagram Story highlight video (~15 seconds)...")
-        story_highlight_clip, _ = create_targeted_duration_highlight_video(
-            video_filename,
-            selected_segments_for_main_reel, # Use the same pool of chronological clips
-            STORY_VIDEO_TARGET_DURATION,
-            "story"
-        )
-
-        if story_highlight_clip:
-            save_video(story_highlight_clip, os.path.join(base_output_dir, "merged_highlights_story"))
-            print(f"   Story Portrait video: {os.path.join(base_output_dir, 'merged_highlights_story_portrait.mp4')}")
-            print(f"   Story Landscape video: {os.path.join(base_output_dir, 'merged_highlights_story_landscape.mp4')}")
-        else:
-            print("⚠️ Instagram Story highlight video (15s) could not be created or no segments were selected.")
+        # Short (<1 minute) and Instagram Story (~15 seconds) reels come from the same pool of chronological clips
+        reels = {"main": selected_segments_for_main_reel}
+        for reel_name, target_duration in (("short", SHORT_VIDEO_TARGET_DURATION), ("story", STORY_VIDEO_TARGET_DURATION)):
+            reel_segments = select_targeted_segments(selected_segments_for_main_reel, target_duration)
+            if reel_segments:
+                reels[reel_name] = reel_segments
+            else:
+                print(f"⚠️ {reel_name.capitalize()} highlight video ({target_duration}s) could not be created or no segments were selected.")
+
+        # Every reel is recorded as a render recipe; it is encoded when first requested (or now, if eager)
+        source_path = video_filename if is_local_file else persist_source(video_filename)
+        reel_recipes = {
+            f"merged_highlights_{reel_name}_{label}.mp4": {
+                "kind": "motion_reel", "source": source_path, "orientation": label,
+                "segments": [list(segment) for segment in reel_segments], "chunked_encode": chunked_encode,
+            }
+            for reel_name, reel_segments in reels.items() for label in REEL_ORIENTATIONS
+        }
+        reel_recipes.update({
+            relative_path: {**frame_recipe, "source": source_path}
+            for relative_path, frame_recipe in plan_instagram_frames(selected_segments_for_main_reel, video_duration).items()
+        })
+        if not is_local_file:
+            # Analysed on the low-resolution download: full-quality outputs render from the stream itself
+            for recipe in reel_recipes.values():
+                recipe["source_url"] = input_source
+        # Each reel also gets a fast low-resolution portrait preview, rendered before any full-quality encode
+        for reel_name, reel_segments in reels.items():
+            reel_recipes.update(preview_recipes(
+                f"{reel_name}_reel", source_path, [(start, end) for start, end, _ in reel_segments], PORTRAIT_DIMENSIONS,
+                [f"merged_highlights_{reel_name}_{label}.mp4" for label in REEL_ORIENTATIONS]))
+        record_recipes(base_output_dir, reel_recipes)
+        print("⏳ Rendering previews...")
+        publish_job_outputs(base_output_dir)
 
         print(f"\n✅ Highlight processing complete. Check the '{base_output_dir}/' directory for results.")
-        print(f"   Main Portrait video: {os.path.join(base_output_dir, 'merged_highlights_main_portrait.mp4')}")
-        print(f"   Main Landscape video: {os.path.join(base_output_dir, 'merged_highlights_main_landscape.mp4')}")
-        print(f"   Instagram frames: {os.path.join(base_output_dir, 'instagram_frames')}/")
-        # Specific short/story video paths are printed above if successfully created.
+        for reel_name, reel_segments in reels.items():
+            reel_duration = sum(segment[2] for segment in reel_segments)
+            for label in REEL_ORIENTATIONS:
+                reel_path = os.path.join(base_output_dir, f"merged_highlights_{reel_name}_{label}.mp4")
+                state = "rendered" if os.path.exists(reel_path) else "rendering in background or on first request"
+                print(f"   {reel_name.capitalize()} {label} video ({reel_duration:.1f}s, {state}): {reel_path}")
+        print(f"   Previews: {os.path.join(base_output_dir, 'previews')}/")
+        print(f"   Instagram frames (rendered on first request): {os.path.join(base_output_dir, 'instagram_frames')}/")
 
     finally:
         # Ensure temp_dir is defined and exists before trying to remove it
@@ -537,6 +605,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate video highlights using motion detection.")
     parser.add_argument("input_source", help="Video URL or local file path to process")
     parser.add_argument("output_dir", help="Base directory for output files")
+    parser.add_argument("--chunked-encode", choices=["auto", "on", "off"], default=None,
+                        help="Encode long reels in parallel GOP-aligned chunks (default: CHUNKED_ENCODE env or 'auto')")
     args = parser.parse_args()
 
-    generate_highlights_from_url(args.input_source, base_output_dir=args.output_dir)
\ No newline at end of file
+    generate_highlights_from_url(args.input_source, base_output_dir=args.output_dir, chunked_encode=args.chunked_encode)
\ No newline at end of file
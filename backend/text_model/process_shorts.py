@@ -6,9 +6,19 @@ import argparse
 import subprocess
 import json
 import random
-from math import ceil
 from pathlib import Path # Add this import
 
+# Make the shared backend modules (ml_core) importable when this file is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ml_core.cache_utils import file_content_hash, payload_hash
+from ml_core.cpu_budget import ffmpeg_threads
+from ml_core.render_recipes import publish_job_outputs, record_recipes
+from ml_core.segment_cache import SegmentCache, segment_cache_key
+from ml_core.selection import initial_highlight_count, plan_instagram_clips, plan_youtube_clips, platform_configs_for
+
+# Identifies the scale/pad/x264 settings used for platform clips (part of the segment cache key)
+SHORTS_ENCODE_PROFILE = "ffmpeg-scale-pad-libx264-fast-crf23-aac128k-faststart-v1"
+
 def get_clip_duration(filepath):
     """Gets the duration of a video file using ffprobe."""
     if not os.path.exists(filepath):
@@ -41,28 +51,31 @@ def main():
     parser.add_argument("--resolution", type=str, default="1080x1920", help="Resolution for shorts (default: 1080x1920)")
     parser.add_argument("--format", type=str, choices=["youtube", "instagram", "both"], default="youtube", 
                         help="Format type: youtube (up to 59s), instagram (15s), or both (default: youtube)")
+    parser.add_argument("--sharded-transcription", choices=["auto", "on", "off"], default=None,
+                        help="Transcribe long videos in parallel shards (passed to process_video.py)")
+    parser.add_argument("--asr-model", type=str, default=None,
+                        help="Whisper model used for transcription (passed to process_video.py)")
+    parser.add_argument("--asr-engine", choices=["fp32", "int8"], default=None,
+                        help="Whisper inference engine, fp32 or int8 quantized (passed to process_video.py)")
+    parser.add_argument("--sparse-transcription", choices=["on", "off"], default=None,
+                        help="Only transcribe windows around audio peaks and scene cuts (passed to process_video.py)")
+    parser.add_argument("--streaming-render", choices=["on", "off"], default=None,
+                        help="Render highlight clips while the video is still being transcribed (passed to process_video.py)")
     
     args = parser.parse_args()
     
-    platform_configs = []
-    if args.format == "youtube" or args.format == "both":
-        platform_configs.append({"name": "youtube", "max_duration": min(59, args.max_duration), "num_clips_to_generate": args.clips})
-    if args.format == "instagram" or args.format == "both":
-        platform_configs.append({"name": "instagram", "max_duration": 15, "num_clips_to_generate": args.clips})
+    platform_configs = platform_configs_for(args.format, args.clips, args.max_duration)
     
     # Determine how many initial highlight segments to extract.
     # We want enough short segments to build longer platform-specific clips.
     # Let's aim for enough material to potentially create the longest requested clip from ~5s segments.
-    longest_platform_duration = 0
-    if platform_configs:
-        longest_platform_duration = max(p_conf["max_duration"] for p_conf in platform_configs)
-    
+    # (shared with POST /jobs/{id}/select, which re-runs this selection from the stored features)
     # We'll ask process_video.py to extract more, shorter clips
     # Max 15s segments gives good flexibility.
     initial_extraction_max_duration = 15 
     # Estimate needed clips: if longest is 59s, and we generate 3 such clips, that's ~180s.
     # If segments are ~5-10s long, we need ~18-36 segments. Let's set a higher base.
-    num_initial_highlights_to_extract = max(10, args.clips * ceil(longest_platform_duration / 5.0 if longest_platform_duration > 0 else 1.0))
+    num_initial_highlights_to_extract = initial_highlight_count(args.clips, [p_conf["max_duration"] for p_conf in platform_configs])
 
 
     print("\n===== EXTRACTING INITIAL HIGHLIGHT SEGMENTS =====")
@@ -84,25 +97,39 @@ def main():
         "--frames",
         "--max-duration", str(initial_extraction_max_duration) 
     ])
+    if args.sharded_transcription:
+        cmd.extend(["--sharded-transcription", args.sharded_transcription])
+    if args.asr_model:
+        cmd.extend(["--asr-model", args.asr_model])
+    if args.asr_engine:
+        cmd.extend(["--asr-engine", args.asr_engine])
+    if args.sparse_transcription:
+        cmd.extend(["--sparse-transcription", args.sparse_transcription])
+    if args.streaming_render:
+        cmd.extend(["--streaming-render", args.streaming_render])
     print(f"Requesting {num_initial_highlights_to_extract} initial highlight segments (max {initial_extraction_max_duration}s each)...")
     subprocess.run(cmd)
     
     portrait_dir = os.path.join(args.output, "portrait")
-    if not os.path.exists(portrait_dir) or not os.listdir(portrait_dir):
-        print(f"Error: No portrait highlight clips found in {portrait_dir} after initial extraction. Exiting.")
-        # Fallback or landscape conversion logic could be here if needed, but current focus is on using portrait.
+    # The highlights are render recipes at this point; their durations come from highlights.json
+    try:
+        with open(os.path.join(args.output, "highlights.json"), "r", encoding="utf-8") as f:
+            highlights = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read highlights.json in {args.output} after initial extraction ({e}). Exiting.")
         sys.exit(1)
 
     all_portrait_highlights_with_duration = []
-    raw_portrait_files = sorted([f for f in os.listdir(portrait_dir) if f.startswith("highlight_") and f.endswith(".mp4")])
-    for f_name in raw_portrait_files:
-        f_path = os.path.join(portrait_dir, f_name)
-        duration = get_clip_duration(f_path)
+    # Same order as the highlight files sorted by name (highlight_1, highlight_10, highlight_2, ...)
+    for hl in sorted((h for h in highlights if h.get("portrait_file")), key=lambda h: os.path.basename(h["portrait_file"])):
+        f_name = os.path.basename(hl["portrait_file"])
+        duration = hl["clip_end"] - hl["clip_start"]
         if duration > 0:
-            all_portrait_highlights_with_duration.append({"path": f_path, "duration": duration, "used": False, "name": f_name})
+            all_portrait_highlights_with_duration.append({"path": os.path.join(portrait_dir, f_name), "duration": duration,
+                                                          "used": False, "name": f_name, "input": f"portrait/{f_name}"})
     
     if not all_portrait_highlights_with_duration:
-        print("Error: Could not determine duration for any portrait highlights. Exiting.")
+        print(f"Error: No portrait highlight clips found in {portrait_dir} after initial extraction. Exiting.")
         sys.exit(1)
 
     for platform_config in platform_configs:
@@ -112,22 +139,17 @@ def main():
         
         print(f"\n===== OPTIMIZING FOR {platform_name.upper()} FORMAT (Target: {num_clips_to_make_for_platform} clip(s), Max Duration: {platform_max_duration}s) =====")
         
-        platform_output_dir = os.path.join(args.output, platform_name)
-        os.makedirs(platform_output_dir, exist_ok=True)
-        
-        # Reset 'used' status for each platform to reuse highlights if needed
-        for hl in all_portrait_highlights_with_duration:
-            hl["used"] = False
-
-        clips_made_for_this_platform = 0
-
         if platform_name == "youtube":
-            process_for_youtube(all_portrait_highlights_with_duration, platform_output_dir, platform_name, args.resolution, platform_max_duration, num_clips_to_make_for_platform)
+            recipes = process_for_youtube(all_portrait_highlights_with_duration, platform_name, args.resolution, platform_max_duration, num_clips_to_make_for_platform)
         elif platform_name == "instagram":
-            process_for_instagram(all_portrait_highlights_with_duration, platform_output_dir, platform_name, args.resolution, platform_max_duration, num_clips_to_make_for_platform)
+            recipes = process_for_instagram(all_portrait_highlights_with_duration, platform_name, args.resolution, platform_max_duration, num_clips_to_make_for_platform)
+        record_recipes(args.output, recipes)
         
-        print(f"\n{platform_name.capitalize()} clips generation complete for this pass!")
-        print(f"Clips are in: {platform_output_dir}")
+        print(f"\n{platform_name.capitalize()} clips planned for this pass!")
+        print(f"Clips are in: {os.path.join(args.output, platform_name)} (rendered when first requested unless eager)")
+
+    # The highlight previews already exist; eager clips are rendered at low priority in the background
+    publish_job_outputs(args.output)
 
 def process_ffmpeg_command(input_path, output_path, resolution, duration_to_take, start_time=None):
     """Helper to run common ffmpeg command for scaling, padding, and duration."""
@@ -140,153 +162,124 @@ def process_ffmpeg_command(input_path, output_path, resolution, duration_to_take
         "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
         "-c:v", "libx264", "-preset", "fast", "-crf", "23",
         "-c:a", "aac", "-b:a", "128k",
+        "-threads", ffmpeg_threads(),
         "-movflags", "+faststart",
         "-y", output_path
     ])
+    segment_cache = SegmentCache()
+    cache_key = None
+    if segment_cache.enabled:
+        range_start = start_time or 0
+        cache_key = segment_cache_key(file_content_hash(input_path), range_start, range_start + float(duration_to_take),
+                                      f"pad:{resolution}", SHORTS_ENCODE_PROFILE)
+        if segment_cache.fetch(cache_key, output_path):
+            print(f"Reused cached render for {output_path}")
+            return
+
     print(f"Running ffmpeg: {' '.join(ffmpeg_cmd)}")
-    subprocess.run(ffmpeg_cmd)
+    completed = subprocess.run(ffmpeg_cmd)
+    if cache_key and completed.returncode == 0:
+        segment_cache.store(cache_key, output_path)
 
-def process_for_youtube(available_highlights, platform_dir, platform_name, resolution, max_clip_duration, num_clips_to_generate):
-    """
-    Processes highlights for YouTube.
-    Tries to create num_clips_to_generate, each up to max_clip_duration.
-    It will concatenate available chronological highlights to fill the duration.
-    """
-    clips_generated_count = 0
-    highlight_idx = 0
+def render_platform_clip(part_paths, output_filename, resolution, total_duration):
+    """Encodes one platform clip: a single highlight trimmed to total_duration, or several concatenated."""
+    if len(part_paths) == 1:
+        process_ffmpeg_command(part_paths[0], output_filename, resolution, total_duration)
+        return
+
+    temp_concat_list_path = f"{output_filename}.concat.txt"
+    with open(temp_concat_list_path, 'w') as f_concat:
+        for part_path in part_paths:
+            f_concat.write(f"file '{os.path.abspath(part_path)}'\n")
+    
+    width, height = resolution.split("x")
+    ffmpeg_cmd_concat = [
+        "ffmpeg", "-f", "concat", "-safe", "0", "-i", temp_concat_list_path,
+        "-t", str(total_duration), # Use the actual combined duration
+        "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+        "-c:v", "libx264", "-preset", "fast", "-crf", "23",
+        "-c:a", "aac", "-b:a", "128k",
+        "-threads", ffmpeg_threads(),
+        "-movflags", "+faststart",
+        "-y", output_filename
+    ]
+    segment_cache = SegmentCache()
+    cache_key = None
+    if segment_cache.enabled:
+        # The "source" of a concatenated clip is the ordered list of its parts
+        parts_hash = payload_hash([file_content_hash(part_path) for part_path in part_paths])
+        cache_key = segment_cache_key(parts_hash, 0, total_duration, f"pad:{resolution}", SHORTS_ENCODE_PROFILE)
+    try:
+        if cache_key and segment_cache.fetch(cache_key, output_filename):
+            print(f"Reused cached render for {output_filename}")
+        else:
+            print(f"Running ffmpeg concat: {' '.join(ffmpeg_cmd_concat)}")
+            completed = subprocess.run(ffmpeg_cmd_concat)
+            if cache_key and completed.returncode == 0:
+                segment_cache.store(cache_key, output_filename)
+    finally:
+        if os.path.exists(temp_concat_list_path):
+            os.remove(temp_concat_list_path)
 
-    # Corrected loop: Iterate exactly num_clips_to_generate times
-    for _i in range(num_clips_to_generate): 
-        if clips_generated_count >= num_clips_to_generate: # Redundant check, but safe
-            break
-        if highlight_idx >= len(available_highlights):
-            print("No more highlights available for YouTube.")
-            break
 
-        current_clip_parts_paths = []
-        current_total_duration = 0
-        
-        temp_concat_list_path = os.path.join(platform_dir, f"concat_list_yt_{clips_generated_count + 1}.txt") # Use clips_generated_count
-        
-        # Try to build a clip by concatenating
-        temp_highlight_idx = highlight_idx
-        while temp_highlight_idx < len(available_highlights):
-            hl = available_highlights[temp_highlight_idx]
-            if current_total_duration + hl["duration"] <= max_clip_duration:
-                current_clip_parts_paths.append(hl["path"])
-                current_total_duration += hl["duration"]
-                # Mark as "potentially" used for this specific output clip.
-                # We advance highlight_idx only after successful generation.
-                temp_highlight_idx += 1 
-            else: # Next clip would exceed max_duration
-                # If we have nothing yet, but this single clip is too long, trim it.
-                if not current_clip_parts_paths and hl["duration"] > max_clip_duration :
-                    current_clip_parts_paths.append(hl["path"])
-                    current_total_duration = max_clip_duration # We will trim this single clip
-                    temp_highlight_idx += 1
-                break 
-        
-        if not current_clip_parts_paths:
-            print(f"Could not form YouTube clip {clips_generated_count + 1}, not enough suitable short highlights remaining or next one is too short.")
-            # Try to see if the very next UNUSED highlight can be trimmed (if we haven't advanced highlight_idx yet)
-            if highlight_idx < len(available_highlights):
-                 hl_next = available_highlights[highlight_idx]
-                 if hl_next["duration"] > 0: # Must have some duration
-                    output_filename = os.path.join(platform_dir, f"{platform_name}_clip_{clips_generated_count + 1}.mp4")
-                    duration_to_use = min(hl_next["duration"], max_clip_duration)
-                    print(f"Making YouTube clip {clips_generated_count + 1} from single highlight {hl_next['name']}, trimmed to {duration_to_use:.2f}s.")
-                    process_ffmpeg_command(hl_next["path"], output_filename, resolution, duration_to_use)
-                    clips_generated_count += 1
-                    highlight_idx +=1 # Consume this highlight
-                    continue # Try to make the next YouTube clip
-            break # Stop trying to make more YouTube clips if we can't form the current one
+def render_shorts_recipe(recipe, output_path, job_dir):
+    """Renders a recorded platform clip from its portrait highlights (see ml_core/render_recipes.py)."""
+    part_paths = [os.path.join(job_dir, input_path) for input_path in recipe["inputs"]]
+    render_platform_clip(part_paths, output_path, recipe["resolution"], recipe["duration"])
 
 
-        output_filename = os.path.join(platform_dir, f"{platform_name}_clip_{clips_generated_count + 1}.mp4")
+def _platform_clip_recipe(available_highlights, parts, resolution):
+    return {"kind": "shorts_clip", "inputs": [available_highlights[idx]["input"] for idx, _take in parts],
+            "duration": sum(take for _idx, take in parts), "resolution": resolution}
 
-        if len(current_clip_parts_paths) == 1:
-            # Single clip, might need trimming if it was selected as the "too long" single clip
-            duration_to_use = min(get_clip_duration(current_clip_parts_paths[0]), current_total_duration) # current_total_duration would be max_clip_duration if trimmed
-            if duration_to_use == 0 : # Safety check if get_clip_duration failed
-                print(f"Skipping YT clip {clips_generated_count +1} due to zero duration for {current_clip_parts_paths[0]}")
-                highlight_idx = temp_highlight_idx # Advance past used clips
-                continue
 
-            print(f"Making YouTube clip {clips_generated_count + 1} from single highlight, duration {duration_to_use:.2f}s.")
-            process_ffmpeg_command(current_clip_parts_paths[0], output_filename, resolution, duration_to_use)
+def process_for_youtube(available_highlights, platform_name, resolution, max_clip_duration, num_clips_to_generate):
+    """
+    Plans highlights for YouTube.
+    Tries to create num_clips_to_generate, each up to max_clip_duration.
+    It will concatenate available chronological highlights to fill the duration
+    (grouping is planned by selection.plan_youtube_clips).
+    Returns {relative clip path: render recipe}.
+    """
+    plan = plan_youtube_clips([hl["duration"] for hl in available_highlights], max_clip_duration, num_clips_to_generate)
+    recipes = {}
+
+    for clip_number, parts in enumerate(plan, 1):
+        recipe = _platform_clip_recipe(available_highlights, parts, resolution)
+        if len(parts) == 1:
+            print(f"YouTube clip {clip_number}: single highlight {available_highlights[parts[0][0]]['name']}, duration {recipe['duration']:.2f}s.")
         else:
-            # Concatenate multiple clips
-            print(f"Making YouTube clip {clips_generated_count + 1} by concatenating {len(current_clip_parts_paths)} highlights (total {current_total_duration:.2f}s).")
-            with open(temp_concat_list_path, 'w') as f_concat:
-                for part_path in current_clip_parts_paths:
-                    f_concat.write(f"file '{os.path.abspath(part_path)}'\n")
-            
-            width, height = resolution.split("x")
-            ffmpeg_cmd_concat = [
-                "ffmpeg", "-f", "concat", "-safe", "0", "-i", temp_concat_list_path,
-                "-t", str(current_total_duration), # Use the actual combined duration
-                "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
-                "-c:v", "libx264", "-preset", "fast", "-crf", "23",
-                "-c:a", "aac", "-b:a", "128k",
-                "-movflags", "+faststart",
-                "-y", output_filename
-            ]
-            print(f"Running ffmpeg concat: {' '.join(ffmpeg_cmd_concat)}")
-            subprocess.run(ffmpeg_cmd_concat)
-            if os.path.exists(temp_concat_list_path):
-                os.remove(temp_concat_list_path)
-        
-        clips_generated_count += 1
-        highlight_idx = temp_highlight_idx # Advance main index past the clips used for this YT short
-        if clips_generated_count >= num_clips_to_generate: # Ensure we break if limit reached
-            break
+            print(f"YouTube clip {clip_number}: {len(parts)} concatenated highlights (total {recipe['duration']:.2f}s).")
+        recipes[f"{platform_name}/{platform_name}_clip_{clip_number}.mp4"] = recipe
 
-    if clips_generated_count < num_clips_to_generate:
-        print(f"Warning: Only {clips_generated_count} YouTube clips were generated, less than the requested {num_clips_to_generate}.")
-    elif clips_generated_count == 0 :
+    if not plan:
         print("No YouTube clips were generated.")
+    elif len(plan) < num_clips_to_generate:
+        print(f"Warning: Only {len(plan)} YouTube clips were generated, less than the requested {num_clips_to_generate}.")
+    return recipes
 
 
-def process_for_instagram(available_highlights, platform_dir, platform_name, resolution, max_clip_duration, num_clips_to_generate):
+def process_for_instagram(available_highlights, platform_name, resolution, max_clip_duration, num_clips_to_generate):
     """
-    Processes highlights for Instagram.
-    Creates num_clips_to_generate, each from a distinct chronological highlight.
-    Each clip is trimmed to max_clip_duration (15s) if longer, or used as is.
+    Plans highlights for Instagram.
+    Creates up to num_clips_to_generate, each from a distinct chronological highlight.
+    Each clip is trimmed to max_clip_duration (15s) if longer, or used as is
+    (see selection.plan_instagram_clips).
+    Returns {relative clip path: render recipe}.
     """
-    clips_generated_count = 0
-    current_highlight_source_index = 0 # Keep track of which highlight to use next
+    plan = plan_instagram_clips([hl["duration"] for hl in available_highlights], max_clip_duration, num_clips_to_generate)
+    recipes = {}
 
-    for _i in range(num_clips_to_generate): # Iterate exactly num_clips_to_generate times
-        if clips_generated_count >= num_clips_to_generate: # Redundant, but safe
-            break
-        
-        if current_highlight_source_index >= len(available_highlights):
-            print("No more unique highlights available for Instagram.")
-            break
-            
-        hl = available_highlights[current_highlight_source_index]
-        current_highlight_source_index += 1 # Move to next highlight for the next IG clip
-
-        output_filename = os.path.join(platform_dir, f"{platform_name}_clip_{clips_generated_count + 1}.mp4")
-        
-        duration_to_use = min(hl["duration"], max_clip_duration)
-        if duration_to_use <= 0.1: # Skip if too short or zero duration
-            print(f"Skipping Instagram clip for {hl['name']} as effective duration is too short ({duration_to_use:.2f}s).")
-            # We don't `continue` here in the outer loop directly, but this clip won't be made,
-            # and clips_generated_count won't increment for this iteration.
-            # The loop will try to make the "next" clip in the next iteration if num_clips_to_generate allows.
-        else:
-            print(f"Making Instagram clip {clips_generated_count + 1} from {hl['name']}, duration {duration_to_use:.2f}s.")
-            process_ffmpeg_command(hl["path"], output_filename, resolution, duration_to_use)
-            clips_generated_count += 1
-        
-        if clips_generated_count >= num_clips_to_generate: # Ensure we break if limit reached
-            break
+    for clip_number, parts in enumerate(plan, 1):
+        recipe = _platform_clip_recipe(available_highlights, parts, resolution)
+        print(f"Instagram clip {clip_number}: {available_highlights[parts[0][0]]['name']}, duration {recipe['duration']:.2f}s.")
+        recipes[f"{platform_name}/{platform_name}_clip_{clip_number}.mp4"] = recipe
 
-    if clips_generated_count < num_clips_to_generate:
-        print(f"Warning: Only {clips_generated_count} Instagram clips were generated, less than the requested {num_clips_to_generate}.")
-    elif clips_generated_count == 0:
+    if not plan:
         print("No Instagram clips were generated.")
+    elif len(plan) < num_clips_to_generate:
+        print(f"Warning: Only {len(plan)} Instagram clips were generated, less than the requested {num_clips_to_generate}.")
+    return recipes
 
 
 if __name__ == "__main__":
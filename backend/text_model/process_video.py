@@ -5,17 +5,40 @@ import json
 import ssl
 import argparse
 import logging # Added
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
 import numpy as np
 import librosa
-import whisper
-import yt_dlp
 import certifi
 import cv2
-from scenedetect import open_video, SceneManager
-from scenedetect.detectors import ContentDetector
 from moviepy.editor import VideoFileClip, vfx
 from PIL import Image, ImageDraw, ImageFont
 
+# Make the shared backend modules (ml_core) importable when this file is run as a script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ml_core.analysis import ANALYSIS_INDEX_ENABLED, load_feature_index
+from ml_core.media_utils import merge_clips_with_xfade
+from ml_core.cache_utils import file_content_hash
+from ml_core.checkpoints import file_fingerprint, run_stage
+from ml_core.cpu_budget import apply_thread_allotment, concurrent_step, ffmpeg_threads, thread_allotment
+from ml_core.download_cache import DOWNLOAD_PROFILES, download_profile
+from ml_core.pipeline_graph import PipelineGraph
+from ml_core.previews import preview_recipes
+from ml_core.render_recipes import persist_source, publish_job_outputs, record_recipes, render_output
+from ml_core.scenes import detect_scenes_cached
+from ml_core.segment_cache import SegmentCache, segment_cache_key
+from ml_core.selection import (
+    HIGHLIGHT_KEYWORDS, KEYWORD_HIT_SCORE, TEXT_SCORE_MAX_WITHOUT_KEYWORDS, committed_text_highlights, compute_score_enhanced,
+    select_text_highlights, write_selection_features
+)
+from ml_core.transcription import (
+    DEFAULT_ENGINE, SAMPLE_RATE, SHARDED_TRANSCRIPTION_MODE, SPARSE_MAX_COVERAGE, SPARSE_TRANSCRIPTION_MODE, cached_transcript, energy_vad, load_audio, plan_sparse_windows,
+    start_low_priority_transcription, transcribe_media, transcribe_windows, window_coverage
+)
+
 # Configure basic logging
 logging.basicConfig(
     level=logging.INFO,  # Or logging.DEBUG for more verbosity
@@ -51,18 +74,42 @@ PORTRAIT_FRAME_HEIGHT = 1920  # 9:16 aspect ratio
 
 BASE_DIR = os.getcwd()
 
-def download_from_url(url, output_dir=None):
-    """Downloads a video from a URL using yt-dlp."""
-    logging.debug(f"Entering download_from_url with url: {url}, output_dir: {output_dir}")
+# Identifies how highlight clips are encoded (moviepy libx264 + convert_to_compatible_format);
+# part of the rendered-segment cache key, so change it whenever the clip encode settings change.
+HIGHLIGHT_CLIP_ENCODE_PROFILE = "moviepy-libx264+compat-fast-yuv420p-aac-v1"
+
+# Whisper model for the low-priority full-text keyword pass of sparse transcription ("none" disables it)
+SPARSE_KEYWORD_MODEL = os.environ.get("SPARSE_KEYWORD_MODEL", "tiny")
+
+# Streaming render: the transcript is scored while it is still being transcribed (shard by shard, in
+# timeline order) and highlight clips that look settled in the top N are rendered right away, so the
+# job takes about max(ASR, rendering) instead of ASR + rendering. Early commits are best-effort: keyword
+# hits are not bounded (they are substring counts, so "ai" also hits in "said"), so no clip is certain
+# before the whole transcript is in. "bounded" commits a segment once no later segment with
+# STREAMING_ASSUMED_KEYWORD_HITS keyword hits or fewer can outrank it. That count is a guess at what
+# later segments will score, not a limit the scorer enforces; raise it to commit later and waste fewer
+# renders. "eager" renders the current top N as it changes.
+# A later segment that beats the bound makes a committed render wasted work, never a wrong result: the
+# final selection is made from the whole transcript as before, and the top N clips are rendered once it
+# is known (those already committed are copied from the rendered-segment cache).
+STREAMING_RENDER = os.environ.get("STREAMING_RENDER", "off")
+STREAMING_COMMIT_POLICY = os.environ.get("STREAMING_COMMIT_POLICY", "bounded")
+STREAMING_ASSUMED_KEYWORD_HITS = int(os.environ.get("STREAMING_ASSUMED_KEYWORD_HITS", "1"))
+STREAMING_RENDER_WORKERS = int(os.environ.get("STREAMING_RENDER_WORKERS", "1"))
+
+def download_from_url(url, output_dir=None, profile="full"):
+    """
+    Downloads a video from a URL using yt-dlp. profile is a download_cache.DOWNLOAD_PROFILES entry:
+    "full" quality, the "audio" stream only, or a low-resolution "analysis" stream.
+    """
+    logging.debug(f"Entering download_from_url with url: {url}, output_dir: {output_dir}, profile: {profile}")
     if output_dir is None:
         output_dir = BASE_DIR
     
-    logging.info(f"Downloading video from URL: {url}")
+    logging.info(f"Downloading video from URL ({profile} profile): {url}")
     
     # Set up yt-dlp options
     ydl_opts = {
-        'format': 'best[ext=mp4]/best',
-        'outtmpl': os.path.join(output_dir, 'downloaded_video.%(ext)s'),
         'quiet': False,
         'no_warnings': False,
         'ignoreerrors': False,
@@ -72,26 +119,44 @@ def download_from_url(url, output_dir=None):
     # The client_certificate option was causing issues, removed it
     
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            output_path = ydl.prepare_filename(info)
-            logging.debug(f"Exiting download_from_url, returning: {output_path}")
-            return output_path
+        # Shared download cache (by extractor, video id and selected format), single download per video
+        output_path, _info = download_profile(url, output_dir, profile, ydl_opts,
+                                              filename='downloaded_video' if profile == 'full' else f'downloaded_{profile}')
+        logging.debug(f"Exiting download_from_url, returning: {output_path}")
+        return output_path
     except Exception as e:
         logging.error(f"Error downloading video: {e}")
         logging.debug(f"Exiting download_from_url, returning: None")
         return None
 
+def download_analysis_video(url):
+    """Low-resolution download for scene detection and previews, kept for the job's lazy renders."""
+    video_path = download_from_url(url, profile="analysis")
+    return persist_source(video_path) if video_path else None
+
+def download_audio(url):
+    """Audio-only download for peaks and transcription, kept under SOURCES_DIR like the analysis video."""
+    audio_path = download_from_url(url, profile="audio")
+    return persist_source(audio_path) if audio_path else None
+
+def download_stage(job_dir, url, profile, download):
+    """A checkpointed download (ml_core/checkpoints.py): a retried job reuses the file while it exists."""
+    return run_stage(job_dir, f"download_{profile}", {"url": url, "format": DOWNLOAD_PROFILES[profile]},
+                     lambda: download(url), files=lambda path: [path])
+
 def detect_scenes(video_path):
-    """Detects scene boundaries in a video file."""
+    """
+    Detects scene boundaries in a video file. Uses the shared feature index when it is enabled (the
+    default); ml_core/scenes.py (downscaled, frame-skipping, cached per content hash) is the fallback
+    when ANALYSIS_INDEX=off.
+    """
     logging.debug(f"Entering detect_scenes with video_path: {video_path}")
+    apply_thread_allotment()
     try:
-        video = open_video(video_path)
-        scene_manager = SceneManager()
-        scene_manager.add_detector(ContentDetector(threshold=30.0))
-        scene_manager.detect_scenes(frame_source=video)
-        scenes_list = scene_manager.get_scene_list()
-        scenes_data = [(s[0].get_seconds(), s[1].get_seconds()) for s in scenes_list]
+        if ANALYSIS_INDEX_ENABLED:
+            scenes_data = load_feature_index(video_path).scenes(threshold=30.0)
+        else:
+            scenes_data = detect_scenes_cached(video_path, threshold=30.0)
         logging.debug(f"Exiting detect_scenes, returning {len(scenes_data)} scenes")
         return scenes_data
     except Exception as e:
@@ -103,6 +168,14 @@ def detect_scenes(video_path):
 def get_audio_peaks(video_path):
     """Extracts audio peaks from a video file."""
     logging.debug(f"Entering get_audio_peaks with video_path: {video_path}")
+    apply_thread_allotment()
+    if ANALYSIS_INDEX_ENABLED:
+        try:
+            peak_times = load_feature_index(video_path).audio_peaks()
+            logging.debug(f"Exiting get_audio_peaks, returning {len(peak_times)} peaks from the feature index")
+            return peak_times
+        except Exception as e:
+            logging.error(f"Audio peaks from feature index failed, decoding audio instead: {e}")
     temp_audio = os.path.join(BASE_DIR, "temp_audio.wav")
     try:
         logging.debug(f"Attempting to extract audio to {temp_audio} using ffmpeg.")
@@ -127,24 +200,6 @@ def get_audio_peaks(video_path):
             os.remove(temp_audio)
 
 
-def compute_score_enhanced(segment, peaks, keywords, scenes):
-    """Scores a transcription segment for highlight selection."""
-    logging.debug(f"Entering compute_score_enhanced for segment: {segment.get('text', '')[:50]}...")
-    score = 0
-    start, end, text = segment['start'], segment['end'], segment['text']
-    if any(start - 0.5 <= p <= end + 0.5 for p in peaks):
-        score += 1
-    score += sum(text.lower().count(k.lower()) * 2 for k in keywords)
-    if any(abs(start - s[0]) < 1 for s in scenes):
-        score += 1.5
-    duration = end - start
-    score += 0.5 if 3 <= duration <= 20 else -0.5 if duration < 3 or duration > 30 else 0
-    if '?' in text or '!' in text:
-        score += 0.5
-    logging.debug(f"Exiting compute_score_enhanced with score: {score}")
-    return score
-
-
 def add_subtitles_pillow(frame, segments, current_time, frame_size,
                          text_color=(255,255,255), bg_color=(0,0,0,180),
                          font_size=40, stroke_color=(0,0,0), stroke_width=2,
@@ -257,6 +312,7 @@ def convert_to_compatible_format(input_file, output_file=None):
         f"-vf 'pad=ceil(iw/2)*2:ceil(ih/2)*2' "
         f"-pix_fmt yuv420p "
         f"-c:a aac "
+        f"-threads {ffmpeg_threads()} "
         f"-movflags +faststart "
         f"-y '{output_file}'"
     )
@@ -321,43 +377,31 @@ def crop_frame_to_aspect_ratio(frame_array, target_w, target_h):
         
     return cropped_frame
 
-def extract_frames_from_highlights(video_path, highlights, output_dir,
-                                  frame_formats=["instagram", "landscape", "portrait"],
-                                  frames_per_segment=3):
-    logging.debug(f"Entering extract_frames_from_highlights for {len(highlights)} highlights, output_dir: {output_dir}, formats: {frame_formats}")
+FRAME_FORMAT_DIMENSIONS = {
+    "instagram": (INSTAGRAM_FRAME_WIDTH, INSTAGRAM_FRAME_HEIGHT),
+    "landscape": (LANDSCAPE_FRAME_WIDTH, LANDSCAPE_FRAME_HEIGHT),
+    "portrait": (PORTRAIT_FRAME_WIDTH, PORTRAIT_FRAME_HEIGHT),
+}
+
+def plan_highlight_frames(video_path, highlights, output_dir,
+                          frame_formats=["instagram", "landscape", "portrait"],
+                          frames_per_segment=3):
     """
-    Extract frames from highlight segments in various formats.
+    Plans screenshot frames of highlight segments in various formats. Frames are recorded as render
+    recipes and only grabbed when requested (see render_frame_recipe).
     
     Args:
         video_path: Path to the original video
         highlights: List of highlight segments with start/end times
-        output_dir: Base directory to save extracted frames
+        output_dir: Base directory the frames are saved to
         frame_formats: List of formats to extract (instagram, landscape, portrait)
         frames_per_segment: Number of frames to extract from each segment
+
+    Returns:
+        (frames metadata list, {relative frame path: recipe})
     """
-    if not highlights:
-        logging.info("No highlights to extract frames from.")
-        logging.debug("Exiting extract_frames_from_highlights, no highlights provided.")
-        return []
-    
-    # Create output directories for each format
-    frame_dirs = {}
-    for format_name in frame_formats:
-        format_dir = os.path.join(output_dir, f"{format_name}_frames")
-        os.makedirs(format_dir, exist_ok=True)
-        frame_dirs[format_name] = format_dir
-    
-    logging.info(f"Extracting frames from {len(highlights)} highlight clips...")
-    
-    try:
-        video = VideoFileClip(video_path)
-    except Exception as e:
-        logging.error(f"Error opening video for frame extraction: {e}")
-        logging.debug("Exiting extract_frames_from_highlights due to video open error.")
-        return []
-    
-    extracted_frames = []
-    
+    logging.debug(f"Entering plan_highlight_frames for {len(highlights)} highlights, output_dir: {output_dir}, formats: {frame_formats}")
+    planned_frames, recipes = [], {}
     for i, clip in enumerate(highlights):
         start_time = clip.get('start', 0)
         end_time = clip.get('end', 0)
@@ -374,96 +418,342 @@ def extract_frames_from_highlights(video_path, highlights, output_dir,
         ]
         
         for j, time_point in enumerate(time_points):
+            for format_name in frame_formats:
+                if format_name not in FRAME_FORMAT_DIMENSIONS:
+                    continue
+                target_w, target_h = FRAME_FORMAT_DIMENSIONS[format_name]
+                relative_path = f"{format_name}_frames/highlight_{i+1:02d}_frame_{j+1:02d}.jpg"
+                recipes[relative_path] = {"kind": "text_frame", "source": os.path.abspath(video_path),
+                                          "time": time_point, "width": target_w, "height": target_h}
+                planned_frames.append({
+                    "highlight_index": i+1,
+                    "frame_index": j+1,
+                    "format": format_name,
+                    "time": time_point,
+                    "file": os.path.join(output_dir, relative_path)
+                })
+    
+    logging.info(f"Planned {len(planned_frames)} frames in {len(frame_formats)} formats.")
+    return planned_frames, recipes
+
+def render_frame_recipe(recipe, output_path, job_dir):
+    """Grabs, crops and saves one recorded screenshot frame."""
+    video = VideoFileClip(recipe["source"])
+    try:
+        # Get frame at specified time point (in RGB format) and convert it to BGR for OpenCV
+        frame_bgr = cv2.cvtColor(video.get_frame(recipe["time"]), cv2.COLOR_RGB2BGR)
+    finally:
+        video.close()
+    processed_frame = crop_frame_to_aspect_ratio(frame_bgr, recipe["width"], recipe["height"])
+    if processed_frame is not None:
+        cv2.imwrite(output_path, processed_frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+def render_highlight_clip(sub, subs, target_aspect, output_path, temp_dir, temp_label, fps=None):
+    """
+    Crops a highlight subclip to target_aspect, burns in subtitles and writes it in the
+    web-compatible format. Returns the output path, or None if the final file was not created.
+    """
+    clip = crop_to_aspect_ratio(sub, target_aspect=target_aspect)
+    
+    if subs:
+        logging.debug(f"    Adding subtitles to {temp_label} clip")
+        clip = clip.fl(
+            lambda get_frame, t: add_subtitles_pillow(
+                get_frame(t),
+                subs,
+                t,
+                clip.size
+            ),
+            keep_duration=True
+        )
+    
+    output_dir_for_clip = os.path.dirname(output_path)
+    temp_path = os.path.join(output_dir_for_clip, f"temp_{os.path.basename(output_path)}")
+    
+    logging.info(f"    Attempting to save temporary file: {temp_path}")
+    clip.write_videofile(
+        temp_path,
+        codec="libx264",
+        audio_codec="aac",
+        temp_audiofile=os.path.join(temp_dir, f"temp-audio-{temp_label}.m4a"),
+        remove_temp=True,
+        fps=fps if fps else 24,
+        threads=thread_allotment(),
+        verbose=False,
+        logger=None # Suppress moviepy console output
+    )
+    logging.info(f"    Successfully saved temporary file: {temp_path}")
+    
+    # Convert to compatible format
+    final_path = convert_to_compatible_format(temp_path, output_path)
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    return final_path if final_path and os.path.exists(final_path) else None
+
+
+def transcribe_for_highlights(video_path, scenes, peaks, asr_model="base", asr_engine=None, sharded=None,
+                              sparse=None, keyword_model=None, on_segments=None):
+    """
+    Transcribes the video for highlight scoring. Returns (result, full_text).
+
+    In sparse mode only padded windows around audio peaks and scene starts that contain speech are
+    decoded, since compute_score_enhanced only rewards segments near those anchors; the timestamps are
+    mapped back to the source timeline. full_text (used for the keyword hashtags) then comes from a
+    full pass with a small model running at low CPU priority alongside the main pass, or from the
+    sparse transcript if that pass is disabled or fails. Segments far from any anchor that only score
+    on keywords are not found in sparse mode.
+    on_segments(segments, processed_until) receives the segments in timeline order as they are transcribed.
+    """
+    sparse = (sparse or SPARSE_TRANSCRIPTION_MODE) == "on"
+    if not sparse:
+        result = transcribe_media(video_path, asr_model, sharded=sharded, engine=asr_engine, on_segments=on_segments)
+        return result, result.get("text", "")
+
+    # A full transcript from an earlier run (or from /transcribe/video/) beats a sparse one
+    result = cached_transcript(video_path, asr_model, asr_engine)
+    if result is not None:
+        if on_segments is not None:
+            on_segments(result.get("segments", []), float("inf"))
+        return result, result.get("text", "")
+
+    audio = load_audio(video_path)
+    duration = len(audio) / SAMPLE_RATE
+    anchors = list(peaks) + [scene[0] for scene in scenes]
+    windows = plan_sparse_windows(anchors, duration, speech=energy_vad(audio))
+    coverage = window_coverage(windows, duration)
+    if not windows or coverage > SPARSE_MAX_COVERAGE:
+        logging.info(f"Sparse transcription would cover {coverage:.0%} of the video, transcribing it fully instead.")
+        result = transcribe_media(audio, asr_model, sharded=sharded, engine=asr_engine, on_segments=on_segments)
+        return result, result.get("text", "")
+
+    keyword_model = keyword_model or SPARSE_KEYWORD_MODEL
+    keyword_future = None
+    if keyword_model != "none":
+        logging.info(f"Starting low-priority full-text keyword pass with whisper model ({keyword_model}).")
+        keyword_future = start_low_priority_transcription(audio, keyword_model, asr_engine)
+
+    logging.info(f"Sparse transcription of {len(windows)} windows covering {coverage:.0%} of {duration:.1f}s.")
+    result = transcribe_windows(audio, windows, asr_model, engine=asr_engine, on_segments=on_segments)
+
+    full_text = result.get("text", "")
+    if keyword_future is not None:
+        try:
+            full_text = keyword_future.result()
+        except Exception as e:
+            logging.warning(f"Keyword pass failed, using the sparse transcript for keywords: {e}")
+    return result, full_text
+
+
+def render_highlight_recipe(recipe, output_path, job_dir):
+    """Renders one recorded highlight clip, reusing a cached render of the same segment when there is one."""
+    target_aspect = tuple(recipe["aspect"])
+    segment_cache = SegmentCache()
+    cache_key = None
+    if segment_cache.enabled:
+        cache_key = segment_cache_key(file_content_hash(recipe["source"]), recipe["start"], recipe["end"],
+                                      f"crop:{target_aspect[0]}:{target_aspect[1]}", HIGHLIGHT_CLIP_ENCODE_PROFILE, recipe["subs"])
+        if segment_cache.fetch(cache_key, output_path):
+            logging.info(f"    Reused cached render for {output_path}")
+            return output_path
+
+    original_clip = VideoFileClip(recipe["source"])
+    try:
+        sub = original_clip.subclip(recipe["start"], recipe["end"])
+        rendered_path = render_highlight_clip(
+            sub, recipe["subs"], target_aspect, output_path, job_dir,
+            f"{target_aspect[0]}x{target_aspect[1]}-{Path(output_path).stem}", recipe.get("fps") or original_clip.fps
+        )
+    finally:
+        original_clip.close()
+    if cache_key:
+        segment_cache.store(cache_key, rendered_path)
+    return rendered_path
+
+
+def highlight_subs(segments, clip_data):
+    """Subtitles of a highlight: the transcript segments inside it, timed relative to its start."""
+    return [{'start': float(s['start']) - clip_data['start'], 'end': float(s['end']) - clip_data['start'], 'text': s['text']}
+            for s in segments if s['start']>=clip_data['start'] and s['end']<=clip_data['end']]
+
+
+class StreamingHighlightRenders:
+    """
+    Streaming render mode of process_video_for_highlights (STREAMING_RENDER). add_segments() is the
+    transcription's on_segments callback: it scores the new segments (once peaks and scenes are there)
+    and renders committed highlight clips in a small thread pool into the rendered-segment cache while
+    transcription goes on. finish() renders the final top N into the job directory.
+    """
+
+    def __init__(self, wait_for_video, peaks, scenes, num_clips, aspects, policy=None):
+        # peaks, scenes: Futures of those steps' outputs (PipelineGraph.output), not waited for
+        self.wait_for_video = wait_for_video
+        self.peaks, self.scenes = peaks, scenes
+        self.num_clips = num_clips
+        self.aspects = aspects
+        policy = policy or STREAMING_COMMIT_POLICY
+        self.max_unseen_score = (None if policy == "eager"
+                                 else TEXT_SCORE_MAX_WITHOUT_KEYWORDS + KEYWORD_HIT_SCORE * STREAMING_ASSUMED_KEYWORD_HITS)
+        self.segments, self.scores = [], []
+        self.committed = {}  # start of a committed segment -> Future of its renders
+        self.video = None
+        self.lock = threading.Lock()
+        # Separate from self.lock: waiting for the video download must not hold up the transcription's callbacks
+        self.video_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, STREAMING_RENDER_WORKERS), thread_name_prefix="streaming-render")
+
+    def add_segments(self, segments, processed_until):
+        with self.lock:
+            self.segments.extend(segments)
+            if not (self.peaks.done() and self.scenes.done()) or self.peaks.exception() or self.scenes.exception():
+                logging.info(f"Streaming: {processed_until:.1f}s transcribed, waiting for peaks and scenes to score it")
+                return
+            peaks, scenes = self.peaks.result(), self.scenes.result()
+            self.scores.extend(compute_score_enhanced(segment, peaks, HIGHLIGHT_KEYWORDS, scenes)
+                               for segment in self.segments[len(self.scores):])
+            for index in committed_text_highlights(self.scores, self.num_clips, self.max_unseen_score):
+                segment = self.segments[index]
+                key = float(segment["start"])
+                if key not in self.committed:
+                    logging.info(f"Streaming: committed segment {key:.2f}s-{segment['end']:.2f}s (score {self.scores[index]}), rendering it")
+                    self.committed[key] = self.pool.submit(self._render_segment, dict(segment), list(self.segments))
+            logging.info(f"Streaming: {processed_until:.1f}s transcribed, {len(self.committed)} clips committed")
+
+    def _video_info(self):
+        with self.video_lock:
+            if self.video is None:
+                video_path = self.wait_for_video()
+                clip = VideoFileClip(video_path)
+                self.video = {"source": os.path.abspath(video_path), "duration": clip.duration, "fps": clip.fps}
+                clip.close()
+            return self.video
+
+    def _render_segment(self, segment, segments):
+        # The same recipe the final highlight gets, so its render lands under the same segment cache key
+        video = self._video_info()
+        start, end = segment["start"], min(segment["end"], video["duration"])
+        if end - start < 0.1:
+            return
+        recipe = {"kind": "text_highlight", "source": video["source"], "start": start, "end": end,
+                  "subs": highlight_subs(segments, segment), "fps": video["fps"]}
+        work_dir = tempfile.mkdtemp(prefix="streaming_render_")
+        try:
+            with concurrent_step():
+                for aspect in self.aspects:
+                    render_highlight_recipe({**recipe, "aspect": list(aspect)},
+                                            os.path.join(work_dir, f"highlight_{aspect[0]}x{aspect[1]}.mp4"), work_dir)
+        except Exception as e:
+            logging.error(f"Streaming render of {start:.2f}s-{end:.2f}s failed: {e}")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def finish(self, job_dir, recipes):
+        """Renders the recorded highlight clips, after the streaming renders of the same segments."""
+        highlight_outputs = sorted(rel for rel, recipe in recipes.items() if recipe["kind"] == "text_highlight")
+
+        def render(relative_path):
+            recipe = recipes[relative_path]
+            committed = self.committed.get(float(recipe["start"]))
+            if committed is not None:
+                committed.result()
+            with concurrent_step():
+                render_output(job_dir, relative_path)
+
+        renders = [self.pool.submit(render, rel) for rel in highlight_outputs]
+        for relative_path, future in zip(highlight_outputs, renders):
             try:
-                # Get frame at specified time point (in RGB format)
-                frame_rgb = video.get_frame(time_point)
-                
-                # Convert from RGB to BGR for OpenCV
-                frame_bgr = cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR)
-                
-                # Process and save frame in each requested format
-                for format_name in frame_formats:
-                    if format_name == "instagram":
-                        target_w, target_h = INSTAGRAM_FRAME_WIDTH, INSTAGRAM_FRAME_HEIGHT
-                    elif format_name == "landscape":
-                        target_w, target_h = LANDSCAPE_FRAME_WIDTH, LANDSCAPE_FRAME_HEIGHT
-                    elif format_name == "portrait":
-                        target_w, target_h = PORTRAIT_FRAME_WIDTH, PORTRAIT_FRAME_HEIGHT
-                    else:
-                        continue
-                    
-                    # Crop and resize frame to target aspect ratio
-                    processed_frame = crop_frame_to_aspect_ratio(frame_bgr, target_w, target_h)
-                    
-                    if processed_frame is not None:
-                        # Save frame to file
-                        output_path = os.path.join(
-                            frame_dirs[format_name],
-                            f"highlight_{i+1:02d}_frame_{j+1:02d}.jpg"
-                        )
-                        logging.debug(f"Attempting to save frame: {output_path}")
-                        cv2.imwrite(output_path, processed_frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
-                        logging.debug(f"Successfully saved frame: {output_path}")
-                        
-                        # Add to extracted frames list
-                        extracted_frames.append({
-                            "highlight_index": i+1,
-                            "frame_index": j+1,
-                            "format": format_name,
-                            "time": time_point,
-                            "file": output_path
-                        })
+                future.result()
             except Exception as e:
-                logging.error(f"Error extracting frame from segment {i+1} at time {time_point:.2f}s for format {format_name}: {e}")
-    
-    video.close()
-    
-    logging.info(f"Successfully extracted {len(extracted_frames)} frames in {len(frame_formats)} formats.")
-    logging.debug(f"Exiting extract_frames_from_highlights, extracted {len(extracted_frames)} frames.")
-    return extracted_frames
-
-def process_video_for_highlights(source, num_clips=5, output_dir=None, generate_both_formats=True, extract_frames=True):
-    """Main pipeline: download/transcribe/process and save highlight clips."""
-    logging.debug(f"Entering process_video_for_highlights with source: {source}, num_clips: {num_clips}, output_dir: {output_dir}, generate_both: {generate_both_formats}, extract_frames: {extract_frames}")
-    # Prepare video
-    video_path = source
-    if not os.path.exists(video_path):
-        logging.error(f"Video not found: {video_path}")
-        raise FileNotFoundError(f"Video not found: {video_path}")
-    
-    logging.info(f"Detecting scenes for {video_path}")
-    scenes = detect_scenes(video_path)
-    logging.info(f"Extracting audio peaks for {video_path}")
-    peaks = get_audio_peaks(video_path)
-    
-    # Transcription
-    logging.info("Loading whisper model (base)...")
-    model = whisper.load_model("base")
-    logging.info(f"Transcribing video: {video_path}")
-    result = model.transcribe(video_path)
+                logging.error(f"Render of {relative_path} failed: {e}")
+        self.pool.shutdown(wait=True)
+        reused = sum(1 for rel in highlight_outputs if float(recipes[rel]["start"]) in self.committed)
+        logging.info(f"Streaming: {len(highlight_outputs)} highlight clips rendered, {reused} of them while transcribing")
+
+
+def process_video_for_highlights(source, num_clips=5, output_dir=None, generate_both_formats=True, extract_frames=True,
+                                 asr_model="base", sharded_transcription=None, asr_engine=None,
+                                 sparse_transcription=None, audio_source=None, source_url=None, streaming_render=None):
+    """
+    Main pipeline: download/transcribe/process and save highlight clips.
+
+    URL jobs pass the downloaded audio stream as audio_source and the low-resolution video as source,
+    usually a Future of its still running download: peaks and transcription start from the audio while
+    the video arrives. Outputs are recorded with source_url, so they render from the full-quality stream.
+    Scenes, peaks, transcription and scoring are checkpointed steps of a graph (see below) in output_dir.
+    With streaming_render "on" (default: STREAMING_RENDER env) highlight clips are rendered while the
+    video is still being transcribed (StreamingHighlightRenders).
+    """
+    logging.debug(f"Entering process_video_for_highlights with source: {source}, num_clips: {num_clips}, output_dir: {output_dir}, generate_both: {generate_both_formats}, extract_frames: {extract_frames}, audio_source: {audio_source}")
+
+    def wait_for_video():
+        video_path = source.result() if isinstance(source, Future) else source
+        if not video_path or not os.path.exists(video_path):
+            logging.error(f"Video not found: {video_path}")
+            raise FileNotFoundError(f"Video not found: {video_path}")
+        return video_path
+
+    def scenes_step(video_path):
+        logging.info(f"Detecting scenes for {video_path}")
+        return detect_scenes(video_path)
+
+    def peaks_step(audio_path):
+        logging.info(f"Extracting audio peaks for {audio_path}")
+        return get_audio_peaks(audio_path)
+
+    def transcription_step(audio_path, peaks=(), scenes=()):
+        logging.info(f"Transcribing video with whisper model ({asr_model}, {asr_engine or 'default engine'}): {audio_path}")
+        result, full_text = transcribe_for_highlights(audio_path, scenes, peaks, asr_model, asr_engine,
+                                                      sharded=sharded, sparse=sparse_transcription,
+                                                      on_segments=streaming.add_segments if streaming else None)
+        return {"result": result, "full_text": full_text}
+
+    def scoring_step(transcript, peaks, scenes):
+        logging.info("Filtering and scoring segments...")
+        return select_text_highlights(transcript["result"].get("segments", []), peaks, scenes, transcript["full_text"],
+                                      num_clips, HIGHLIGHT_KEYWORDS)
+
+    # The analysis runs as a step graph (ml_core/pipeline_graph.py): scene detection, audio peaks and
+    # transcription run concurrently, except that sparse transcription anchors its windows on the peaks
+    # and scene starts and so waits for them. Steps are checkpointed in the job directory; a retried
+    # job with different parameters only reruns the steps downstream of the changed ones.
+    sparse = (sparse_transcription or SPARSE_TRANSCRIPTION_MODE) == "on"
+    graph = PipelineGraph(output_dir)
+
+    # Streaming render needs the transcript in timeline order (always sharded; shards arrive in order)
+    # and the rendered-segment cache to hand the clips rendered meanwhile to the final renders
+    streaming = None
+    sharded = sharded_transcription or SHARDED_TRANSCRIPTION_MODE
+    if (streaming_render or STREAMING_RENDER) == "on":
+        if source_url:
+            logging.info("Streaming render is off for URL jobs: their clips render from the full-quality stream on demand")
+        elif not SegmentCache().enabled:
+            logging.warning("Streaming render needs the rendered-segment cache (SEGMENT_CACHE), rendering after selection instead")
+        else:
+            sharded = "on"
+            streaming = StreamingHighlightRenders(wait_for_video, graph.output("peaks"), graph.output("scenes"), num_clips,
+                                                  [(9, 16), (16, 9)] if generate_both_formats else [(16, 9)])
+    graph.add_step("video", wait_for_video, checkpoint=False, fingerprint=file_fingerprint)
+    if audio_source:
+        graph.add_step("audio", lambda: audio_source, checkpoint=False, fingerprint=file_fingerprint)
+    else:
+        graph.add_step("audio", lambda video_path: video_path, inputs=["video"], checkpoint=False, fingerprint=file_fingerprint)
+    graph.add_step("scenes", scenes_step, inputs=["video"], params={"threshold": 30.0})
+    graph.add_step("peaks", peaks_step, inputs=["audio"])
+    graph.add_step("transcription", transcription_step, inputs=["audio", "peaks", "scenes"] if sparse else ["audio"],
+                   params={"model": asr_model, "engine": asr_engine or DEFAULT_ENGINE, "sparse": sparse,
+                           "sharded": sharded,
+                           "keyword_model": SPARSE_KEYWORD_MODEL if sparse else None})
+    graph.add_step("scoring", scoring_step, inputs=["transcription", "peaks", "scenes"],
+                   params={"num_clips": num_clips, "keywords": HIGHLIGHT_KEYWORDS})
+    try:
+        outputs = graph.run()
+    except BaseException:
+        if streaming is not None:
+            streaming.pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    video_path, peaks, scenes, top = outputs["video"], outputs["peaks"], outputs["scenes"], outputs["scoring"]
+    result, full_text = outputs["transcription"]["result"], outputs["transcription"]["full_text"]
     raw_segments = result.get("segments", [])
     logging.info(f"Found {len(raw_segments)} raw segments initially from transcription.")
-    
-    keywords = ["главное","вопрос","важно","итог","ответ",
-                "ключевое","education","students","learning","school",
-                "ai", "developers", "artificial", "intelligence", "coding"]
-    
-    found = [k for k in keywords if k in result.get("text","").lower()]
-    data = []
-    logging.info("Filtering and scoring segments...")
-    for seg_idx, seg in enumerate(raw_segments):
-        logging.debug(f"Processing raw segment {seg_idx + 1}/{len(raw_segments)}: Start: {seg.get('start', 0):.2f}s, End: {seg.get('end', 0):.2f}s, Text: '{seg.get('text', '')[:50]}...'")
-        score = compute_score_enhanced(seg, peaks, keywords, scenes)
-        if score <= 0:
-            logging.debug(f"Segment {seg_idx + 1} (Start: {seg.get('start',0):.2f}s) failed filtering with score {score}.")
-            continue
-        logging.info(f"Segment {seg_idx + 1} (Start: {seg.get('start',0):.2f}s) passed filtering with score {score}.")
-        hashtags = list({f"#{w.lower()}" for w in seg['text'].split() if w.isalpha() and len(w)>3} |
-                        {f"#{k.lower()}" for k in found})
-        data.append({**seg, 'score': score, 'hashtags': hashtags})
-    
-    logging.info(f"Selected {len(data)} segments after scoring, sorting to get top {num_clips}.")
-    top = sorted(data, key=lambda x: -x['score'])[:num_clips]
     logging.info(f"Attempting to create highlight clips from {len(top)} candidate segments.")
     
     # Save clips
@@ -480,7 +770,20 @@ def process_video_for_highlights(source, num_clips=5, output_dir=None, generate_
     logging.info(f"Processing video into up to {num_clips} highlight clips...")
     original_clip = VideoFileClip(video_path)
     original_clip_duration = original_clip.duration
+
+    # Keep the selection inputs with the job so POST /jobs/{id}/select can re-rank without the media
+    try:
+        write_selection_features(output_dir, "text", {
+            "duration": original_clip_duration,
+            "segments": [{"start": float(seg["start"]), "end": float(seg["end"]), "text": seg["text"]} for seg in raw_segments],
+            "peaks": [float(p) for p in peaks],
+            "scenes": [[float(start), float(end)] for start, end in scenes],
+            "full_text": full_text,
+        })
+    except OSError as e:
+        logging.warning(f"Could not store selection features in {output_dir}: {e}")
     results = []
+    recipes = {}
     
     if not top:
         logging.warning("No segments selected as top candidates. No highlight clips will be generated.")
@@ -540,108 +843,32 @@ def process_video_for_highlights(source, num_clips=5, output_dir=None, generate_
             logging.warning(f"Segment for clip {i} is too short ({segment_end_time - segment_start_time:.3f}s) after clamping: Start {segment_start_time:.2f}s, End {segment_end_time:.2f}s. Minimum duration is {min_clip_duration}s. Skipping this highlight.")
             continue
 
-        sub = video.subclip(segment_start_time, segment_end_time)
-        subs = [{'start':s['start']-clip_data['start'], 'end':s['end']-clip_data['start'], 'text':s['text']} \
-                for s in result['segments'] if s['start']>=clip_data['start'] and s['end']<=clip_data['end']]
-        
-        portrait_path_final = None # Initialize
-        # Create portrait (vertical) version
+        subs = highlight_subs(result['segments'], clip_data)
+
+        # The clips are recorded as render recipes and rendered when first requested (or at the end, if eager)
+        highlight_recipe = {"kind": "text_highlight", "source": os.path.abspath(video_path), "start": segment_start_time,
+                            "end": segment_end_time, "subs": subs, "fps": original_clip.fps}
+        portrait_path_final = None
         if generate_both_formats:
-            logging.info(f"  - Creating portrait (9:16) version for highlight {i}...")
-            portrait = crop_to_aspect_ratio(sub, target_aspect=(9, 16))
-            
-            if subs:
-                logging.debug(f"    Adding subtitles to portrait clip {i}")
-                portrait = portrait.fl(
-                    lambda get_frame, t: add_subtitles_pillow(
-                        get_frame(t),
-                        subs,
-                        t,
-                        portrait.size
-                    ),
-                    keep_duration=True
-                )
-            
+            recipes[f"portrait/highlight_{i}.mp4"] = {**highlight_recipe, "aspect": [9, 16]}
             portrait_path_final = os.path.join(portrait_dir, f"highlight_{i}.mp4")
-            temp_portrait_path = os.path.join(portrait_dir, f"temp_highlight_{i}.mp4")
-            
-            logging.info(f"    Attempting to save temporary portrait file: {temp_portrait_path}")
-            portrait.write_videofile(
-                temp_portrait_path,
-                codec="libx264",
-                audio_codec="aac",
-                temp_audiofile=os.path.join(output_dir, f"temp-audio-portrait-{i}.m4a"),
-                remove_temp=True,
-                fps=video.fps if video.fps else 24,
-                verbose=False,
-                logger=None # Suppress moviepy console output
-            )
-            logging.info(f"    Successfully saved temporary portrait file: {temp_portrait_path}")
-            
-            # Convert to compatible format
-            portrait_path_final = convert_to_compatible_format(temp_portrait_path, portrait_path_final)
-            if os.path.exists(temp_portrait_path):
-                os.remove(temp_portrait_path)
-            
-            if portrait_path_final and os.path.exists(portrait_path_final):
-                logging.info(f"    Successfully created final portrait clip: {portrait_path_final}")
-            else:
-                logging.warning(f"    Failed to create/find final portrait clip for highlight {i} at expected path: {portrait_path_final or os.path.join(portrait_dir, f'highlight_{i}.mp4')}")
-                portrait_path_final = None # Ensure it's None if failed
-        
-        # Create landscape (16:9) version
-        logging.info(f"  - Creating landscape (16:9) version for highlight {i}...")
-        landscape = crop_to_aspect_ratio(sub, target_aspect=(16, 9))
-        
-        if subs:
-            logging.debug(f"    Adding subtitles to landscape clip {i}")
-            landscape = landscape.fl(
-                lambda get_frame, t: add_subtitles_pillow(
-                    get_frame(t),
-                    subs,
-                    t,
-                    landscape.size
-                ),
-                keep_duration=True
-            )
-        
+        recipes[f"landscape/highlight_{i}.mp4"] = {**highlight_recipe, "aspect": [16, 9]}
         landscape_path_final = os.path.join(landscape_dir, f"highlight_{i}.mp4")
-        temp_landscape_path = os.path.join(landscape_dir, f"temp_highlight_{i}.mp4")
-        
-        logging.info(f"    Attempting to save temporary landscape file: {temp_landscape_path}")
-        landscape.write_videofile(
-            temp_landscape_path,
-            codec="libx264",
-            audio_codec="aac",
-            temp_audiofile=os.path.join(output_dir, f"temp-audio-landscape-{i}.m4a"),
-            remove_temp=True,
-            fps=video.fps if video.fps else 24,
-            verbose=False,
-            logger=None # Suppress moviepy console output
-        )
-        logging.info(f"    Successfully saved temporary landscape file: {temp_landscape_path}")
-        
-        # Convert to compatible format
-        landscape_path_final = convert_to_compatible_format(temp_landscape_path, landscape_path_final)
-        if os.path.exists(temp_landscape_path):
-            os.remove(temp_landscape_path)
-
-        if landscape_path_final and os.path.exists(landscape_path_final):
-            logging.info(f"    Successfully created final landscape clip: {landscape_path_final}")
-        else:
-            logging.warning(f"    Failed to create/find final landscape clip for highlight {i} at expected path: {landscape_path_final or os.path.join(landscape_dir, f'highlight_{i}.mp4')}")
-            landscape_path_final = None # Ensure it's None if failed
+        # A fast low-resolution preview (subtitles as a VTT sidecar) stands for both formats until they are rendered
+        full_outputs = [rel for rel in (f"portrait/highlight_{i}.mp4", f"landscape/highlight_{i}.mp4") if rel in recipes]
+        recipes.update(preview_recipes(f"highlight_{i}", highlight_recipe["source"], [(segment_start_time, segment_end_time)],
+                                       (9, 16) if generate_both_formats else (16, 9), full_outputs, subs))
         
         # Add to results - use landscape as default for metadata
-        results.append({**clip_data, 'file': landscape_path_final, 'portrait_file': portrait_path_final})
+        results.append({**clip_data, 'file': landscape_path_final, 'portrait_file': portrait_path_final,
+                        'clip_start': segment_start_time, 'clip_end': segment_end_time})
     
-    video.close()
+    original_clip.close()
 
-    num_portrait_results = sum(1 for r in results if r.get('portrait_file'))
-    if generate_both_formats and num_portrait_results == 0 and top:
-        logging.error(f"No portrait highlight clips were successfully generated and saved from {len(top)} candidates. Check logs for individual segment processing details.")
-    elif generate_both_formats and top:
-        logging.info(f"Successfully generated {num_portrait_results} portrait clips out of {len(top)} candidates.")
+    if generate_both_formats and top and not any(r.get('portrait_file') for r in results):
+        logging.error(f"No portrait highlight clips could be planned from {len(top)} candidates. Check logs for individual segment processing details.")
+    else:
+        logging.info(f"Recorded {len(results)} highlight clips out of {len(top)} candidates.")
 
     # Save metadata
     meta_path = os.path.join(output_dir, "highlights.json")
@@ -660,12 +887,13 @@ def process_video_for_highlights(source, num_clips=5, output_dir=None, generate_
             frame_formats.append("portrait")
         frame_formats.append("instagram")  # Always include Instagram format
         
-        extracted_frames = extract_frames_from_highlights(
+        extracted_frames, frame_recipes = plan_highlight_frames(
             video_path, 
             top,  # Use the top segments
             output_dir,
             frame_formats=frame_formats
         )
+        recipes.update(frame_recipes)
         
         # Save extracted frames metadata
         frames_meta_path = os.path.join(output_dir, "frames.json")
@@ -674,11 +902,20 @@ def process_video_for_highlights(source, num_clips=5, output_dir=None, generate_
             json.dump(extracted_frames, f, ensure_ascii=False, indent=2)
         logging.info(f"Successfully saved frames metadata to: {frames_meta_path}")
     
+    if source_url:
+        # Analysed on reduced downloads: full-quality renders fetch the stream itself (render_recipes.with_render_source)
+        for recipe in recipes.values():
+            if "source" in recipe:
+                recipe["source_url"] = source_url
+    record_recipes(output_dir, recipes)
+    if streaming is not None:
+        streaming.finish(output_dir, recipes)
+    
     logging.debug(f"Exiting process_video_for_highlights, returning {len(results)} highlights")
     return results
 
 
-def merge_highlights_with_transitions(clips_dir, output_file, transition_duration=0.1, format="landscape"):
+def merge_highlights_with_transitions(clips_dir, output_file, transition_duration=0.1, format="landscape", engine="ffmpeg"):
     """
     Merges multiple highlight clips with smooth crossfade transitions into a single video.
     
@@ -687,9 +924,9 @@ def merge_highlights_with_transitions(clips_dir, output_file, transition_duratio
         output_file: Path for the output merged video
         transition_duration: Duration of transitions in seconds
         format: Either "landscape" or "portrait"
+        engine: "ffmpeg" builds one xfade/acrossfade filter graph and encodes once,
+                "moviepy" composites the fades in Python (also used as a fallback)
     """
-    from moviepy.editor import VideoFileClip, concatenate_videoclips, vfx
-    
     # Get the proper format directory
     if format == "landscape":
         format_dir = os.path.join(clips_dir, "landscape")
@@ -709,11 +946,32 @@ def merge_highlights_with_transitions(clips_dir, output_file, transition_duratio
         return None
     
     logging.info(f"Merging {len(highlight_files)} {format} highlight clips from {format_dir} into a single video: {output_file}")
+    clip_paths = [os.path.join(format_dir, f) for f in highlight_files]
+    return merge_highlight_files(clip_paths, output_file, transition_duration, engine)
+
+
+def merge_highlight_files(clip_paths, output_file, transition_duration=0.1, engine="ffmpeg"):
+    """Merges the given clips (in order) with crossfade transitions; see merge_highlights_with_transitions."""
+    if engine == "ffmpeg":
+        final_merged_path = merge_clips_with_xfade(clip_paths, output_file, transition_duration)
+        if final_merged_path and os.path.exists(final_merged_path):
+            logging.info(f"Successfully merged highlights to {final_merged_path}")
+            return final_merged_path
+        logging.warning("ffmpeg xfade merge failed, falling back to moviepy compositing.")
+
+    return _merge_highlights_moviepy(clip_paths, output_file, transition_duration)
+
+
+def _merge_highlights_moviepy(clip_paths, output_file, transition_duration):
+    """Legacy merge: fades are composited frame by frame in Python, then transcoded again."""
+    from moviepy.editor import VideoFileClip, concatenate_videoclips
+
     video_clips = []
+    final_merged_path = None
     try:
         # Load and prepare clips with fade effects
-        for file in highlight_files:
-            clip = VideoFileClip(os.path.join(format_dir, file))
+        for clip_path in clip_paths:
+            clip = VideoFileClip(clip_path)
             # Add fadeout to end of clip
             clip = clip.fadein(transition_duration).fadeout(transition_duration)
             video_clips.append(clip)
@@ -734,6 +992,7 @@ def merge_highlights_with_transitions(clips_dir, output_file, transition_duratio
             temp_audiofile="temp-audio-merge.m4a",
             remove_temp=True,
             fps=video_clips[0].fps,
+            threads=thread_allotment(),
             verbose=False,
             logger=None # Suppress moviepy console output
         )
@@ -757,6 +1016,12 @@ def merge_highlights_with_transitions(clips_dir, output_file, transition_duratio
     return final_merged_path if final_merged_path and os.path.exists(final_merged_path) else None
 
 
+def render_merged_recipe(recipe, output_path, job_dir):
+    """Renders a recorded merged reel from its highlight clips (rendered first by the recipe machinery)."""
+    clip_paths = [os.path.join(job_dir, input_path) for input_path in recipe["inputs"]]
+    merge_highlight_files(clip_paths, output_path, recipe.get("transition_duration", 0.1), recipe.get("engine", "ffmpeg"))
+
+
 def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description="Extract, process and create highlight videos from a source video")
@@ -771,6 +1036,8 @@ def parse_arguments():
     parser.add_argument('--clips', type=int, default=NUM_CLIPS, help="Number of highlight clips to extract")
     parser.add_argument('--merge', action='store_true', default=MERGE_CLIPS, help="Merge highlight clips into a single video")
     parser.add_argument('--no-merge', dest='merge', action='store_false', help="Don't merge highlight clips")
+    parser.add_argument('--merge-engine', choices=['ffmpeg', 'moviepy'], default='ffmpeg',
+                        help="Merge engine: 'ffmpeg' (single xfade filter graph encode) or 'moviepy' (legacy compositing)")
     parser.add_argument('--formats', choices=['both', 'landscape', 'portrait'], default='both', 
                         help="Which format(s) to generate: 'landscape' (16:9), 'portrait' (9:16), or 'both'")
     parser.add_argument('--frames', action='store_true', default=EXTRACT_FRAMES, 
@@ -780,6 +1047,17 @@ def parse_arguments():
     parser.add_argument('--frames-per-clip', type=int, default=3, 
                         help="Number of frames to extract from each highlight clip")
     
+    parser.add_argument('--asr-model', type=str, default="base",
+                        help="Whisper model used for transcription (tiny, base, small, ...)")
+    parser.add_argument('--sharded-transcription', choices=['auto', 'on', 'off'], default=None,
+                        help="Transcribe long videos in parallel shards split at silences (default: SHARDED_TRANSCRIPTION env or 'auto')")
+    parser.add_argument('--asr-engine', choices=['fp32', 'int8'], default=None,
+                        help="Whisper inference engine: fp32, or int8 quantized Linear layers for CPU-only hosts (default: ASR_ENGINE env or 'fp32')")
+    parser.add_argument('--sparse-transcription', choices=['on', 'off'], default=None,
+                        help="Only transcribe windows around audio peaks and scene cuts (default: SPARSE_TRANSCRIPTION env or 'off')")
+    parser.add_argument('--streaming-render', choices=['on', 'off'], default=None,
+                        help="Render highlight clips while the video is still being transcribed (default: STREAMING_RENDER env or 'off')")
+    
     # Add max duration parameter for YouTube Shorts
     parser.add_argument("--max-duration", type=int, default=None, 
                       help="Maximum duration in seconds for each highlight clip (useful for Shorts/TikTok)")
@@ -800,19 +1078,29 @@ if __name__ == "__main__":
     
     # Determine video source
     video_source = None
+    audio_source = None
     if args.file:
         video_source = args.file
         if not os.path.exists(video_source):
             logging.error(f"Error: File not found: {video_source}")
             sys.exit(1)
     elif args.url:
-        # Download video from URL
-        logging.info(f"URL provided, attempting download: {args.url}")
-        video_source = download_from_url(args.url)
-        if not video_source:
-            logging.error(f"Error: Failed to download video from URL: {args.url}")
-            sys.exit(1)
-        logging.info(f"Video downloaded to: {video_source}")
+        # Only the audio is needed to start transcribing; the low-resolution video (scenes, previews)
+        # downloads meanwhile, and the full-quality stream is fetched when an output is rendered
+        logging.info(f"URL provided, downloading the audio stream first: {args.url}")
+        audio_source = download_stage(OUTPUT_DIR, args.url, "audio", download_audio)
+        if audio_source:
+            logging.info(f"Audio downloaded to: {audio_source}")
+            video_source = ThreadPoolExecutor(max_workers=1).submit(download_stage, OUTPUT_DIR, args.url, "analysis",
+                                                                    download_analysis_video)
+        else:
+            logging.warning(f"Audio-only download failed, downloading the analysis video instead: {args.url}")
+            # Outputs are rendered on demand later, so keep the source where the next download will not overwrite it
+            video_source = download_stage(OUTPUT_DIR, args.url, "analysis", download_analysis_video)
+            if not video_source:
+                logging.error(f"Error: Failed to download video from URL: {args.url}")
+                sys.exit(1)
+            logging.info(f"Video downloaded to: {video_source}")
     
     # Create output directory
     os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -825,33 +1113,37 @@ if __name__ == "__main__":
             NUM_CLIPS,
             OUTPUT_DIR,
             GENERATE_BOTH_FORMATS,
-            EXTRACT_FRAMES
+            EXTRACT_FRAMES,
+            asr_model=args.asr_model,
+            sharded_transcription=args.sharded_transcription,
+            asr_engine=args.asr_engine,
+            sparse_transcription=args.sparse_transcription,
+            streaming_render=args.streaming_render,
+            audio_source=audio_source,
+            source_url=args.url
         )
         logging.debug(f"Highlights data: {json.dumps(highlights, ensure_ascii=False, indent=2)}") # Changed to debug
         
-        # Merge if requested
+        # Merge if requested (recorded as recipes; a merged reel is rendered when first requested)
         if MERGE_CLIPS and highlights:
-            logging.info("Merging highlight clips as requested.")
-            # Merge landscape clips
-            if GENERATE_BOTH_FORMATS or args.formats == 'landscape':
-                landscape_merged_path = os.path.join(OUTPUT_DIR, "merged_highlights_landscape.mp4")
-                merged_landscape = merge_highlights_with_transitions(OUTPUT_DIR, landscape_merged_path, format="landscape")
-                if merged_landscape:
-                    logging.info(f"Merged landscape video saved to: {merged_landscape}")
-                else:
-                    logging.warning(f"Failed to merge landscape clips. Check logs for {OUTPUT_DIR}/landscape.")
-
-            # Merge portrait clips if both formats are generated
-            if GENERATE_BOTH_FORMATS or args.formats == 'portrait':
-                portrait_merged_path = os.path.join(OUTPUT_DIR, "merged_highlights_portrait.mp4")
-                merged_portrait = merge_highlights_with_transitions(OUTPUT_DIR, portrait_merged_path, format="portrait")
-                if merged_portrait:
-                    logging.info(f"Merged portrait video saved to: {merged_portrait}")
-                else:
-                    logging.warning(f"Failed to merge portrait clips. Check logs for {OUTPUT_DIR}/portrait.")
+            merge_recipes = {}
+            for merge_format, file_key in (("landscape", "file"), ("portrait", "portrait_file")):
+                if not (GENERATE_BOTH_FORMATS or args.formats == merge_format):
+                    continue
+                # Same order merge_highlights_with_transitions uses: sorted file names
+                inputs = sorted(f"{merge_format}/{os.path.basename(h[file_key])}" for h in highlights if h.get(file_key))
+                if inputs:
+                    merge_recipes[f"merged_highlights_{merge_format}.mp4"] = {
+                        "kind": "text_merged", "inputs": inputs, "transition_duration": 0.1, "engine": args.merge_engine,
+                    }
+            record_recipes(OUTPUT_DIR, merge_recipes)
+            logging.info(f"Recorded merged reels: {', '.join(merge_recipes) or 'none'}")
         elif MERGE_CLIPS and not highlights:
             logging.warning("Merging requested, but no highlights were generated to merge.")
 
+        # Previews now; the eager full-quality outputs continue at low priority in the background
+        publish_job_outputs(OUTPUT_DIR)
+
         logging.info("Processing complete!")
         logging.info(f"Highlight clips saved to: {OUTPUT_DIR}")
         